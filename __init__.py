@@ -1,7 +1,19 @@
+import asyncio
+
 from fastapi import APIRouter
+from lnbits.tasks import create_permanent_unique_task
+from loguru import logger
 
 from .crud import db
-from .views import satsdice_generic_router
+from .payouts import payout_queue
+from .pool import invoice_pool
+from .tasks import (
+    flush_link_counters,
+    run_link_counter_flush,
+    run_retention,
+    wait_for_paid_invoices,
+)
+from .views import satsdice_generic_router, satsdice_renderer
 from .views_api import satsdice_api_router
 from .views_lnurl import satsdice_lnurl_router
 
@@ -17,4 +29,36 @@ satsdice_static_files = [
     }
 ]
 
-__all__ = ["db", "satsdice_ext", "satsdice_static_files"]
+scheduled_tasks: list[asyncio.Task] = []
+
+
+async def satsdice_stop():
+    for task in scheduled_tasks:
+        try:
+            task.cancel()
+        except Exception as ex:
+            logger.warning(ex)
+    await flush_link_counters()
+
+
+def satsdice_start():
+    satsdice_renderer()
+    task = create_permanent_unique_task("ext_satsdice", wait_for_paid_invoices)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_satsdice_counters", run_link_counter_flush)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_satsdice_retention", run_retention)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_satsdice_payouts", payout_queue.run)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_satsdice_pool", invoice_pool.run)
+    scheduled_tasks.append(task)
+
+
+__all__ = [
+    "db",
+    "satsdice_ext",
+    "satsdice_start",
+    "satsdice_static_files",
+    "satsdice_stop",
+]
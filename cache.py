@@ -0,0 +1,46 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Any
+
+
+class LRUCache:
+    """
+    Bounded in-process LRU cache with a per-entry time to live.
+    Keeps hit/miss counters so the cache can be observed.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._values: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        cached = self._values.get(key)
+        if cached is None or cached[0] < monotonic():
+            if cached is not None:
+                del self._values[key]
+            self.misses += 1
+            return default
+        self._values.move_to_end(key)
+        self.hits += 1
+        return cached[1]
+
+    def set(self, key: Any, value: Any) -> None:
+        self._values[key] = (monotonic() + self.ttl, value)
+        self._values.move_to_end(key)
+        while len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+
+    def pop(self, key: Any) -> None:
+        self._values.pop(key, None)
+
+    def clear(self) -> None:
+        self._values.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._values), "hits": self.hits, "misses": self.misses}
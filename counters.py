@@ -0,0 +1,31 @@
+from collections import defaultdict
+
+
+class LinkCounters:
+    """
+    In-memory buffer of per-link counter increments (amount, served_meta,
+    served_pr). The buffer is swapped out before it is written, so a flush
+    that fails or a crash loses the buffered counts instead of applying
+    them twice.
+    """
+
+    def __init__(self) -> None:
+        self._deltas: defaultdict[str, list[int]] = defaultdict(lambda: [0, 0, 0])
+
+    def __len__(self) -> int:
+        return len(self._deltas)
+
+    def add(
+        self, link_id: str, amount: int = 0, served_meta: int = 0, served_pr: int = 0
+    ) -> None:
+        delta = self._deltas[link_id]
+        delta[0] += amount
+        delta[1] += served_meta
+        delta[2] += served_pr
+
+    def take(self) -> dict[str, tuple[int, int, int]]:
+        deltas, self._deltas = self._deltas, defaultdict(lambda: [0, 0, 0])
+        return {link_id: (d[0], d[1], d[2]) for link_id, d in deltas.items()}
+
+
+link_counters = LinkCounters()
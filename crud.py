@@ -1,19 +1,63 @@
+import heapq
+from collections.abc import AsyncIterator, Callable, Sequence
 from datetime import datetime
+from itertools import islice
+from typing import Any, TypeVar
 
-from lnbits.db import Database
+from lnbits.db import SQLITE, Database, insert_query, model_to_dict
 from lnbits.helpers import urlsafe_short_hash
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import text
 
+from .cache import LRUCache
+from .fair import (
+    SEED_CHAIN_LENGTH,
+    SEED_CHAIN_MARGIN,
+    chain_commitment,
+    new_root,
+    unpack_rolls,
+)
+from .metrics import instrument_database, metrics
 from .models import (
+    BetStatus,
     CreateSatsDiceLink,
     CreateSatsDicePayment,
     CreateSatsDiceWithdraw,
+    PayoutStatus,
+    SatsdiceAnalytics,
+    SatsdiceBet,
+    SatsdiceClaim,
     SatsdiceLink,
     SatsdicePayment,
+    SatsdicePayout,
+    SatsdiceRollup,
+    SatsdiceSeedChain,
+    SatsdiceStats,
     SatsdiceWithdraw,
+    WithdrawStatus,
 )
 
 db = Database("ext_satsdice")
 
+# links are read on every step of a bet but almost never change
+satsdice_link_cache = LRUCache(maxsize=1024, ttl=60)
+# hashes that are known to be in hash_checkw, cached for far less time
+# than they are retained
+satsdice_hash_check_cache = LRUCache(maxsize=10000, ttl=3600)
+
+instrument_database(db)
+metrics.gauge(
+    "satsdice_cache",
+    lambda: {
+        (("cache", name), ("stat", stat)): value
+        for name, cache in (
+            ("link", satsdice_link_cache),
+            ("hash_check", satsdice_hash_check_cache),
+        )
+        for stat, value in cache.stats().items()
+    },
+)
+
 
 async def create_satsdice_pay(data: CreateSatsDiceLink) -> SatsdiceLink:
     satsdice = SatsdiceLink(
@@ -21,15 +65,47 @@ async def create_satsdice_pay(data: CreateSatsDiceLink) -> SatsdiceLink:
         **data.dict(),
     )
     await db.insert("satsdice.satsdice_pay", satsdice)
+    # the first commitment is published before the first bet
+    await create_satsdice_seed_chain(satsdice.id)
+    satsdice_link_cache.set(satsdice.id, satsdice.copy())
     return satsdice
 
 
+async def create_satsdice_pays(data: list[CreateSatsDiceLink]) -> list[SatsdiceLink]:
+    """
+    Create many links with one batched insert in a single transaction.
+    """
+    links = [SatsdiceLink(id=urlsafe_short_hash(), **item.dict()) for item in data]
+    if not links:
+        return links
+    chains = [_new_seed_chain(link.id) for link in links]
+    async with db.connect() as conn:
+        await conn.conn.execute(
+            text(insert_query("satsdice.satsdice_pay", links[0])),
+            [model_to_dict(link) for link in links],
+        )
+        await conn.conn.execute(
+            text(insert_query("satsdice.satsdice_seed_chain", chains[0])),
+            [model_to_dict(chain) for chain in chains],
+        )
+        await conn.conn.commit()
+    for link in links:
+        satsdice_link_cache.set(link.id, link.copy())
+    return links
+
+
 async def get_satsdice_pay(link_id: str) -> SatsdiceLink | None:
-    return await db.fetchone(
+    cached = satsdice_link_cache.get(link_id)
+    if cached:
+        return cached.copy()
+    link = await db.fetchone(
         "SELECT * FROM satsdice.satsdice_pay WHERE id = :id",
         {"id": link_id},
         SatsdiceLink,
     )
+    if link:
+        satsdice_link_cache.set(link_id, link.copy())
+    return link
 
 
 async def get_satsdice_pays(wallet_ids: str | list[str]) -> list[SatsdiceLink]:
@@ -43,15 +119,110 @@ async def get_satsdice_pays(wallet_ids: str | list[str]) -> list[SatsdiceLink]:
     )
 
 
+async def get_satsdice_pooled_pays() -> list[SatsdiceLink]:
+    return await db.fetchall(
+        "SELECT * FROM satsdice.satsdice_pay WHERE pool_size > 0",
+        model=SatsdiceLink,
+    )
+
+
+async def get_satsdice_pays_by_id(link_ids: list[str]) -> list[SatsdiceLink]:
+    if not link_ids:
+        return []
+    values = {f"id_{i}": link_id for i, link_id in enumerate(link_ids)}
+    return await db.fetchall(
+        "SELECT * FROM satsdice.satsdice_pay "
+        f"WHERE id IN ({', '.join(f':{key}' for key in values)})",
+        values,
+        SatsdiceLink,
+    )
+
+
+def _link_update(link: SatsdiceLink) -> tuple[str, dict]:
+    # the counters are only ever incremented, see `add_satsdice_pay_counters`
+    values = link.dict(exclude={"amount", "served_meta", "served_pr"})
+    fields = ", ".join([f'"{key}" = :{key}' for key in values.keys()])
+    return f"UPDATE satsdice.satsdice_pay SET {fields} WHERE id = :id", values
+
+
 async def update_satsdice_pay(link: SatsdiceLink) -> SatsdiceLink:
-    await db.update("satsdice.satsdice_pay", link)
+    await db.execute(*_link_update(link))
+    satsdice_link_cache.set(link.id, link.copy())
     return link
 
 
+async def update_satsdice_pays(links: list[SatsdiceLink]) -> list[SatsdiceLink]:
+    """
+    Update many links with one batched statement in a single transaction.
+    """
+    if not links:
+        return links
+    query, _ = _link_update(links[0])
+    async with db.connect() as conn:
+        await conn.conn.execute(text(query), [_link_update(link)[1] for link in links])
+        await conn.conn.commit()
+    for link in links:
+        satsdice_link_cache.set(link.id, link.copy())
+    return links
+
+
+async def add_satsdice_pay_counters(
+    deltas: dict[str, tuple[int, int, int]], batch_size: int = 500
+) -> None:
+    """
+    Add (amount, served_meta, served_pr) increments to many links,
+    with one statement per batch of links.
+    """
+    link_ids = list(deltas.keys())
+    for start in range(0, len(link_ids), batch_size):
+        batch = link_ids[start : start + batch_size]
+        values: dict = {}
+        for i, link_id in enumerate(batch):
+            amount, served_meta, served_pr = deltas[link_id]
+            values[f"id_{i}"] = link_id
+            values[f"amount_{i}"] = amount
+            values[f"meta_{i}"] = served_meta
+            values[f"pr_{i}"] = served_pr
+        ids = ", ".join([f":id_{i}" for i in range(len(batch))])
+        amount_cases, meta_cases, pr_cases = (
+            " ".join(
+                [
+                    f"WHEN :id_{i} THEN CAST(:{key}_{i} AS {db.big_int})"
+                    for i in range(len(batch))
+                ]
+            )
+            for key in ("amount", "meta", "pr")
+        )
+        await db.execute(
+            f"""
+            UPDATE satsdice.satsdice_pay SET
+                amount = amount + CASE id {amount_cases} ELSE 0 END,
+                served_meta = served_meta + CASE id {meta_cases} ELSE 0 END,
+                served_pr = served_pr + CASE id {pr_cases} ELSE 0 END
+            WHERE id IN ({ids})
+            """,
+            values,
+        )
+
+
+async def delete_satsdice_pays(link_ids: list[str]) -> None:
+    if not link_ids:
+        return
+    values = {f"id_{i}": link_id for i, link_id in enumerate(link_ids)}
+    await db.execute(
+        "DELETE FROM satsdice.satsdice_pay "
+        f"WHERE id IN ({', '.join(f':{key}' for key in values)})",
+        values,
+    )
+    for link_id in link_ids:
+        satsdice_link_cache.pop(link_id)
+
+
 async def delete_satsdice_pay(link_id: str) -> None:
     await db.execute(
         "DELETE FROM satsdice.satsdice_pay WHERE id = :id", {"id": link_id}
     )
+    satsdice_link_cache.pop(link_id)
 
 
 async def create_satsdice_payment(data: CreateSatsDicePayment) -> SatsdicePayment:
@@ -77,16 +248,265 @@ async def update_satsdice_payment(payment: SatsdicePayment) -> SatsdicePayment:
     return payment
 
 
+async def settle_satsdice_payment(
+    payment: SatsdicePayment, rollup: SatsdiceRollup
+) -> bool:
+    """
+    Store the outcome and roll of an unresolved bet and add it to the
+    rollups, in a single transaction. Returns False if the bet was already
+    resolved.
+    """
+    async with db.connect() as conn:
+        result = await conn.conn.execute(
+            text(
+                """
+                UPDATE satsdice.satsdice_payment
+                SET paid = :paid, lost = :lost, chain = :chain,
+                    seed_index = :seed_index, roll = :roll, results = :results,
+                    rolled_up = TRUE
+                WHERE payment_hash = :payment_hash AND NOT paid AND NOT lost
+                """
+            ),
+            {
+                "payment_hash": payment.payment_hash,
+                "paid": payment.paid,
+                "lost": payment.lost,
+                "chain": payment.chain,
+                "seed_index": payment.seed_index,
+                "roll": payment.roll,
+                "results": payment.results,
+            },
+        )
+        if result.rowcount != 1:
+            return False
+        await conn.conn.execute(text(_ROLLUP_UPSERT), rollup.dict())
+        await conn.conn.commit()
+        return True
+
+
+async def get_satsdice_payments_by_hash(
+    link_id: str, payment_hashes: list[str]
+) -> list[SatsdicePayment]:
+    values: dict = {"link_id": link_id}
+    keys = []
+    for i, payment_hash in enumerate(payment_hashes):
+        values[f"hash_{i}"] = payment_hash
+        keys.append(f":hash_{i}")
+    return await db.fetchall(
+        f"""
+        SELECT * FROM satsdice.satsdice_payment
+        WHERE payment_hash IN ({", ".join(keys)}) AND satsdice_pay = :link_id
+        """,
+        values,
+        SatsdicePayment,
+    )
+
+
+async def get_pending_satsdice_payments(
+    before: int, cursor: tuple[int, str] | None = None, limit: int = 500
+) -> list[SatsdicePayment]:
+    """
+    Unresolved bets placed before `before`, oldest first, paged by
+    (time, payment_hash).
+    """
+    values: dict = {"before": before, "limit": limit}
+    where = ["NOT paid AND NOT lost", "time < :before"]
+    if cursor:
+        where.append("(time, payment_hash) > (:cursor_time, :cursor_key)")
+        values["cursor_time"], values["cursor_key"] = cursor
+    return await db.fetchall(
+        f"""
+        SELECT * FROM satsdice.satsdice_payment
+        WHERE {" AND ".join(where)}
+        ORDER BY time, payment_hash
+        LIMIT :limit
+        """,
+        values,
+        SatsdicePayment,
+    )
+
+
+async def get_satsdice_bet(link_id: str, payment_hash: str) -> SatsdiceBet | None:
+    return await db.fetchone(
+        """
+        SELECT p.payment_hash, p.satsdice_pay, p.value, p.paid, p.lost, p.time,
+            p.roll, p.rolls, p.results, l.chance, l.multiplier, w.unique_hash,
+            w.value AS winnings, w.used, w.payout_status, w.payout_address
+        FROM satsdice.satsdice_payment p
+        JOIN satsdice.satsdice_pay l ON l.id = p.satsdice_pay
+        LEFT JOIN satsdice.satsdice_withdraw w ON w.id = p.payment_hash
+        WHERE p.payment_hash = :payment_hash AND p.satsdice_pay = :link_id
+        """,
+        {"payment_hash": payment_hash, "link_id": link_id},
+        SatsdiceBet,
+    )
+
+
+async def get_satsdice_bets(
+    wallet_ids: list[str],
+    link_id: str | None = None,
+    status: BetStatus | None = None,
+    cursor: tuple[int, str] | None = None,
+    limit: int = 50,
+) -> list[SatsdiceBet]:
+    """
+    Bets on the wallets' links, newest first, paged by (time, payment_hash).
+    """
+    link_ids = [link_id] if link_id else await _wallet_link_ids(wallet_ids)
+    pages = [
+        await _get_link_bets(wallet_ids, link, status, cursor, limit)
+        for link in link_ids
+    ]
+    return _merge_pages(pages, lambda bet: (bet.time, bet.payment_hash), limit)
+
+
+async def _get_link_bets(
+    wallet_ids: list[str],
+    link_id: str,
+    status: BetStatus | None,
+    cursor: tuple[int, str] | None,
+    limit: int,
+) -> list[SatsdiceBet]:
+    """One page of a link's bets, read in order from its (satsdice_pay, time) index."""
+    values: dict = {"limit": limit, "link_id": link_id}
+    where = [_wallet_clause(wallet_ids, values), "p.satsdice_pay = :link_id"]
+    if status == BetStatus.won:
+        where.append("p.paid")
+    elif status == BetStatus.lost:
+        where.append("p.lost")
+    elif status == BetStatus.unclaimed:
+        where.append("p.paid AND w.used = 0")
+    elif status == BetStatus.pending:
+        where.append("NOT p.paid AND NOT p.lost")
+    if cursor:
+        where.append("(p.time, p.payment_hash) < (:cursor_time, :cursor_key)")
+        values["cursor_time"], values["cursor_key"] = cursor
+    return await db.fetchall(
+        f"""
+        SELECT p.payment_hash, p.satsdice_pay, p.value, p.paid, p.lost, p.time,
+            p.roll, p.rolls, p.results, l.chance, l.multiplier, w.unique_hash,
+            w.value AS winnings, w.used, w.payout_status, w.payout_address
+        FROM satsdice.satsdice_payment p
+        JOIN satsdice.satsdice_pay l ON l.id = p.satsdice_pay
+        LEFT JOIN satsdice.satsdice_withdraw w ON w.id = p.payment_hash
+        WHERE {" AND ".join(where)}
+        ORDER BY p.time DESC, p.payment_hash DESC
+        LIMIT :limit
+        """,
+        values,
+        SatsdiceBet,
+    )
+
+
+EXPORT_COLUMNS = (
+    "payment_hash",
+    "time",
+    "value",
+    "rolls",
+    "outcome",
+    "roll",
+    "winnings",
+    "claim",
+    "payout_address",
+    "archived",
+)
+
+_EXPORT_SELECT = """
+    SELECT p.payment_hash, p.time, p.value, p.rolls,
+        CASE WHEN p.paid THEN 'won' WHEN p.lost THEN 'lost' ELSE 'pending' END,
+        p.roll, COALESCE(w.value, 0),
+        CASE WHEN w.id IS NULL THEN NULL WHEN w.used = 0 THEN 'unclaimed'
+            ELSE COALESCE(w.payout_status, 'paid') END,
+        COALESCE(w.payout_address, p.payout_address), {archived}
+    FROM satsdice.{payments} p
+    LEFT JOIN satsdice.{withdraws} w ON w.id = p.payment_hash
+    WHERE p.satsdice_pay = :link_id{keyset}
+    ORDER BY p.time, p.payment_hash
+"""
+_EXPORT_KEYSET = " AND (p.time, p.payment_hash) > (:after_time, :after_key)"
+
+
+async def stream_satsdice_export(
+    link_id: str, chunk_size: int = 1000
+) -> AsyncIterator[Sequence[Sequence[Any]]]:
+    """
+    Every bet of a link with its withdraw as plain rows of EXPORT_COLUMNS,
+    archived bets first, in chunks of at most `chunk_size` rows. Only one
+    chunk is held in memory at a time.
+    """
+    sqlite = db.type == SQLITE
+    for payments, withdraws, archived in (
+        ("satsdice_payment_archive", "satsdice_withdraw_archive", 1),
+        ("satsdice_payment", "satsdice_withdraw", 0),
+    ):
+        query = _EXPORT_SELECT.format(
+            payments=payments,
+            withdraws=withdraws,
+            archived=archived,
+            keyset=_EXPORT_KEYSET if sqlite else "",
+        )
+        if sqlite:
+            chunks = _export_pages(query + " LIMIT :limit", link_id, chunk_size)
+        else:
+            chunks = _export_cursor(query, link_id, chunk_size)
+        async for chunk in chunks:
+            yield chunk
+
+
+async def _export_cursor(
+    query: str, link_id: str, chunk_size: int
+) -> AsyncIterator[Sequence[Sequence[Any]]]:
+    # a server-side cursor on a connection of its own, db.connect() would
+    # hold the database lock for as long as the download takes
+    async with db.engine.connect() as conn:
+        result = await conn.stream(
+            text(query).execution_options(yield_per=chunk_size), {"link_id": link_id}
+        )
+        async for rows in result.partitions(chunk_size):
+            yield rows
+
+
+async def _export_pages(
+    query: str, link_id: str, chunk_size: int
+) -> AsyncIterator[Sequence[Sequence[Any]]]:
+    # sqlite has no server-side cursors, every chunk is a short keyset query
+    # and the lock is released between chunks
+    values: dict[str, Any] = {
+        "link_id": link_id,
+        "after_time": -1,
+        "after_key": "",
+        "limit": chunk_size,
+    }
+    while True:
+        async with db.connect() as conn:
+            rows = (await conn.conn.execute(text(query), values)).all()
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        values["after_key"], values["after_time"] = rows[-1][0], rows[-1][1]
+
+
 async def create_satsdice_withdraw(data: CreateSatsDiceWithdraw) -> SatsdiceWithdraw:
+    """
+    Withdraws with a payout address are created claimed, with their payout
+    queued, so they never need an LNURL-withdraw round trip.
+    """
+    now = int(datetime.now().timestamp())
     withdraw = SatsdiceWithdraw(
         unique_hash=urlsafe_short_hash(),
         k1=urlsafe_short_hash(),
-        open_time=int(datetime.now().timestamp()),
+        open_time=now,
         id=data.payment_hash,
         satsdice_pay=data.satsdice_pay,
         value=data.value,
         used=data.used,
     )
+    if data.payout_address:
+        withdraw.used = 1
+        withdraw.payout_status = PayoutStatus.queued
+        withdraw.payout_address = data.payout_address
+        withdraw.next_attempt = now
     await db.insert("satsdice.satsdice_withdraw", withdraw)
     return withdraw
 
@@ -108,15 +528,56 @@ async def get_satsdice_withdraw_by_hash(unique_hash: str) -> SatsdiceWithdraw |
 
 
 async def get_satsdice_withdraws(
-    wallet_ids: str | list[str],
+    wallet_ids: list[str],
+    link_id: str | None = None,
+    status: WithdrawStatus | None = None,
+    cursor: tuple[int, str] | None = None,
+    limit: int = 50,
 ) -> list[SatsdiceWithdraw]:
-    if isinstance(wallet_ids, str):
-        wallet_ids = [wallet_ids]
+    """
+    Withdraws of the wallets' links, newest first, paged by (open_time, id).
+    """
+    link_ids = [link_id] if link_id else await _wallet_link_ids(wallet_ids)
+    pages = [
+        await _get_link_withdraws(wallet_ids, link, status, cursor, limit)
+        for link in link_ids
+    ]
+    return _merge_pages(
+        pages, lambda withdraw: (withdraw.open_time, withdraw.id), limit
+    )
 
-    q = ",".join([f"'{wallet_id}'" for wallet_id in wallet_ids])
+
+async def _get_link_withdraws(
+    wallet_ids: list[str],
+    link_id: str,
+    status: WithdrawStatus | None,
+    cursor: tuple[int, str] | None,
+    limit: int,
+) -> list[SatsdiceWithdraw]:
+    """
+    One page of a link's withdraws, read in order from its
+    (satsdice_pay, open_time) or (satsdice_pay, used, open_time) index.
+    """
+    values: dict = {"limit": limit, "link_id": link_id}
+    where = [_wallet_clause(wallet_ids, values), "w.satsdice_pay = :link_id"]
+    # used is 0 or 1, equality keeps the page in (link, used, open_time) order
+    if status == WithdrawStatus.claimed:
+        where.append("w.used = 1")
+    elif status == WithdrawStatus.unclaimed:
+        where.append("w.used = 0")
+    if cursor:
+        where.append("(w.open_time, w.id) < (:cursor_time, :cursor_key)")
+        values["cursor_time"], values["cursor_key"] = cursor
     return await db.fetchall(
-        f"SELECT * FROM satsdice.satsdice_withdraw WHERE wallet IN ({q})",
-        model=SatsdiceWithdraw,
+        f"""
+        SELECT w.* FROM satsdice.satsdice_withdraw w
+        JOIN satsdice.satsdice_pay l ON l.id = w.satsdice_pay
+        WHERE {" AND ".join(where)}
+        ORDER BY w.open_time DESC, w.id DESC
+        LIMIT :limit
+        """,
+        values,
+        SatsdiceWithdraw,
     )
 
 
@@ -125,36 +586,552 @@ async def update_satsdice_withdraw(withdraw: SatsdiceWithdraw) -> SatsdiceWithdr
     return withdraw
 
 
-async def delete_satsdice_withdraw(withdraw_id: str) -> None:
+async def get_unclaimed_winnings(wallet_id: str) -> int:
+    """Winnings the wallet still owes, unclaimed or claimed but not paid yet."""
+    result = await db.execute(
+        """
+        SELECT COALESCE(SUM(w.value), 0) AS total
+        FROM satsdice.satsdice_withdraw w
+        JOIN satsdice.satsdice_pay l ON l.id = w.satsdice_pay
+        WHERE l.wallet = :wallet
+            AND (w.used = 0 OR w.payout_status IN ('queued', 'paying'))
+        """,
+        {"wallet": wallet_id},
+    )
+    row = result.mappings().first()
+    return int(row["total"]) if row else 0
+
+
+async def claim_satsdice_withdraw(
+    unique_hash: str, pr: str, amount_msat: int, opened_after: int = 0
+) -> SatsdiceClaim | None:
+    """
+    Atomically mark an unused withdraw as used and queue its payout to `pr`,
+    returning it together with the wallet of its pay link. Returns None if
+    the withdraw does not exist, is already used, was opened before
+    `opened_after`, is worth less than `amount_msat` or its pay link is gone.
+    """
+    result = await db.execute(
+        """
+        UPDATE satsdice.satsdice_withdraw
+        SET used = 1, payout_status = 'queued', pr = :pr, attempts = 0,
+            next_attempt = :now, error = NULL
+        WHERE unique_hash = :unique_hash AND used = 0
+        AND open_time >= :opened_after AND value * 1000 >= :amount_msat
+        AND satsdice_pay IN (SELECT id FROM satsdice.satsdice_pay)
+        RETURNING id, satsdice_pay, value, (
+            SELECT l.wallet FROM satsdice.satsdice_pay l
+            WHERE l.id = satsdice_withdraw.satsdice_pay
+        ) AS wallet
+        """,
+        {
+            "unique_hash": unique_hash,
+            "pr": pr,
+            "amount_msat": amount_msat,
+            "opened_after": opened_after,
+            "now": int(datetime.now().timestamp()),
+        },
+    )
+    row = result.mappings().first()
+    return SatsdiceClaim(**row) if row else None
+
+
+async def take_satsdice_payouts(now: int, limit: int) -> list[SatsdicePayout]:
+    """
+    Mark up to `limit` queued payouts that are due at `now` as paying and
+    return them, so that no other worker picks them up. Payouts of deleted
+    links are never taken, and a row that is not a valid payout is failed
+    on its own instead of stranding the rest of the batch.
+    """
+    result = await db.execute(
+        """
+        UPDATE satsdice.satsdice_withdraw SET payout_status = 'paying'
+        WHERE id IN (
+            SELECT w.id FROM satsdice.satsdice_withdraw w
+            JOIN satsdice.satsdice_pay l ON l.id = w.satsdice_pay
+            WHERE w.payout_status = 'queued' AND w.next_attempt <= :now
+            ORDER BY w.next_attempt
+            LIMIT :limit
+        ) AND payout_status = 'queued'
+        RETURNING id, unique_hash, value, pr, attempts, payout_address, (
+            SELECT l.wallet FROM satsdice.satsdice_pay l
+            WHERE l.id = satsdice_withdraw.satsdice_pay
+        ) AS wallet
+        """,
+        {"now": now, "limit": limit},
+    )
+    payouts = []
+    for row in result.mappings().all():
+        try:
+            payouts.append(SatsdicePayout(**row))
+        except ValidationError as exc:
+            await fail_satsdice_payout(row["id"], f"Invalid payout: {exc}")
+    return payouts
+
+
+async def set_satsdice_payout_invoice(withdraw_id: str, pr: str) -> None:
+    """
+    Keep the invoice fetched for a payout address, so that retries pay the
+    same invoice instead of fetching a new one.
+    """
     await db.execute(
-        "DELETE FROM satsdice.satsdice_withdraw WHERE id = :id", {"id": withdraw_id}
+        """
+        UPDATE satsdice.satsdice_withdraw SET pr = :pr
+        WHERE id = :id AND pr IS NULL
+        """,
+        {"id": withdraw_id, "pr": pr},
     )
 
 
-async def create_withdraw_hash_check(the_hash: str, lnurl_id: str):
+async def finish_satsdice_payout(withdraw_id: str) -> bool:
+    """Mark a payout paid, False if it was not being paid."""
+    result = await db.execute(
+        """
+        UPDATE satsdice.satsdice_withdraw
+        SET payout_status = 'paid', attempts = attempts + 1, error = NULL
+        WHERE id = :id AND payout_status = 'paying'
+        """,
+        {"id": withdraw_id},
+    )
+    return result.rowcount == 1
+
+
+async def retry_satsdice_payout(
+    withdraw_id: str, next_attempt: int, error: str
+) -> None:
+    await db.execute(
+        """
+        UPDATE satsdice.satsdice_withdraw
+        SET payout_status = 'queued', attempts = attempts + 1,
+            next_attempt = :next_attempt, error = :error
+        WHERE id = :id AND payout_status = 'paying'
+        """,
+        {"id": withdraw_id, "next_attempt": next_attempt, "error": error},
+    )
+
+
+async def fail_satsdice_payout(withdraw_id: str, error: str) -> None:
+    """
+    Give up on a payout and undo its claim, so the winnings can be
+    withdrawn again with a new invoice.
+    """
     await db.execute(
         """
-        INSERT INTO satsdice.hash_checkw (id, lnurl_id)
-        VALUES (:id, :lnurl_id)
+        UPDATE satsdice.satsdice_withdraw
+        SET used = 0, payout_status = 'failed', attempts = attempts + 1,
+            pr = NULL, next_attempt = NULL, error = :error
+        WHERE id = :id AND payout_status = 'paying'
+        """,
+        {"id": withdraw_id, "error": error},
+    )
+
+
+async def get_satsdice_links_paying_out(link_ids: list[str]) -> set[str]:
+    """The links among `link_ids` that have payouts queued or being paid."""
+    if not link_ids:
+        return set()
+    values = {f"id_{i}": link_id for i, link_id in enumerate(link_ids)}
+    rows: list[Any] = await db.fetchall(
+        f"""
+        SELECT DISTINCT satsdice_pay FROM satsdice.satsdice_withdraw
+        WHERE satsdice_pay IN ({", ".join(f":{key}" for key in values)})
+            AND used = 1 AND payout_status IN ('queued', 'paying')
         """,
-        {"id": the_hash, "lnurl_id": lnurl_id},
+        values,
     )
-    hash_check = await get_withdraw_hash_checkw(the_hash, lnurl_id)
-    return hash_check
+    return {row["satsdice_pay"] for row in rows}
 
 
-async def get_withdraw_hash_checkw(the_hash: str, lnurl_id: str):
-    result1 = await db.execute(
-        "SELECT * FROM satsdice.hash_checkw WHERE id = :hash", {"hash": the_hash}
+async def requeue_satsdice_payouts() -> None:
+    """
+    Queue payouts again that were being paid when the server stopped. The
+    funding source refuses to pay an invoice twice, so this is safe.
+    """
+    await db.execute(
+        """
+        UPDATE satsdice.satsdice_withdraw SET payout_status = 'queued'
+        WHERE payout_status = 'paying'
+        """
     )
-    rowid = result1.mappings().first()
-    result2 = await db.execute(
-        "SELECT * FROM satsdice.hash_checkw WHERE lnurl_id = :lnurl_id",
-        {"lnurl_id": lnurl_id},
+
+
+async def delete_satsdice_withdraw(withdraw_id: str) -> None:
+    await db.execute(
+        "DELETE FROM satsdice.satsdice_withdraw WHERE id = :id", {"id": withdraw_id}
     )
-    rowlnurl = result2.mappings().first()
-    if not rowlnurl or not rowid:
-        await create_withdraw_hash_check(the_hash, lnurl_id)
-        return {"lnurl": True, "hash": False}
-    else:
+
+
+async def get_withdraw_hash_checkw(the_hash: str, lnurl_id: str) -> dict[str, bool]:
+    """
+    Records `the_hash` as used with a single upsert. `hash` is True if
+    the hash had been checked before.
+    """
+    if satsdice_hash_check_cache.get(the_hash):
         return {"lnurl": True, "hash": True}
+    result = await db.execute(
+        """
+        INSERT INTO satsdice.hash_checkw (id, lnurl_id, time)
+        VALUES (:id, :lnurl_id, :time)
+        ON CONFLICT (id) DO NOTHING
+        RETURNING id
+        """,
+        {
+            "id": the_hash,
+            "lnurl_id": lnurl_id,
+            "time": int(datetime.now().timestamp()),
+        },
+    )
+    inserted = result.mappings().first() is not None
+    satsdice_hash_check_cache.set(the_hash, True)
+    return {"lnurl": True, "hash": not inserted}
+
+
+def _new_seed_chain(link_id: str, length: int = SEED_CHAIN_LENGTH) -> SatsdiceSeedChain:
+    root = new_root()
+    return SatsdiceSeedChain(
+        id=urlsafe_short_hash(),
+        satsdice_pay=link_id,
+        root=root,
+        commitment=chain_commitment(root, length),
+        length=length,
+    )
+
+
+async def create_satsdice_seed_chain(
+    link_id: str, length: int = SEED_CHAIN_LENGTH
+) -> SatsdiceSeedChain:
+    """Publish the commitment of a new, unused seed chain for a link."""
+    chain = _new_seed_chain(link_id, length)
+    await db.insert("satsdice.satsdice_seed_chain", chain)
+    return chain
+
+
+async def get_satsdice_seed_chain(chain_id: str) -> SatsdiceSeedChain | None:
+    return await db.fetchone(
+        "SELECT * FROM satsdice.satsdice_seed_chain WHERE id = :id",
+        {"id": chain_id},
+        SatsdiceSeedChain,
+    )
+
+
+async def get_satsdice_seed_chains(link_id: str) -> list[SatsdiceSeedChain]:
+    return await db.fetchall(
+        """
+        SELECT * FROM satsdice.satsdice_seed_chain
+        WHERE satsdice_pay = :link_id ORDER BY created_at, id
+        """,
+        {"link_id": link_id},
+        SatsdiceSeedChain,
+    )
+
+
+async def reserve_satsdice_seed(link_id: str) -> tuple[str, int] | None:
+    """
+    Hand out the next unused seed of the link's published seed chains as
+    (chain, index). The next chain is published once the current one has
+    `SEED_CHAIN_MARGIN` seeds left, so seeds only ever come from a chain
+    whose commitment was out before the bet was paid. Returns None, after
+    publishing a chain, if the link had none left.
+    """
+    result = await db.execute(
+        """
+        UPDATE satsdice.satsdice_seed_chain SET used = used + 1
+        WHERE id = (
+            SELECT id FROM satsdice.satsdice_seed_chain
+            WHERE satsdice_pay = :link_id AND used < length
+            ORDER BY created_at, id LIMIT 1
+        ) AND used < length
+        RETURNING id, used, length
+        """,
+        {"link_id": link_id},
+    )
+    row = result.mappings().first()
+    if not row:
+        await create_satsdice_seed_chain(link_id)
+        return None
+    if row["length"] - row["used"] <= SEED_CHAIN_MARGIN:
+        spare: Any = await db.fetchone(
+            """
+            SELECT COUNT(*) AS chains FROM satsdice.satsdice_seed_chain
+            WHERE satsdice_pay = :link_id AND used < length AND id != :id
+            """,
+            {"link_id": link_id, "id": row["id"]},
+        )
+        if not spare["chains"]:
+            await create_satsdice_seed_chain(link_id)
+    return row["id"], row["used"]
+
+
+async def expire_satsdice_payments(
+    before: int, lost: bool = True, archive: bool = True, batch_size: int = 500
+) -> int:
+    """
+    Remove one batch of lost bets, or of bets that were never paid, placed
+    before `before`. Returns the number of bets removed.
+    """
+    state = "lost" if lost else "NOT paid AND NOT lost"
+    return await _expire_batch(
+        f"""
+        SELECT payment_hash AS id FROM satsdice.satsdice_payment
+        WHERE {state} AND time < :before LIMIT :limit
+        """,
+        {"before": before, "limit": batch_size},
+        [("satsdice_payment", "payment_hash", SatsdicePayment)],
+        archive,
+    )
+
+
+async def expire_satsdice_withdraws(
+    before: int, claimed: bool, archive: bool = True, batch_size: int = 500
+) -> int:
+    """
+    Remove one batch of claimed or unclaimed withdraws opened before
+    `before`, together with the bets they pay out. Claimed withdraws whose
+    payout is still queued or being paid are kept until it ends.
+    Returns the number of withdraws removed.
+    """
+    return await _expire_batch(
+        """
+        SELECT id FROM satsdice.satsdice_withdraw
+        WHERE used = :used AND open_time < :before
+            AND (payout_status IS NULL OR payout_status NOT IN ('queued', 'paying'))
+        LIMIT :limit
+        """,
+        {"used": int(claimed), "before": before, "limit": batch_size},
+        [
+            ("satsdice_withdraw", "id", SatsdiceWithdraw),
+            ("satsdice_payment", "payment_hash", SatsdicePayment),
+        ],
+        archive,
+    )
+
+
+async def delete_withdraw_hash_checks(before: int, batch_size: int = 500) -> int:
+    result = await db.execute(
+        """
+        DELETE FROM satsdice.hash_checkw WHERE id IN (
+            SELECT id FROM satsdice.hash_checkw WHERE time < :before LIMIT :limit
+        )
+        """,
+        {"before": before, "limit": batch_size},
+    )
+    if result.rowcount:
+        satsdice_hash_check_cache.clear()
+    return result.rowcount
+
+
+async def _expire_batch(
+    select: str,
+    values: dict,
+    tables: list[tuple[str, str, type[BaseModel]]],
+    archive: bool,
+) -> int:
+    # every step can safely run again, so a batch that is interrupted
+    # half way is simply finished by the next run
+    async with db.connect() as conn:
+        rows = await conn.fetchall(select, values)
+        if not rows:
+            return 0
+        keys = {f"id_{i}": row["id"] for i, row in enumerate(rows)}
+        ids = ", ".join(f":{key}" for key in keys)
+        for table, key, model in tables:
+            if archive:
+                columns = ", ".join(model.__fields__)
+                await conn.execute(
+                    f"""
+                    INSERT INTO satsdice.{table}_archive ({columns})
+                    SELECT {columns} FROM satsdice.{table} WHERE {key} IN ({ids})
+                    ON CONFLICT ({key}) DO NOTHING
+                    """,
+                    keys,
+                )
+            await conn.execute(
+                f"DELETE FROM satsdice.{table} WHERE {key} IN ({ids})", keys
+            )
+        return len(rows)
+
+
+_ROLLUP_UPSERT = """
+    INSERT INTO satsdice.satsdice_rollup
+        (satsdice_pay, hour, bets, volume, volume_sq, wins, payouts, biggest_win)
+    VALUES (
+        :satsdice_pay, :hour, :bets, :volume, :volume_sq, :wins, :payouts,
+        :biggest_win
+    )
+    ON CONFLICT (satsdice_pay, hour) DO UPDATE SET
+        bets = satsdice_rollup.bets + excluded.bets,
+        volume = satsdice_rollup.volume + excluded.volume,
+        volume_sq = satsdice_rollup.volume_sq + excluded.volume_sq,
+        wins = satsdice_rollup.wins + excluded.wins,
+        payouts = satsdice_rollup.payouts + excluded.payouts,
+        biggest_win = CASE
+            WHEN excluded.biggest_win > satsdice_rollup.biggest_win
+            THEN excluded.biggest_win ELSE satsdice_rollup.biggest_win
+        END
+"""
+
+
+async def backfill_satsdice_rollups(batch_size: int = 500) -> int:
+    """
+    Count one batch of settled bets that are not in the rollups yet, in a
+    single transaction. Returns the number of bets counted.
+    """
+    async with db.connect() as conn:
+        rows = await conn.fetchall(
+            """
+            SELECT p.payment_hash, p.satsdice_pay, p.time, p.value, p.paid,
+                p.rolls, p.results, COALESCE(w.value, 0) AS winnings
+            FROM satsdice.satsdice_payment p
+            LEFT JOIN satsdice.satsdice_withdraw w ON w.id = p.payment_hash
+            WHERE NOT p.rolled_up AND (p.paid OR p.lost)
+            ORDER BY p.time, p.payment_hash
+            LIMIT :limit
+            """,
+            {"limit": batch_size},
+        )
+        if not rows:
+            return 0
+        rollups: dict[tuple[str, int], SatsdiceRollup] = {}
+        for row in rows:
+            hour = rollup_hour(row["time"])
+            rollup = rollups.get((row["satsdice_pay"], hour))
+            if rollup is None:
+                rollup = rollups[(row["satsdice_pay"], hour)] = SatsdiceRollup(
+                    satsdice_pay=row["satsdice_pay"], hour=hour
+                )
+            winnings = row["winnings"] if row["paid"] else 0
+            rollup.bets += row["rolls"]
+            rollup.volume += row["value"]
+            rollup.volume_sq += row["value"] ** 2 / row["rolls"]
+            if row["results"]:
+                rollup.wins += sum(won for _, won in unpack_rolls(row["results"]))
+            else:
+                rollup.wins += int(bool(row["paid"]))
+            rollup.payouts += winnings
+            rollup.biggest_win = max(rollup.biggest_win, winnings)
+
+        keys = {f"hash_{i}": row["payment_hash"] for i, row in enumerate(rows)}
+        await conn.conn.execute(
+            text(
+                "UPDATE satsdice.satsdice_payment SET rolled_up = TRUE "
+                f"WHERE payment_hash IN ({', '.join(f':{key}' for key in keys)})"
+            ),
+            keys,
+        )
+        await conn.conn.execute(
+            text(_ROLLUP_UPSERT), [rollup.dict() for rollup in rollups.values()]
+        )
+        await conn.conn.commit()
+        return len(rows)
+
+
+def rollup_hour(time: int) -> int:
+    return time - time % 3600
+
+
+async def get_satsdice_rollups(
+    link_id: str, start: int, end: int
+) -> list[SatsdiceRollup]:
+    return await db.fetchall(
+        """
+        SELECT * FROM satsdice.satsdice_rollup
+        WHERE satsdice_pay = :link_id AND hour >= :start AND hour < :end
+        ORDER BY hour
+        """,
+        {"link_id": link_id, "start": start, "end": end},
+        SatsdiceRollup,
+    )
+
+
+async def get_satsdice_stats(
+    wallet_ids: list[str], link_id: str | None, start: int, end: int
+) -> list[SatsdiceStats]:
+    """
+    Totals per link between `start` and `end`, read from the hourly rollups.
+    """
+    values: dict = {"start": start, "end": end}
+    where = [_wallet_clause(wallet_ids, values), "r.hour >= :start", "r.hour < :end"]
+    if link_id:
+        where.append("l.id = :link_id")
+        values["link_id"] = link_id
+    return await db.fetchall(
+        f"""
+        SELECT r.satsdice_pay, SUM(r.bets) AS bets, SUM(r.volume) AS volume,
+            SUM(r.wins) AS wins, SUM(r.payouts) AS payouts,
+            MAX(r.biggest_win) AS biggest_win
+        FROM satsdice.satsdice_pay l
+        JOIN satsdice.satsdice_rollup r ON r.satsdice_pay = l.id
+        WHERE {" AND ".join(where)}
+        GROUP BY r.satsdice_pay
+        """,
+        values,
+        SatsdiceStats,
+    )
+
+
+async def get_satsdice_analytics(
+    wallet_ids: list[str], link_id: str | None, start: int, end: int
+) -> list[SatsdiceAnalytics]:
+    """
+    Per link aggregates between `start` and `end` from the hourly rollups,
+    with the winnings that are still unclaimed right now.
+    """
+    values: dict = {"start": start, "end": end}
+    where = [_wallet_clause(wallet_ids, values)]
+    if link_id:
+        where.append("l.id = :link_id")
+        values["link_id"] = link_id
+    return await db.fetchall(
+        f"""
+        SELECT l.id AS satsdice_pay, l.chance, l.multiplier,
+            COALESCE(SUM(r.bets), 0) AS bets,
+            COALESCE(SUM(r.volume), 0) AS volume,
+            COALESCE(SUM(r.volume_sq), 0) AS volume_sq,
+            COALESCE(SUM(r.wins), 0) AS wins,
+            COALESCE(SUM(r.payouts), 0) AS payouts,
+            (
+                SELECT COALESCE(SUM(w.value), 0)
+                FROM satsdice.satsdice_withdraw w
+                WHERE w.satsdice_pay = l.id AND w.used = 0
+            ) AS liability
+        FROM satsdice.satsdice_pay l
+        LEFT JOIN satsdice.satsdice_rollup r
+            ON r.satsdice_pay = l.id AND r.hour >= :start AND r.hour < :end
+        WHERE {" AND ".join(where)}
+        GROUP BY l.id, l.chance, l.multiplier
+        """,
+        values,
+        SatsdiceAnalytics,
+    )
+
+
+async def _wallet_link_ids(wallet_ids: list[str]) -> list[str]:
+    values: dict = {}
+    rows: list[Any] = await db.fetchall(
+        f"SELECT l.id FROM satsdice.satsdice_pay l "
+        f"WHERE {_wallet_clause(wallet_ids, values)}",
+        values,
+    )
+    return [row["id"] for row in rows]
+
+
+Row = TypeVar("Row")
+
+
+def _merge_pages(
+    pages: list[list[Row]], key: Callable[[Row], tuple[int, str]], limit: int
+) -> list[Row]:
+    """
+    The newest `limit` rows of pages that are each sorted newest first.
+    History across links is paged this way, as no index orders the rows of
+    several links by time, but each link's own index does.
+    """
+    return list(islice(heapq.merge(*pages, key=key, reverse=True), limit))
+
+
+def _wallet_clause(wallet_ids: list[str], values: dict) -> str:
+    keys = []
+    for i, wallet_id in enumerate(wallet_ids):
+        values[f"wallet_{i}"] = wallet_id
+        keys.append(f":wallet_{i}")
+    return f"l.wallet IN ({', '.join(keys)})"
@@ -0,0 +1,44 @@
+import asyncio
+from collections import defaultdict
+
+from .metrics import metrics
+
+
+class BetEvents:
+    """
+    In-process fan-out of bet events to Server-Sent Event streams. Channels
+    are a payment hash for a single bet or `link:<id>` for all bets of a
+    link. Streams only see events of bets resolved by their own process.
+    """
+
+    def __init__(self, queue_size: int = 16) -> None:
+        self.queue_size = queue_size
+        self._subscribers: defaultdict[str, set[asyncio.Queue]] = defaultdict(set)
+
+    def subscribe(self, channel: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(self.queue_size)
+        self._subscribers[channel].add(queue)
+        return queue
+
+    def unsubscribe(self, channel: str, queue: asyncio.Queue) -> None:
+        subscribers = self._subscribers.get(channel)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._subscribers[channel]
+
+    def publish(self, channel: str, event: str, data: dict) -> None:
+        for queue in self._subscribers.get(channel, ()):
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                # a stream that stopped reading just misses events
+                pass
+
+    def __len__(self) -> int:
+        return sum(len(queues) for queues in self._subscribers.values())
+
+
+bet_events = BetEvents()
+metrics.gauge("satsdice_event_streams", lambda: {(): len(bet_events)})
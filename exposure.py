@@ -0,0 +1,51 @@
+from lnbits.core.crud import get_wallet
+from lnbits.utils.cache import cache
+
+from .crud import get_unclaimed_winnings
+
+
+class HouseExposure:
+    """
+    Running total of winnings not paid out yet per wallet. Each wallet is
+    seeded with one SUM over its withdraws the first time it is needed and
+    from then on only moves when withdraws are created or their payouts paid.
+    """
+
+    def __init__(self, balance_expiry: float = 5) -> None:
+        self.balance_expiry = balance_expiry
+        self._liability: dict[str, int] = {}
+
+    async def liability(self, wallet_id: str) -> int:
+        if wallet_id not in self._liability:
+            seeded = await get_unclaimed_winnings(wallet_id)
+            self._liability.setdefault(wallet_id, seeded)
+        return self._liability[wallet_id]
+
+    def add(self, wallet_id: str, amount: int) -> None:
+        # wallets that are not seeded yet will pick this up from the database
+        if wallet_id in self._liability:
+            self._liability[wallet_id] += amount
+
+    def reset(self) -> None:
+        """Forget all totals, e.g. after withdraws expired in bulk."""
+        self._liability.clear()
+
+    async def balance(self, wallet_id: str) -> int:
+        async def _balance() -> int:
+            wallet = await get_wallet(wallet_id)
+            return wallet.balance if wallet else 0
+
+        return await cache.save_result(
+            _balance, f"satsdice:balance:{wallet_id}", expiry=self.balance_expiry
+        )
+
+    async def admits(self, wallet_id: str, payout: int) -> bool:
+        """
+        Whether the wallet can cover a possible `payout` on top of the
+        winnings that are still waiting to be paid out.
+        """
+        balance = await self.balance(wallet_id)
+        return await self.liability(wallet_id) + payout <= balance
+
+
+house_exposure = HouseExposure()
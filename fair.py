@@ -0,0 +1,116 @@
+"""
+Provably fair rolls.
+
+Every link rolls from a chain of server seeds. The chain is generated by
+hashing a random root `length` times and is handed out backwards:
+
+    seed(i) = sha256^(length - i)(root),  commitment = seed(0)
+
+The commitment is published before any seed of the chain is used: a
+link's first chain when the link is created, every next one while the
+current chain still has `SEED_CHAIN_MARGIN` seeds left. Once
+seed(i) is revealed anyone can check that sha256(seed(i)) == seed(i - 1),
+all the way back to the commitment, while seeds after i stay unknown.
+
+A roll is HMAC-SHA256(seed, payment_hash) reduced to basis points, a bet
+with a chance of 45% wins if its roll is below 4500. Bets of N rolls use
+one seed; roll i > 0 is keyed by "payment_hash:i" instead.
+"""
+
+import hashlib
+import hmac
+import secrets
+import struct
+from base64 import b64decode, b64encode
+from collections.abc import Iterable
+
+SEED_CHAIN_LENGTH = 10_000
+SEED_CHAIN_MARGIN = 100
+ROLL_RANGE = 10_000
+CHECKPOINT_INTERVAL = 100
+
+
+def new_root() -> str:
+    return secrets.token_hex(32)
+
+
+def chain_commitment(root: str, length: int) -> str:
+    seed = bytes.fromhex(root)
+    for _ in range(length):
+        seed = hashlib.sha256(seed).digest()
+    return seed.hex()
+
+
+def roll(seed: bytes, payment_hash: str) -> int:
+    digest = hmac.new(seed, payment_hash.encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], "big") % ROLL_RANGE
+
+
+def wins(roll: int, chance: float) -> bool:
+    return roll < round(chance * ROLL_RANGE / 100)
+
+
+def win_probability(chance: float) -> float:
+    return round(chance * ROLL_RANGE / 100) / ROLL_RANGE
+
+
+def rolls(seed: bytes, payment_hash: str, count: int) -> list[int]:
+    """All rolls of a bet, the first is the roll of a single roll bet."""
+    return [
+        roll(seed, f"{payment_hash}:{i}" if i else payment_hash) for i in range(count)
+    ]
+
+
+def pack_rolls(results: Iterable[tuple[int, bool]]) -> str:
+    """Two bytes per roll, the highest bit is set for winning rolls."""
+    values = [value | won << 15 for value, won in results]
+    return b64encode(struct.pack(f">{len(values)}H", *values)).decode()
+
+
+def unpack_rolls(packed: str) -> list[tuple[int, bool]]:
+    data = b64decode(packed)
+    values = struct.unpack(f">{len(data) // 2}H", data)
+    return [(value & 0x7FFF, bool(value >> 15)) for value in values]
+
+
+class SeedChain:
+    """
+    Seeds of one chain. The first lookup walks the whole chain once and keeps
+    every CHECKPOINT_INTERVAL-th seed, later lookups hash forward from the
+    nearest checkpoint.
+    """
+
+    def __init__(self, root: str, length: int) -> None:
+        self.root = bytes.fromhex(root)
+        self.length = length
+        self._checkpoints: dict[int, bytes] | None = None
+
+    def seed(self, index: int) -> bytes:
+        if not 0 <= index <= self.length:
+            raise ValueError(f"Seed index {index} is outside of the chain.")
+        if self._checkpoints is None:
+            self._checkpoints = {}
+            seed = self.root
+            for i in range(self.length, -1, -1):
+                if i % CHECKPOINT_INTERVAL == 0 or i == self.length:
+                    self._checkpoints[i] = seed
+                seed = hashlib.sha256(seed).digest()
+        start = min(-(-index // CHECKPOINT_INTERVAL) * CHECKPOINT_INTERVAL, self.length)
+        seed = self._checkpoints[start]
+        for _ in range(start - index):
+            seed = hashlib.sha256(seed).digest()
+        return seed
+
+    def seeds(self, indexes: Iterable[int]) -> tuple[dict[int, bytes], bytes]:
+        """
+        Seeds at `indexes` and the recomputed commitment, in a single walk
+        down the chain.
+        """
+        wanted = set(indexes)
+        found: dict[int, bytes] = {}
+        seed = self.root
+        for i in range(self.length, 0, -1):
+            if i in wanted:
+                found[i] = seed
+            seed = hashlib.sha256(seed).digest()
+        return found, seed
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import math
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from functools import lru_cache
+from typing import NamedTuple
+
+from lnurl import (
+    CallbackUrl,
+    LnAddress,
+    LnAddressError,
+    LnurlPayerData,
+    LnurlPayMetadata,
+    LnurlPayResponse,
+    LnurlPayResponsePayerData,
+    LnurlPayResponsePayerDataOption,
+    MilliSatoshi,
+)
+from pydantic import ValidationError, parse_obj_as
+
+from .models import SatsdiceLink
+
+# long enough for any Lightning address
+COMMENT_ALLOWED = 144
+
+
+class CachedResponse(NamedTuple):
+    content: bytes
+    etag: str
+
+
+def etag(*parts: object) -> str:
+    """Strong ETag over `parts`."""
+    digest = hashlib.sha256(":".join(map(str, parts)).encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def not_modified(if_none_match: str | None, current: str) -> bool:
+    """Whether an If-None-Match header matches the `current` ETag."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or current in tags
+
+
+class LnurlpMetadata(NamedTuple):
+    metadata: LnurlPayMetadata
+    encoded: bytes
+    description_hash: bytes
+
+
+@lru_cache(maxsize=1024)
+def _lnurlp_metadata(
+    title: str, chance: float, multiplier: float, rolls: int
+) -> LnurlpMetadata:
+    terms = f"Chance: {chance}%, Multiplier: {multiplier}"
+    if rolls > 1:
+        terms += f", Rolls: {rolls}"
+    _plain = ["text/plain", f"{title} ({terms})"]
+    metadata = LnurlPayMetadata(json.dumps([_plain]))
+    encoded = metadata.encode()
+    return LnurlpMetadata(metadata, encoded, hashlib.sha256(encoded).digest())
+
+
+def lnurlp_metadata(link: SatsdiceLink) -> LnurlpMetadata:
+    """
+    LNURL-pay metadata of a link, built once per title and odds.
+    """
+    return _lnurlp_metadata(link.title, link.chance, link.multiplier, link.rolls)
+
+
+def bet_invoice(link: SatsdiceLink, amount: int, payerdata: str | None = None) -> dict:
+    """
+    Arguments of `create_invoice` for a bet of `amount` sats on `link`.
+    Per LUD-18 the invoice commits to the metadata followed by the payer
+    data exactly as the wallet sent it.
+    """
+    description = lnurlp_metadata(link).encoded
+    if payerdata:
+        description += payerdata.encode()
+    return {
+        "wallet_id": link.wallet,
+        "amount": amount,
+        "memo": "Satsdice bet",
+        "description_hash": hashlib.sha256(description).digest(),
+        "unhashed_description": description,
+        "extra": {"tag": "satsdice", "link": link.id, "comment": "comment"},
+    }
+
+
+@lru_cache(maxsize=1024)
+def _lnurlp_response(
+    callback_url: str,
+    title: str,
+    chance: float,
+    multiplier: float,
+    min_bet: int,
+    max_bet: int,
+    rolls: int,
+) -> CachedResponse:
+    # bets are per roll, one payment covers all rolls
+    response = LnurlPayResponse(
+        callback=parse_obj_as(CallbackUrl, callback_url),
+        metadata=_lnurlp_metadata(title, chance, multiplier, rolls).metadata,
+        minSendable=MilliSatoshi(math.ceil(min_bet * rolls) * 1000),
+        maxSendable=MilliSatoshi(round(max_bet * rolls) * 1000),
+        # a Lightning address to pay the winnings to, LUD-18 or LUD-12
+        payerData=LnurlPayResponsePayerData(
+            identifier=LnurlPayResponsePayerDataOption(mandatory=False)
+        ),
+        commentAllowed=COMMENT_ALLOWED,
+    )
+    content = response.json().encode()
+    return CachedResponse(content, etag(content))
+
+
+def lnurlp_response(link: SatsdiceLink, callback_url: str) -> CachedResponse:
+    """
+    Serialized first step LNURL-pay response of a link and its ETag.
+    """
+    return _lnurlp_response(
+        callback_url,
+        link.title,
+        link.chance,
+        link.multiplier,
+        link.min_bet,
+        link.max_bet,
+        link.rolls,
+    )
+
+
+def payout_address(comment: str | None, payerdata: str | None) -> str | None:
+    """
+    Lightning address a bet's winnings are paid out to: the LUD-18 payer
+    identifier, or else a LUD-12 comment that is nothing but an address.
+    """
+    candidates = [comment]
+    if payerdata:
+        try:
+            candidates.insert(0, LnurlPayerData.parse_raw(payerdata).identifier)
+        except ValidationError:
+            pass
+    for candidate in candidates:
+        if not candidate:
+            continue
+        try:
+            return str(LnAddress(candidate.strip()))
+        except (LnAddressError, ValueError):
+            continue
+    return None
+
+
+def encode_cursor(time: int, key: str) -> str:
+    """
+    Opaque keyset pagination cursor pointing after the row (time, key).
+    """
+    return urlsafe_b64encode(json.dumps([time, key]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[int, str]:
+    try:
+        time, key = json.loads(urlsafe_b64decode(cursor.encode()))
+        return int(time), str(key)
+    except Exception as exc:
+        raise ValueError("Invalid cursor.") from exc
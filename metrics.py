@@ -0,0 +1,162 @@
+from bisect import bisect_left
+from collections import defaultdict
+from collections.abc import Callable, Coroutine
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any
+
+from fastapi import HTTPException, Request, Response
+from fastapi.routing import APIRoute
+from lnbits.db import Database
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Request, database and payment backend metrics of the extension,
+    rendered in the Prometheus text format. Recording is a few dict
+    lookups and integer increments, cheap enough to always be on.
+    """
+
+    def __init__(self) -> None:
+        self.counters: defaultdict[str, defaultdict[Labels, float]] = defaultdict(
+            lambda: defaultdict(float)
+        )
+        self.histograms: defaultdict[str, dict[Labels, Histogram]] = defaultdict(dict)
+        self.gauges: dict[str, Callable[[], dict[Labels, float]]] = {}
+        self.help: dict[str, str] = {}
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1) -> None:
+        self.counters[name][labels] += value
+
+    def observe(self, name: str, labels: Labels, value: float) -> None:
+        histogram = self.histograms[name].get(labels)
+        if histogram is None:
+            histogram = self.histograms[name][labels] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name: str, collect: Callable[[], dict[Labels, float]]) -> None:
+        """Register a gauge whose values are collected when rendering."""
+        self.gauges[name] = collect
+
+    @contextmanager
+    def timer(self, name: str, labels: Labels = ()):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, perf_counter() - start)
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for name, values in self.counters.items():
+            self._header(lines, name, "counter")
+            for labels, value in values.items():
+                lines.append(f"{name}{_labels(labels)} {value:g}")
+        for name, histograms in self.histograms.items():
+            self._header(lines, name, "histogram")
+            for labels, histogram in histograms.items():
+                cumulative = 0
+                for bound, count in zip(
+                    (*histogram.buckets, "+Inf"), histogram.counts, strict=True
+                ):
+                    cumulative += count
+                    bucket_labels = (*labels, ("le", str(bound)))
+                    lines.append(f"{name}_bucket{_labels(bucket_labels)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram.sum:g}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        for name, collect in self.gauges.items():
+            self._header(lines, name, "gauge")
+            for labels, value in collect().items():
+                lines.append(f"{name}{_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines: list[str], name: str, kind: str) -> None:
+        if name in self.help:
+            lines.append(f"# HELP {name} {self.help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join([f'{key}="{_escape(value)}"' for key, value in labels]) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
+metrics.help.update(
+    {
+        "satsdice_requests_total": "Requests by route, method and status code.",
+        "satsdice_request_errors_total": "Requests that raised or returned a 5xx.",
+        "satsdice_request_duration_seconds": "Request latency by route.",
+        "satsdice_db_statements_total": "Statements sent to the satsdice database.",
+        "satsdice_backend_wait_seconds": "Time spent waiting on the funding source.",
+        "satsdice_retention_rows_total": "Rows removed by retention, by rule.",
+        "satsdice_retention_seconds": "Duration of retention runs.",
+        "satsdice_payouts_total": "Payout attempts by result.",
+        "satsdice_rate_limited_total": "LNURL-pay callbacks refused by a rate limit.",
+        "satsdice_invoice_pool_total": "Pooled invoices by what became of them.",
+    }
+)
+
+
+class MetricsRoute(APIRoute):
+    """Route class that records count, latency and errors of each request."""
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+        route = (("route", self.path),)
+
+        async def instrumented_handler(request: Request) -> Response:
+            start = perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            except HTTPException as exc:
+                status = exc.status_code
+                raise
+            finally:
+                metrics.observe(
+                    "satsdice_request_duration_seconds",
+                    route,
+                    perf_counter() - start,
+                )
+                labels = (*route, ("method", request.method), ("status", str(status)))
+                metrics.inc("satsdice_requests_total", labels)
+                if status >= 500:
+                    metrics.inc("satsdice_request_errors_total", route)
+
+        return instrumented_handler
+
+
+def instrument_database(db: Database) -> None:
+    """Count the statements `db` sends to the database, by statement type."""
+
+    def count_statement(conn, cursor, statement: str, *_):
+        kind = statement.lstrip().split(None, 1)[0].upper()
+        metrics.inc("satsdice_db_statements_total", (("statement", kind),))
+
+    event.listen(db.engine.sync_engine, "before_cursor_execute", count_statement)
@@ -1,3 +1,22 @@
+import time
+
+from lnbits.db import SQLITE
+from lnbits.helpers import urlsafe_short_hash
+
+from .fair import SEED_CHAIN_LENGTH, chain_commitment, new_root
+
+
+def _create_index(db, name: str, table: str, columns: str, where: str = "") -> str:
+    # sqlite attaches the extension database as a schema, so the schema
+    # prefix belongs to the index name instead of the table name
+    where = f" WHERE {where}" if where else ""
+    if db.type == SQLITE:
+        return (
+            f"CREATE INDEX IF NOT EXISTS satsdice.{name} ON {table} ({columns})" + where
+        )
+    return f"CREATE INDEX IF NOT EXISTS {name} ON satsdice.{table} ({columns})" + where
+
+
 async def m001_initial(db):
     """
     Creates an improved satsdice table and migrates the existing data.
@@ -81,3 +100,386 @@ async def m005_add_disposable(db):
     await db.execute(
         "ALTER TABLE satsdice.satsdice_pay ADD COLUMN disposable BOOL DEFAULT TRUE"
     )
+
+
+async def m006_add_indexes(db):
+    """
+    Adds secondary indexes for the wallet and link lookups.
+    """
+    await db.execute(
+        _create_index(db, "satsdice_pay_wallet_idx", "satsdice_pay", "wallet")
+    )
+    await db.execute(
+        _create_index(
+            db, "satsdice_payment_satsdice_pay_idx", "satsdice_payment", "satsdice_pay"
+        )
+    )
+    await db.execute(
+        _create_index(
+            db,
+            "satsdice_withdraw_satsdice_pay_idx",
+            "satsdice_withdraw",
+            "satsdice_pay",
+        )
+    )
+    await db.execute(
+        _create_index(db, "hash_checkw_lnurl_id_idx", "hash_checkw", "lnurl_id")
+    )
+
+
+async def m007_add_payment_time(db):
+    """
+    Adds a time column to satsdice_payment and indexes for paging bet
+    and withdraw history by time.
+    """
+    await db.execute("ALTER TABLE satsdice.satsdice_payment ADD COLUMN time INTEGER")
+    await db.execute("UPDATE satsdice.satsdice_payment SET time = 0")
+    await db.execute(
+        _create_index(
+            db,
+            "satsdice_payment_satsdice_pay_time_idx",
+            "satsdice_payment",
+            "satsdice_pay, time, payment_hash",
+        )
+    )
+    await db.execute(
+        _create_index(
+            db,
+            "satsdice_withdraw_satsdice_pay_open_time_idx",
+            "satsdice_withdraw",
+            "satsdice_pay, open_time, id",
+        )
+    )
+
+
+async def m008_add_seed_chains(db):
+    """
+    Creates the seed chain table for provably fair rolls and records the
+    seed and roll of every bet.
+    """
+    await db.execute(
+        """
+        CREATE TABLE satsdice.satsdice_seed_chain (
+            id TEXT PRIMARY KEY,
+            satsdice_pay TEXT NOT NULL,
+            root TEXT NOT NULL,
+            commitment TEXT NOT NULL,
+            length INTEGER NOT NULL,
+            used INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL
+        );
+    """
+    )
+    await db.execute(
+        _create_index(
+            db,
+            "satsdice_seed_chain_satsdice_pay_idx",
+            "satsdice_seed_chain",
+            "satsdice_pay, created_at",
+        )
+    )
+    await db.execute("ALTER TABLE satsdice.satsdice_payment ADD COLUMN chain TEXT")
+    await db.execute(
+        "ALTER TABLE satsdice.satsdice_payment ADD COLUMN seed_index INTEGER"
+    )
+    await db.execute("ALTER TABLE satsdice.satsdice_payment ADD COLUMN roll INTEGER")
+
+
+async def m009_add_retention(db):
+    """
+    Creates archive tables for expired payments and withdraws, adds a time
+    column to hash_checkw and indexes for finding expired rows.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE satsdice.satsdice_payment_archive (
+            payment_hash TEXT PRIMARY KEY,
+            satsdice_pay TEXT,
+            value {db.big_int},
+            paid BOOL DEFAULT FALSE,
+            lost BOOL DEFAULT FALSE,
+            time INTEGER,
+            chain TEXT,
+            seed_index INTEGER,
+            roll INTEGER
+        );
+    """
+    )
+    await db.execute(
+        f"""
+        CREATE TABLE satsdice.satsdice_withdraw_archive (
+            id TEXT PRIMARY KEY,
+            satsdice_pay TEXT,
+            value {db.big_int} DEFAULT 1,
+            unique_hash TEXT,
+            k1 TEXT,
+            open_time INTEGER,
+            used INTEGER DEFAULT 0
+        );
+    """
+    )
+    await db.execute("ALTER TABLE satsdice.hash_checkw ADD COLUMN time INTEGER")
+    await db.execute(
+        "UPDATE satsdice.hash_checkw SET time = :now",
+        {"now": int(time.time())},
+    )
+    await db.execute(
+        _create_index(db, "satsdice_payment_time_idx", "satsdice_payment", "time")
+    )
+    await db.execute(
+        _create_index(
+            db,
+            "satsdice_withdraw_used_open_time_idx",
+            "satsdice_withdraw",
+            "used, open_time",
+        )
+    )
+    await db.execute(_create_index(db, "hash_checkw_time_idx", "hash_checkw", "time"))
+
+
+async def m010_add_rollups(db):
+    """
+    Creates the hourly per link rollup table and marks which settled bets
+    are already counted in it.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE satsdice.satsdice_rollup (
+            satsdice_pay TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            bets INTEGER NOT NULL DEFAULT 0,
+            volume {db.big_int} NOT NULL DEFAULT 0,
+            wins INTEGER NOT NULL DEFAULT 0,
+            payouts {db.big_int} NOT NULL DEFAULT 0,
+            biggest_win {db.big_int} NOT NULL DEFAULT 0,
+            PRIMARY KEY (satsdice_pay, hour)
+        );
+    """
+    )
+    await db.execute(
+        "ALTER TABLE satsdice.satsdice_payment "
+        "ADD COLUMN rolled_up BOOL NOT NULL DEFAULT FALSE"
+    )
+    await db.execute(
+        _create_index(
+            db,
+            "satsdice_payment_rollup_idx",
+            "satsdice_payment",
+            "time, payment_hash",
+            "NOT rolled_up",
+        )
+    )
+
+
+async def m011_add_payout_queue(db):
+    """
+    Adds the payout state of claimed withdraws, which are paid out in the
+    background instead of inside the LNURL-withdraw callback.
+    """
+    for table in ("satsdice_withdraw", "satsdice_withdraw_archive"):
+        for column in (
+            "payout_status TEXT",
+            "attempts INTEGER NOT NULL DEFAULT 0",
+            "error TEXT",
+        ):
+            await db.execute(f"ALTER TABLE satsdice.{table} ADD COLUMN {column}")
+    await db.execute("ALTER TABLE satsdice.satsdice_withdraw ADD COLUMN pr TEXT")
+    await db.execute(
+        "ALTER TABLE satsdice.satsdice_withdraw ADD COLUMN next_attempt INTEGER"
+    )
+    await db.execute(
+        _create_index(
+            db,
+            "satsdice_withdraw_payout_idx",
+            "satsdice_withdraw",
+            "payout_status, next_attempt",
+        )
+    )
+
+
+async def m012_add_payout_address(db):
+    """
+    Stores the Lightning address a bet's winnings are paid out to without
+    going through LNURL-withdraw.
+    """
+    for table in (
+        "satsdice_payment",
+        "satsdice_payment_archive",
+        "satsdice_withdraw",
+        "satsdice_withdraw_archive",
+    ):
+        await db.execute(f"ALTER TABLE satsdice.{table} ADD COLUMN payout_address TEXT")
+    await db.execute(
+        "ALTER TABLE satsdice.satsdice_withdraw_archive ADD COLUMN next_attempt INTEGER"
+    )
+
+
+async def m013_add_multi_roll(db):
+    """
+    Lets one payment fund several rolls, stored packed in the payment row.
+    """
+    await db.execute(
+        "ALTER TABLE satsdice.satsdice_pay ADD COLUMN rolls INTEGER NOT NULL DEFAULT 1"
+    )
+    for table in ("satsdice_payment", "satsdice_payment_archive"):
+        await db.execute(
+            f"ALTER TABLE satsdice.{table} ADD COLUMN rolls INTEGER NOT NULL DEFAULT 1"
+        )
+        await db.execute(f"ALTER TABLE satsdice.{table} ADD COLUMN results TEXT")
+
+
+async def m014_add_rate_limits(db):
+    """
+    Adds the per link and per client limits on handed out invoices.
+    """
+    for column in ("rate_limit", "client_rate_limit"):
+        await db.execute(
+            f"ALTER TABLE satsdice.satsdice_pay "
+            f"ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0"
+        )
+
+
+async def m015_add_archive_export_index(db):
+    """
+    Indexes archived bets by link and time, for exporting a link's history.
+    """
+    await db.execute(
+        _create_index(
+            db,
+            "satsdice_payment_archive_satsdice_pay_time_idx",
+            "satsdice_payment_archive",
+            "satsdice_pay, time, payment_hash",
+        )
+    )
+
+
+async def m016_add_invoice_pool(db):
+    """
+    Adds the size of a link's pool of ready made invoices.
+    """
+    await db.execute(
+        "ALTER TABLE satsdice.satsdice_pay "
+        "ADD COLUMN pool_size INTEGER NOT NULL DEFAULT 0"
+    )
+    await db.execute(
+        _create_index(
+            db, "satsdice_pay_pool_idx", "satsdice_pay", "pool_size", "pool_size > 0"
+        )
+    )
+
+
+async def m017_add_rollup_volume_sq(db):
+    """
+    Adds the sum of squared stakes to the rollups, which the confidence
+    interval of a link's return to player needs. Existing rollups get the
+    value they would have if all stakes in the hour were equal.
+    """
+    await db.execute(
+        "ALTER TABLE satsdice.satsdice_rollup "
+        "ADD COLUMN volume_sq FLOAT NOT NULL DEFAULT 0"
+    )
+    await db.execute(
+        """
+        UPDATE satsdice.satsdice_rollup
+        SET volume_sq = CAST(volume AS FLOAT) * volume / bets
+        WHERE bets > 0
+        """
+    )
+    await db.execute(
+        _create_index(
+            db,
+            "satsdice_withdraw_satsdice_pay_used_idx",
+            "satsdice_withdraw",
+            "satsdice_pay, used, value",
+        )
+    )
+
+
+async def m018_add_pending_payment_index(db):
+    """
+    Indexes unresolved bets by time, for sweeping the ones whose paid
+    invoice was missed before retention removes them as unpaid.
+    """
+    await db.execute(
+        _create_index(
+            db,
+            "satsdice_payment_pending_idx",
+            "satsdice_payment",
+            "time, payment_hash",
+            "NOT paid AND NOT lost",
+        )
+    )
+
+
+async def m019_add_withdraw_history_index(db):
+    """
+    Indexes withdraws by link, claim state and time, so a link's claimed or
+    unclaimed withdraws are paged in order without sorting.
+    """
+    await db.execute(
+        _create_index(
+            db,
+            "satsdice_withdraw_satsdice_pay_used_open_time_idx",
+            "satsdice_withdraw",
+            "satsdice_pay, used, open_time, id",
+        )
+    )
+
+
+async def m020_publish_seed_chains(db):
+    """
+    Publishes a seed chain for every link that has none with seeds left,
+    so no bet is rolled from a chain created after it was paid.
+    """
+    result = await db.execute(
+        """
+        SELECT id FROM satsdice.satsdice_pay l
+        WHERE NOT EXISTS (
+            SELECT 1 FROM satsdice.satsdice_seed_chain c
+            WHERE c.satsdice_pay = l.id AND c.used < c.length
+        )
+        """
+    )
+    for row in result.mappings().all():
+        root = new_root()
+        await db.execute(
+            """
+            INSERT INTO satsdice.satsdice_seed_chain
+                (id, satsdice_pay, root, commitment, length, used, created_at)
+            VALUES (:id, :link_id, :root, :commitment, :length, 0, :now)
+            """,
+            {
+                "id": urlsafe_short_hash(),
+                "link_id": row["id"],
+                "root": root,
+                "commitment": chain_commitment(root, SEED_CHAIN_LENGTH),
+                "length": SEED_CHAIN_LENGTH,
+                "now": int(time.time()),
+            },
+        )
+
+
+async def m021_date_untimed_payments(db):
+    """
+    Gives the bets that m007 dated 0 the open time of their withdraw, or the
+    time of this migration, so retention no longer takes them for ancient.
+    Rollups they were already counted in stay as they are.
+    """
+    for table in ("satsdice_payment", "satsdice_payment_archive"):
+        await db.execute(
+            f"""
+            UPDATE satsdice.{table} SET time = COALESCE(
+                (
+                    SELECT open_time FROM satsdice.satsdice_withdraw w
+                    WHERE w.id = {table}.payment_hash
+                ),
+                (
+                    SELECT open_time FROM satsdice.satsdice_withdraw_archive w
+                    WHERE w.id = {table}.payment_hash
+                ),
+                :now
+            )
+            WHERE time = 0 OR time IS NULL
+            """,
+            {"now": int(time.time())},
+        )
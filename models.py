@@ -1,7 +1,11 @@
+import math
 from datetime import datetime, timezone
+from enum import Enum
 
 from fastapi import Query
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, root_validator
+
+from .fair import win_probability
 
 
 class SatsdiceLink(BaseModel):
@@ -18,6 +22,13 @@ class SatsdiceLink(BaseModel):
     served_meta: int = 0
     served_pr: int = 0
     disposable: bool = True
+    # rolls funded by one payment, bets are per roll
+    rolls: int = 1
+    # invoices per minute for the whole link and for each client, 0 is no limit
+    rate_limit: int = 0
+    client_rate_limit: int = 0
+    # unpaid invoices kept ready for each popular amount, 0 disables the pool
+    pool_size: int = 0
     # TODO: Change to datetime
     open_time: int = int(datetime.now(timezone.utc).timestamp())
 
@@ -28,6 +39,195 @@ class SatsdicePayment(BaseModel):
     value: int
     paid: bool = False
     lost: bool = False
+    time: int = Field(
+        default_factory=lambda: int(datetime.now(timezone.utc).timestamp())
+    )
+    chain: str | None = None
+    seed_index: int | None = None
+    roll: int | None = None
+    payout_address: str | None = None
+    rolls: int = 1
+    # every roll of a multi-roll bet, see `fair.pack_rolls`
+    results: str | None = None
+
+
+class SatsdiceSeedChain(BaseModel):
+    id: str
+    satsdice_pay: str
+    root: str
+    commitment: str
+    length: int
+    used: int = 0
+    created_at: int = Field(
+        default_factory=lambda: int(datetime.now(timezone.utc).timestamp())
+    )
+
+
+class SatsdiceCommitment(BaseModel):
+    id: str
+    commitment: str
+    length: int
+    used: int
+    created_at: int
+    # only revealed once every seed of the chain has been used
+    root: str | None = None
+
+
+class SatsdiceRollCheck(BaseModel):
+    payment_hash: str
+    chain: str
+    seed_index: int
+    seed: str
+    roll: int
+    won: bool
+    valid: bool
+
+
+class SatsdiceRoll(BaseModel):
+    index: int
+    roll: int
+    won: bool
+
+
+class SatsdiceRollup(BaseModel):
+    satsdice_pay: str
+    hour: int
+    bets: int = 0
+    volume: int = 0
+    # sum of stake^2 / rolls, for the variance of the return to player
+    volume_sq: float = 0
+    wins: int = 0
+    payouts: int = 0
+    biggest_win: int = 0
+
+
+class SatsdiceStats(BaseModel):
+    satsdice_pay: str
+    bets: int
+    volume: int
+    wins: int
+    payouts: int
+    biggest_win: int
+    win_rate: float = 0
+    # realized return to player, paid out sats per sat bet
+    rtp: float = 0
+
+    @root_validator(skip_on_failure=True)
+    def compute_rates(cls, values):
+        if values["bets"]:
+            values["win_rate"] = values["wins"] / values["bets"]
+        if values["volume"]:
+            values["rtp"] = values["payouts"] / values["volume"]
+        return values
+
+
+class StatsOrder(str, Enum):
+    volume = "volume"
+    bets = "bets"
+    biggest_win = "biggest_win"
+    rtp = "rtp"
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+# two-sided 95% normal quantile
+RTP_CONFIDENCE_Z = 1.96
+
+
+class SatsdiceAnalytics(BaseModel):
+    satsdice_pay: str
+    chance: float
+    multiplier: float
+    bets: int
+    volume: int
+    volume_sq: float = Field(0, exclude=True)
+    wins: int
+    payouts: int
+    # winnings that can still be claimed, regardless of the time window
+    liability: int
+    theoretical_rtp: float = 0
+    rtp: float = 0
+    rtp_low: float = 0
+    rtp_high: float = 0
+
+    @root_validator(skip_on_failure=True)
+    def compute_rtp(cls, values):
+        values["theoretical_rtp"] = (
+            win_probability(values["chance"]) * values["multiplier"]
+        )
+        if values["volume"]:
+            # every roll pays stake * multiplier with the observed win rate,
+            # smoothed so a window without wins still gets an interval
+            rtp = values["payouts"] / values["volume"]
+            p = (values["wins"] + 2) / (values["bets"] + 4)
+            spread = (
+                RTP_CONFIDENCE_Z
+                * values["multiplier"]
+                * math.sqrt(p * (1 - p) * values["volume_sq"])
+                / values["volume"]
+            )
+            values["rtp"] = rtp
+            values["rtp_low"] = max(0, rtp - spread)
+            values["rtp_high"] = rtp + spread
+        return values
+
+
+class PayoutStatus(str, Enum):
+    queued = "queued"
+    paying = "paying"
+    paid = "paid"
+    failed = "failed"
+
+
+class SatsdiceClaim(BaseModel):
+    id: str
+    satsdice_pay: str
+    value: int
+    wallet: str
+
+
+class SatsdicePayout(BaseModel):
+    id: str
+    unique_hash: str
+    value: int
+    wallet: str
+    # None until the invoice for `payout_address` has been fetched
+    pr: str | None
+    attempts: int
+    payout_address: str | None = None
+
+
+class SatsdicePayoutState(BaseModel):
+    status: PayoutStatus | None
+    value: int
+    attempts: int
+    error: str | None
+
+
+class SatsdiceBet(BaseModel):
+    payment_hash: str
+    satsdice_pay: str
+    value: int
+    paid: bool = False
+    lost: bool = False
+    chance: float
+    multiplier: float
+    unique_hash: str | None = None
+    winnings: int | None = None
+    used: int | None = None
+    time: int = 0
+    roll: int | None = None
+    payout_status: PayoutStatus | None = None
+    payout_address: str | None = None
+    rolls: int = 1
+    results: str | None = None
+
+    @property
+    def pending(self) -> bool:
+        return not self.lost and not self.unique_hash
 
 
 class SatsdiceWithdraw(BaseModel):
@@ -38,15 +238,48 @@ class SatsdiceWithdraw(BaseModel):
     k1: str
     open_time: int
     used: int
+    payout_status: PayoutStatus | None = None
+    attempts: int = 0
+    error: str | None = None
+    next_attempt: int | None = None
+    payout_address: str | None = None
 
     @property
     def is_spent(self) -> bool:
         return self.used >= 1
 
 
+class BetStatus(str, Enum):
+    won = "won"
+    lost = "lost"
+    unclaimed = "unclaimed"
+    pending = "pending"
+
+
+class WithdrawStatus(str, Enum):
+    claimed = "claimed"
+    unclaimed = "unclaimed"
+
+
+class SatsdiceBetPage(BaseModel):
+    data: list[SatsdiceBet]
+    next_cursor: str | None = None
+
+
+class SatsdiceWithdrawPage(BaseModel):
+    data: list[SatsdiceWithdraw]
+    next_cursor: str | None = None
+
+
 class HashCheck(BaseModel):
     id: str
     lnurl_id: str
+    time: int | None = None
+
+
+class RetentionReport(BaseModel):
+    rows: dict[str, int]
+    seconds: float
 
 
 class CreateSatsDiceLink(BaseModel):
@@ -59,12 +292,74 @@ class CreateSatsDiceLink(BaseModel):
     chance: float = Query(0)
     haircut: float = Query(0)
     disposable: bool = Query(True)
+    rolls: int = Query(1, ge=1, le=1000)
+    rate_limit: int = Query(0, ge=0)
+    client_rate_limit: int = Query(0, ge=0)
+    pool_size: int = Query(0, ge=0, le=100)
+
+
+class UpdateSatsDiceLink(CreateSatsDiceLink):
+    id: str
+
+
+class CreateSatsDiceLinks(BaseModel):
+    links: list[CreateSatsDiceLink] = Field(..., min_items=1, max_items=1000)
+
+
+class UpdateSatsDiceLinks(BaseModel):
+    links: list[UpdateSatsDiceLink] = Field(..., min_items=1, max_items=1000)
+
+
+class DeleteSatsDiceLinks(BaseModel):
+    ids: list[str] = Field(..., min_items=1, max_items=1000)
+
+
+class SatsdiceBulkResult(BaseModel):
+    id: str | None = None
+    ok: bool = True
+    detail: str | None = None
+    link: SatsdiceLink | None = None
 
 
 class CreateSatsDicePayment(BaseModel):
     satsdice_pay: str = Query(None)
     value: int = Query(0)
     payment_hash: str = Query(None)
+    chain: str | None = Query(None)
+    seed_index: int | None = Query(None)
+    payout_address: str | None = Query(None)
+    rolls: int = Query(1)
+
+
+class VerifySatsdiceRolls(BaseModel):
+    payment_hashes: list[str] = Field(..., min_items=1, max_items=10_000)
+
+
+class SimulateSatsdiceLink(BaseModel):
+    chance: float = Field(..., gt=0, lt=100)
+    multiplier: float = Field(..., gt=1)
+    haircut: float = 0
+    min_bet: int = Field(..., ge=1)
+    max_bet: int = Field(..., ge=1)
+    bankroll: int = Field(..., ge=0)
+    bets: int = Field(1_000_000, ge=1, le=10_000_000)
+    paths: int = Field(1000, ge=1, le=100_000)
+    seed: int | None = None
+
+
+class SatsdiceSimulation(BaseModel):
+    bets: int
+    # house profit per sat bet, simulated and exact
+    house_edge: float
+    expected_edge: float
+    # edge the link's haircut is meant to give the house
+    haircut_edge: float
+    profit: int
+    variance: float
+    drawdown_p50: float
+    drawdown_p95: float
+    drawdown_p99: float
+    ruin_probability: float
 
 
 class CreateSatsDiceWithdraw(BaseModel):
@@ -72,6 +367,8 @@ class CreateSatsDiceWithdraw(BaseModel):
     satsdice_pay: str = Query(None)
     value: int = Query(0)
     used: int = Query(0)
+    # pay the winnings to this Lightning address right away
+    payout_address: str | None = Query(None)
 
 
 class CreateSatsDiceWithdraws(BaseModel):
@@ -0,0 +1,194 @@
+import asyncio
+import ipaddress
+import socket
+from collections import defaultdict
+from datetime import datetime
+
+from lnbits.core.services import pay_invoice
+from lnbits.exceptions import PaymentError
+from lnurl import LnAddress, LnurlPayResponse, execute_pay_request, handle
+from loguru import logger
+
+from .crud import (
+    fail_satsdice_payout,
+    finish_satsdice_payout,
+    requeue_satsdice_payouts,
+    retry_satsdice_payout,
+    set_satsdice_payout_invoice,
+    take_satsdice_payouts,
+)
+from .events import bet_events
+from .exposure import house_exposure
+from .metrics import metrics
+from .models import SatsdicePayout
+from .settings import satsdice_settings
+
+
+class LnurlPayResolver:
+    """
+    Fetches an invoice from a Lightning address over LNURL-pay. Players
+    choose the address, so only hosts on the public internet are asked,
+    and never for longer than `payout_address_timeout` seconds.
+    """
+
+    async def invoice(self, address: str, amount_msat: int) -> str:
+        timeout = satsdice_settings.payout_address_timeout
+        return await asyncio.wait_for(self._invoice(address, amount_msat), timeout)
+
+    async def _invoice(self, address: str, amount_msat: int) -> str:
+        timeout = satsdice_settings.payout_address_timeout
+        await self._check_host(LnAddress(address).url.host)
+        response = await handle(address, timeout=timeout)
+        if not isinstance(response, LnurlPayResponse):
+            raise ValueError(f"{address} is not an LNURL-pay address.")
+        await self._check_host(response.callback.host)
+        action = await execute_pay_request(response, amount_msat, timeout=timeout)
+        return str(action.pr)
+
+    @staticmethod
+    async def _check_host(host: str | None) -> None:
+        if not host:
+            raise ValueError("The address has no host.")
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            host, None, proto=socket.IPPROTO_TCP
+        )
+        for info in infos:
+            ip = ipaddress.ip_address(info[4][0])
+            if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+                ip = ip.ipv4_mapped
+            if not ip.is_global:
+                raise ValueError(f"{host} is not a public host.")
+
+
+class PayoutQueue:
+    """
+    Pays claimed withdraws in the background. The queue lives in the
+    withdraw table, so payouts survive a restart, and every house wallet
+    has at most `payout_concurrency` payments in flight at once.
+    """
+
+    def __init__(self, resolver: LnurlPayResolver | None = None) -> None:
+        self.resolver = resolver or LnurlPayResolver()
+        self._wakeup = asyncio.Event()
+        self._wallets: defaultdict[str, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(satsdice_settings.payout_concurrency)
+        )
+        self._in_flight: set[asyncio.Task] = set()
+
+    def notify(self) -> None:
+        """Look for due payouts right away instead of at the next poll."""
+        self._wakeup.set()
+
+    async def run(self) -> None:
+        await requeue_satsdice_payouts()
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.dispatch()
+            except Exception as exc:
+                logger.warning(f"satsdice: taking payouts failed: {exc}")
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), satsdice_settings.payout_poll_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def dispatch(self) -> int:
+        """Start paying the due payouts there is room for."""
+        room = satsdice_settings.payout_batch_size - len(self._in_flight)
+        if room <= 0:
+            return 0
+        payouts = await take_satsdice_payouts(int(datetime.now().timestamp()), room)
+        for payout in payouts:
+            task = asyncio.create_task(self._pay(payout))
+            self._in_flight.add(task)
+            task.add_done_callback(self._done)
+        return len(payouts)
+
+    async def drain(self) -> None:
+        """Pay until nothing is due anymore, e.g. in tests."""
+        while await self.dispatch() or self._in_flight:
+            await asyncio.gather(*self._in_flight)
+
+    def _done(self, task: asyncio.Task) -> None:
+        self._in_flight.discard(task)
+        if not task.cancelled() and task.exception():
+            # the payout stays marked as paying until the next restart
+            logger.warning(f"satsdice: payout bookkeeping failed: {task.exception()}")
+        self.notify()
+
+    async def _pay(self, payout: SatsdicePayout) -> None:
+        if payout.pr is None:
+            try:
+                payout.pr = await self.resolver.invoice(
+                    payout.payout_address or "", payout.value * 1000
+                )
+            except Exception as exc:
+                await self._retry(payout, f"{payout.payout_address}: {exc}")
+                return
+            await set_satsdice_payout_invoice(payout.id, payout.pr)
+
+        async with self._wallets[payout.wallet]:
+            try:
+                with metrics.timer(
+                    "satsdice_backend_wait_seconds", (("call", "pay_invoice"),)
+                ):
+                    payment = await pay_invoice(
+                        wallet_id=payout.wallet,
+                        payment_request=payout.pr,
+                        max_sat=payout.value,
+                    )
+            except PaymentError as exc:
+                if exc.status == "success":
+                    # a retry of a payout that already went through
+                    await self._paid(payout)
+                else:
+                    # pending payments may still succeed, never undo their claim
+                    await self._retry(payout, exc.message, exc.status != "pending")
+            except Exception as exc:
+                await self._retry(payout, str(exc))
+            else:
+                if payment and payment.pending:
+                    # paying again reports how the pending payment ended
+                    await self._retry(payout, "Payment is still pending.", False)
+                else:
+                    await self._paid(payout)
+
+    async def _paid(self, payout: SatsdicePayout) -> None:
+        if await finish_satsdice_payout(payout.id):
+            # owed until it is paid, the claim alone does not cover it
+            house_exposure.add(payout.wallet, -payout.value)
+        metrics.inc("satsdice_payouts_total", (("result", "paid"),))
+        # withdraws are keyed by the payment hash of the bet they pay out
+        bet_events.publish(payout.id, "claimed", {"winnings": payout.value})
+
+    async def _retry(
+        self, payout: SatsdicePayout, error: str, give_up: bool = True
+    ) -> None:
+        settings = satsdice_settings
+        attempts = payout.attempts + 1
+        if give_up and attempts >= settings.payout_max_attempts:
+            await fail_satsdice_payout(payout.id, error)
+            metrics.inc("satsdice_payouts_total", (("result", "failed"),))
+            # the winnings can be withdrawn with LNURL-withdraw again
+            bet_events.publish(payout.id, "released", {"error": error})
+            logger.warning(
+                f"satsdice: gave up on payout {payout.id} after {attempts} "
+                f"attempts: {error}"
+            )
+            return
+        delay = min(
+            settings.payout_retry_backoff * 2 ** (attempts - 1),
+            settings.payout_max_backoff,
+        )
+        next_attempt = int(datetime.now().timestamp() + delay)
+        await retry_satsdice_payout(payout.id, next_attempt, error)
+        metrics.inc("satsdice_payouts_total", (("result", "retried"),))
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+
+payout_queue = PayoutQueue()
+metrics.gauge("satsdice_payouts_in_flight", lambda: {(): len(payout_queue)})
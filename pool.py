@@ -0,0 +1,149 @@
+import asyncio
+from collections import defaultdict, deque
+from time import time
+from typing import NamedTuple
+
+from lnbits.core.services import create_invoice
+from loguru import logger
+
+from .crud import get_satsdice_pooled_pays
+from .helpers import bet_invoice, lnurlp_metadata
+from .metrics import metrics
+from .models import SatsdiceLink
+from .settings import satsdice_settings
+
+
+class PooledInvoice(NamedTuple):
+    payment_hash: str
+    bolt11: str
+    description_hash: bytes
+    expires_at: float
+
+
+def pool_amounts(link: SatsdiceLink) -> list[int]:
+    """
+    The amounts in sats that are pooled for a link: its smallest and
+    largest bet and every power of ten in between.
+    """
+    low, high = link.min_bet * link.rolls, link.max_bet * link.rolls
+    amounts = {low, high}
+    power = 1
+    while power < high:
+        if power > low:
+            amounts.add(power)
+        power *= 10
+    return sorted(amount for amount in amounts if amount > 0)
+
+
+class InvoicePool:
+    """
+    Unpaid invoices made ahead of time for the popular amounts of links
+    with a `pool_size`. Each invoice is handed out once, and retired well
+    before it expires or once the link's metadata changed. The pool lives
+    in memory only, invoices lost on a restart are simply never paid.
+    """
+
+    def __init__(self) -> None:
+        self._invoices: defaultdict[tuple[str, int], deque[PooledInvoice]] = (
+            defaultdict(deque)
+        )
+        self._wakeup = asyncio.Event()
+
+    def take(self, link: SatsdiceLink, amount_msat: int) -> PooledInvoice | None:
+        """A pooled invoice for `amount_msat`, or None to make one on demand."""
+        if not link.pool_size:
+            return None
+        invoices = self._invoices.get((link.id, amount_msat // 1000))
+        if amount_msat % 1000 == 0 and invoices:
+            description_hash = lnurlp_metadata(link).description_hash
+            while invoices:
+                invoice = invoices.popleft()
+                if self._usable(invoice, description_hash):
+                    metrics.inc("satsdice_invoice_pool_total", (("result", "hit"),))
+                    self.notify()
+                    return invoice
+                metrics.inc("satsdice_invoice_pool_total", (("result", "retired"),))
+        metrics.inc("satsdice_invoice_pool_total", (("result", "miss"),))
+        return None
+
+    def notify(self) -> None:
+        """Refill right away instead of at the next interval."""
+        self._wakeup.set()
+
+    async def run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.refill()
+            except Exception as exc:
+                logger.warning(f"satsdice: refilling the invoice pool failed: {exc}")
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), satsdice_settings.invoice_pool_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def refill(self) -> int:
+        """
+        Retire stale invoices and top every pooled amount up to its link's
+        `pool_size`. Returns the number of invoices made.
+        """
+        created = 0
+        pooled: set[tuple[str, int]] = set()
+        for link in await get_satsdice_pooled_pays():
+            description_hash = lnurlp_metadata(link).description_hash
+            for amount in pool_amounts(link):
+                key = (link.id, amount)
+                pooled.add(key)
+                self._retire(key, description_hash)
+                try:
+                    while len(self._invoices[key]) < link.pool_size:
+                        self._invoices[key].append(await self._create(link, amount))
+                        created += 1
+                except Exception as exc:
+                    logger.warning(f"satsdice: pooling invoices of {link.id}: {exc}")
+                    break
+        # links that were deleted or stopped pooling
+        for key in set(self._invoices) - pooled:
+            del self._invoices[key]
+        return created
+
+    async def _create(self, link: SatsdiceLink, amount: int) -> PooledInvoice:
+        expiry = satsdice_settings.invoice_pool_expiry
+        with metrics.timer(
+            "satsdice_backend_wait_seconds", (("call", "create_invoice"),)
+        ):
+            payment = await create_invoice(**bet_invoice(link, amount), expiry=expiry)
+        metrics.inc("satsdice_invoice_pool_total", (("result", "created"),))
+        return PooledInvoice(
+            payment.payment_hash,
+            payment.bolt11,
+            lnurlp_metadata(link).description_hash,
+            time() + expiry,
+        )
+
+    def _retire(self, key: tuple[str, int], description_hash: bytes) -> None:
+        invoices = self._invoices[key]
+        usable = [i for i in invoices if self._usable(i, description_hash)]
+        retired = len(invoices) - len(usable)
+        if retired:
+            self._invoices[key] = deque(usable)
+            metrics.inc(
+                "satsdice_invoice_pool_total", (("result", "retired"),), retired
+            )
+
+    @staticmethod
+    def _usable(invoice: PooledInvoice, description_hash: bytes) -> bool:
+        # a changed title or odds changes the metadata the invoice commits to
+        return (
+            invoice.description_hash == description_hash
+            and invoice.expires_at - satsdice_settings.invoice_pool_margin > time()
+        )
+
+    def __len__(self) -> int:
+        return sum(len(invoices) for invoices in self._invoices.values())
+
+
+invoice_pool = InvoicePool()
+metrics.gauge("satsdice_invoice_pool_size", lambda: {(): len(invoice_pool)})
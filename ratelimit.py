@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Any
+
+from .metrics import metrics
+from .models import SatsdiceLink
+
+
+class TokenBuckets:
+    """
+    In-process token buckets, one per key. A bucket holds up to `capacity`
+    tokens and refills at `rate` tokens per second, every admitted request
+    takes one. Like `LRUCache` the buckets are bounded, the least recently
+    used bucket is dropped first and starts out full if it comes back.
+    """
+
+    def __init__(self, maxsize: int = 10_000) -> None:
+        self.maxsize = maxsize
+        self._buckets: OrderedDict[Any, tuple[float, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def take(self, key: Any, rate: float, capacity: float) -> bool:
+        """Take a token from the bucket of `key`, False if it is empty."""
+        now = monotonic()
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        admitted = tokens >= 1
+        self._buckets[key] = (tokens - 1 if admitted else tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return admitted
+
+    def clear(self) -> None:
+        self._buckets.clear()
+
+
+# invoices handed out by the LNURL-pay callback, see `SatsdiceLink.rate_limit`
+invoice_limits = TokenBuckets()
+
+
+def admits_invoice(link: SatsdiceLink, client: str) -> bool:
+    """
+    Whether `client` may get another invoice from `link`. The client is
+    checked first so one client over its limit does not drain the link.
+    """
+    for scope, key, limit in (
+        ("client", (link.id, client), link.client_rate_limit),
+        ("link", link.id, link.rate_limit),
+    ):
+        # limits are per minute and a full minute may be used at once
+        if limit and not invoice_limits.take((scope, key), limit / 60, limit):
+            metrics.inc("satsdice_rate_limited_total", (("scope", scope),))
+            return False
+    return True
+
+
+metrics.gauge("satsdice_rate_limit_buckets", lambda: {(): len(invoice_limits)})
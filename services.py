@@ -0,0 +1,314 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from lnbits.core.crud import get_standalone_payment
+from lnbits.core.services import check_payment_status
+from loguru import logger
+
+from .cache import LRUCache
+from .counters import link_counters
+from .crud import (
+    backfill_satsdice_rollups,
+    create_satsdice_withdraw,
+    delete_withdraw_hash_checks,
+    expire_satsdice_payments,
+    expire_satsdice_withdraws,
+    get_pending_satsdice_payments,
+    get_satsdice_pay,
+    get_satsdice_payment,
+    get_satsdice_payments_by_hash,
+    get_satsdice_seed_chain,
+    get_satsdice_seed_chains,
+    reserve_satsdice_seed,
+    rollup_hour,
+    settle_satsdice_payment,
+)
+from .events import bet_events
+from .exposure import house_exposure
+from .fair import SeedChain, pack_rolls, rolls, unpack_rolls, wins
+from .metrics import metrics
+from .models import (
+    CreateSatsDiceWithdraw,
+    RetentionReport,
+    SatsdicePayment,
+    SatsdiceRollCheck,
+    SatsdiceRollup,
+)
+from .payouts import payout_queue
+from .settings import satsdice_settings
+
+# seed chains never change, only their roots are needed to roll
+seed_chain_cache = LRUCache(maxsize=256, ttl=3600)
+
+
+async def get_seed_chain(chain_id: str) -> SeedChain | None:
+    chain = seed_chain_cache.get(chain_id)
+    if chain is None:
+        row = await get_satsdice_seed_chain(chain_id)
+        if not row:
+            return None
+        chain = SeedChain(row.root, row.length)
+        seed_chain_cache.set(chain_id, chain)
+    return chain
+
+
+async def resolve_satsdice_bet(payment_hash: str) -> SatsdicePayment | None:
+    """
+    Roll the dice for a paid bet, mark it won or lost and create the
+    withdraw for the winnings. Bets are only ever resolved once.
+    """
+    payment = await get_satsdice_payment(payment_hash)
+    if not payment or payment.paid or payment.lost:
+        return payment
+    link = await get_satsdice_pay(payment.satsdice_pay)
+    if not link:
+        return payment
+    bet_events.publish(payment_hash, "paid", {"value": payment.value})
+
+    # Seeds are handed out in settle order, never when the invoice is made.
+    # Otherwise the seed of a later bet, once revealed, would hash to the
+    # seed of an earlier bet whose invoice is still unpaid, and its owner
+    # could pay only if it wins. A seed reserved before this rule existed
+    # is replaced for the same reason.
+    seed = await reserve_satsdice_seed(link.id)
+    if not seed:
+        # the chain published just now may only roll bets paid after it
+        logger.warning(f"satsdice: no published seed left for bet {payment_hash}")
+        return payment
+    payment.chain, payment.seed_index = seed
+    chain = await get_seed_chain(payment.chain)
+    if not chain:
+        return payment
+
+    # all rolls of a multi-roll bet are resolved in one pass
+    results = [
+        (value, wins(value, link.chance))
+        for value in rolls(chain.seed(payment.seed_index), payment_hash, payment.rolls)
+    ]
+    won_rolls = sum(won for _, won in results)
+    payment.roll = results[0][0]
+    if payment.rolls > 1:
+        payment.results = pack_rolls(results)
+    won = won_rolls > 0
+    payment.paid = won
+    payment.lost = not won
+    # every roll stakes an equal share of the payment, one withdraw pays all
+    winnings = int(payment.value * link.multiplier * won_rolls / payment.rolls)
+    rollup = SatsdiceRollup(
+        satsdice_pay=link.id,
+        hour=rollup_hour(payment.time),
+        bets=payment.rolls,
+        volume=payment.value,
+        volume_sq=payment.value**2 / payment.rolls,
+        wins=won_rolls,
+        payouts=winnings,
+        biggest_win=winnings,
+    )
+    if not await settle_satsdice_payment(payment, rollup):
+        return await get_satsdice_payment(payment_hash)
+    link_counters.add(link.id, amount=payment.value)
+
+    outcome = {"value": payment.value, "roll": payment.roll}
+    if payment.rolls > 1:
+        outcome.update(rolls=payment.rolls, wins=won_rolls)
+    if won:
+        data = CreateSatsDiceWithdraw(
+            satsdice_pay=link.id,
+            value=winnings,
+            payment_hash=payment_hash,
+            used=0,
+            payout_address=payment.payout_address,
+        )
+        withdraw = await create_satsdice_withdraw(data)
+        outcome["winnings"] = withdraw.value
+        data_won = {**outcome, "unique_hash": withdraw.unique_hash}
+        # owed until the payout is paid, also when it is claimed on creation
+        house_exposure.add(link.wallet, withdraw.value)
+        if withdraw.payout_address:
+            data_won["payout_address"] = withdraw.payout_address
+            payout_queue.notify()
+        bet_events.publish(payment_hash, "won", data_won)
+    else:
+        bet_events.publish(payment_hash, "lost", outcome)
+    # the link channel is public, it must not leak payment or withdraw hashes
+    bet_events.publish(f"link:{link.id}", "won" if won else "lost", outcome)
+    return payment
+
+
+async def invoice_paid(payment_hash: str, check_backend: bool = False) -> bool:
+    """
+    Whether the invoice of a bet is paid according to lnbits core, for
+    bets whose paid invoice the listener missed. With `check_backend` an
+    invoice core still has as pending is looked up at the funding source.
+    """
+    core_payment = await get_standalone_payment(payment_hash, incoming=True)
+    if not core_payment:
+        return False
+    if core_payment.success:
+        return True
+    if not check_backend or not core_payment.pending:
+        return False
+    status = await check_payment_status(core_payment)
+    return status.success
+
+
+async def sweep_pending_bets(before: int, batch_size: int = 500) -> int:
+    """
+    Resolve the bets placed before `before` that are still pending although
+    their invoice was paid. Returns the number of bets resolved.
+    """
+    resolved = 0
+    cursor = None
+    while payments := await get_pending_satsdice_payments(before, cursor, batch_size):
+        for payment in payments:
+            try:
+                paid = await invoice_paid(payment.payment_hash, check_backend=True)
+            except Exception as exc:
+                logger.warning(
+                    f"satsdice: checking the invoice of {payment.payment_hash}: {exc}"
+                )
+                continue
+            if paid:
+                await resolve_satsdice_bet(payment.payment_hash)
+                resolved += 1
+        if len(payments) < batch_size:
+            break
+        cursor = (payments[-1].time, payments[-1].payment_hash)
+    if resolved:
+        logger.warning(f"satsdice: resolved {resolved} bets the listener missed")
+    return resolved
+
+
+async def verify_satsdice_rolls(
+    link_id: str, payment_hashes: list[str]
+) -> list[SatsdiceRollCheck]:
+    """
+    Recompute the rolls of settled bets. Each seed chain involved is walked
+    once for all of its bets, also checking that it ends in its commitment.
+    """
+    payments = await get_satsdice_payments_by_hash(link_id, payment_hashes)
+    # (payment, seed index, roll) of every settled bet, per chain
+    by_chain: defaultdict[str, list[tuple[SatsdicePayment, int, int]]] = defaultdict(
+        list
+    )
+    for payment in payments:
+        if payment.chain and payment.seed_index and payment.roll is not None:
+            by_chain[payment.chain].append((payment, payment.seed_index, payment.roll))
+
+    checks = []
+    for row in await get_satsdice_seed_chains(link_id):
+        if row.id not in by_chain:
+            continue
+        chain = SeedChain(row.root, row.length)
+        seeds, commitment = chain.seeds(index for _, index, _ in by_chain[row.id])
+        committed = commitment.hex() == row.commitment
+        for payment, seed_index, roll in by_chain[row.id]:
+            seed = seeds[seed_index]
+            stored = [roll]
+            if payment.results:
+                stored = [value for value, _ in unpack_rolls(payment.results)]
+            checks.append(
+                SatsdiceRollCheck(
+                    payment_hash=payment.payment_hash,
+                    chain=row.id,
+                    seed_index=seed_index,
+                    seed=seed.hex(),
+                    roll=roll,
+                    won=payment.paid,
+                    valid=committed
+                    and seed_index <= row.used
+                    and rolls(seed, payment.payment_hash, payment.rolls) == stored,
+                )
+            )
+    return checks
+
+
+def days_ago(days: int) -> int:
+    return int((datetime.now() - timedelta(days=days)).timestamp())
+
+
+def withdraw_opened_after() -> int:
+    """Withdraws opened before this time have expired."""
+    days = satsdice_settings.withdraw_expiry_days
+    return days_ago(days) if days else 0
+
+
+async def backfill_rollups(batch_size: int = 500) -> int:
+    """
+    Count every settled bet that is not in the rollups yet, batch by batch.
+    Bets settled by this version are counted right away, so this only has
+    work after an upgrade.
+    """
+    total = 0
+    while (batch := await backfill_satsdice_rollups(batch_size)) > 0:
+        total += batch
+        if batch < batch_size:
+            break
+    if total:
+        logger.info(f"satsdice: backfilled {total} bets into the rollups")
+    return total
+
+
+async def run_satsdice_retention() -> RetentionReport:
+    """
+    Remove expired rows batch by batch, so the database is never locked
+    for longer than one batch takes.
+    """
+    settings = satsdice_settings
+    batch_size = settings.retention_batch_size
+    archive = settings.retention_archive
+    rules = {
+        "lost_payments": (
+            settings.lost_payment_days,
+            lambda before: expire_satsdice_payments(
+                before, lost=True, archive=archive, batch_size=batch_size
+            ),
+        ),
+        "unpaid_payments": (
+            settings.unpaid_payment_days,
+            lambda before: expire_satsdice_payments(
+                before, lost=False, archive=False, batch_size=batch_size
+            ),
+        ),
+        "claimed_withdraws": (
+            settings.claimed_withdraw_days,
+            lambda before: expire_satsdice_withdraws(
+                before, claimed=True, archive=archive, batch_size=batch_size
+            ),
+        ),
+        "expired_withdraws": (
+            settings.withdraw_expiry_days,
+            lambda before: expire_satsdice_withdraws(
+                before, claimed=False, archive=archive, batch_size=batch_size
+            ),
+        ),
+        "hash_checks": (
+            settings.hash_check_days,
+            lambda before: delete_withdraw_hash_checks(before, batch_size),
+        ),
+    }
+
+    start = perf_counter()
+    if settings.unpaid_payment_days:
+        # a paid bet the listener missed must not be removed as unpaid
+        await sweep_pending_bets(days_ago(settings.unpaid_payment_days), batch_size)
+    report = RetentionReport(rows={}, seconds=0)
+    for rule, (days, expire_batch) in rules.items():
+        rows = 0
+        if days:
+            before = days_ago(days)
+            while (batch := await expire_batch(before)) > 0:
+                rows += batch
+                if batch < batch_size:
+                    break
+        report.rows[rule] = rows
+        metrics.inc("satsdice_retention_rows_total", (("rule", rule),), rows)
+    report.seconds = perf_counter() - start
+    metrics.observe("satsdice_retention_seconds", (), report.seconds)
+
+    if report.rows["expired_withdraws"]:
+        # their winnings are no longer owed
+        house_exposure.reset()
+    logger.info(f"satsdice: retention removed {report.rows} in {report.seconds:.2f}s")
+    return report
@@ -0,0 +1,44 @@
+from pydantic import BaseSettings
+
+
+class SatsdiceSettings(BaseSettings):
+    """
+    Background task settings, read from SATSDICE_* environment variables.
+    A retention of 0 days keeps those rows forever.
+    """
+
+    retention_interval: int = 3600
+    retention_batch_size: int = 500
+    # move expired payments and withdraws to archive tables instead of
+    # deleting them
+    retention_archive: bool = True
+    lost_payment_days: int = 30
+    unpaid_payment_days: int = 2
+    claimed_withdraw_days: int = 90
+    # unclaimed winnings can no longer be claimed after this many days
+    withdraw_expiry_days: int = 30
+    hash_check_days: int = 90
+
+    # payments in flight per house wallet
+    payout_concurrency: int = 2
+    payout_batch_size: int = 50
+    payout_poll_interval: float = 5
+    # failed payouts are retried after 10, 20, 40, ... seconds, then the
+    # claim is undone so the winner can withdraw with a new invoice
+    payout_max_attempts: int = 6
+    payout_retry_backoff: float = 10
+    payout_max_backoff: float = 600
+    # seconds to fetch an invoice from a winner's Lightning address
+    payout_address_timeout: int = 10
+
+    invoice_pool_interval: float = 30
+    # pooled invoices are retired once they have less than
+    # `invoice_pool_margin` seconds left, so players have time to pay them
+    invoice_pool_expiry: int = 3600
+    invoice_pool_margin: int = 600
+
+    class Config:
+        env_prefix = "SATSDICE_"
+
+
+satsdice_settings = SatsdiceSettings()
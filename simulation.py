@@ -0,0 +1,73 @@
+"""
+Monte Carlo simulation of a link's chance, multiplier and bet range from
+the house's side, to see what a configuration does to a bankroll before
+saving it. NumPy is optional, without it only the exact edge is available.
+"""
+
+from .fair import ROLL_RANGE, win_probability
+from .models import SatsdiceSimulation, SimulateSatsdiceLink
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore[assignment]
+
+# bets drawn at once, which bounds the memory of a simulation
+CHUNK_SIZE = 1_000_000
+
+
+def house_edge(chance: float, multiplier: float) -> float:
+    """Expected house profit per sat bet."""
+    return 1 - win_probability(chance) * multiplier
+
+
+def simulate(data: SimulateSatsdiceLink) -> SatsdiceSimulation:
+    """
+    Play `data.bets` bets split over `data.paths` independent runs, each
+    starting from `data.bankroll`. Every bet size in the range is equally
+    likely and payouts are rounded down like real withdraws. The runs are
+    played in chunks of about `CHUNK_SIZE` bets, keeping only running
+    totals per run in between.
+    """
+    if np is None:
+        raise RuntimeError("Simulations need numpy to be installed.")
+    rng = np.random.default_rng(data.seed)
+    paths, steps = data.paths, max(1, data.bets // data.paths)
+    threshold = round(data.chance * ROLL_RANGE / 100)
+
+    balance = np.full(paths, float(data.bankroll))
+    peak = balance.copy()
+    drawdown = np.zeros(paths)
+    lowest = balance.copy()
+    staked = profit_sum = profit_sq = 0.0
+    done = 0
+    while done < steps:
+        shape = (paths, min(steps - done, max(1, CHUNK_SIZE // paths)))
+        bets = rng.integers(data.min_bet, data.max_bet, size=shape, endpoint=True)
+        won = rng.integers(0, ROLL_RANGE, size=shape) < threshold
+        profit = bets - np.where(won, np.floor(bets * data.multiplier), 0)
+
+        chunk = balance[:, None] + np.cumsum(profit, axis=1)
+        chunk_peak = np.maximum(np.maximum.accumulate(chunk, axis=1), peak[:, None])
+        drawdown = np.maximum(drawdown, (chunk_peak - chunk).max(axis=1))
+        lowest = np.minimum(lowest, chunk.min(axis=1))
+        balance, peak = chunk[:, -1], chunk_peak[:, -1]
+        staked += float(bets.sum())
+        profit_sum += float(profit.sum())
+        profit_sq += float(np.square(profit).sum())
+        done += shape[1]
+
+    count = paths * steps
+    p50, p95, p99 = np.percentile(drawdown, [50, 95, 99])
+    return SatsdiceSimulation(
+        bets=count,
+        house_edge=profit_sum / staked,
+        expected_edge=house_edge(data.chance, data.multiplier),
+        haircut_edge=data.haircut * data.multiplier / 100,
+        profit=int(profit_sum),
+        variance=profit_sq / count - (profit_sum / count) ** 2,
+        drawdown_p50=float(p50),
+        drawdown_p95=float(p95),
+        drawdown_p99=float(p99),
+        ruin_probability=float((lowest < 0).mean()),
+    )
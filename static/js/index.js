@@ -28,6 +28,7 @@ window.app = Vue.createApp({
       fiatRates: {},
       checker: null,
       payLinks: [],
+      analytics: {},
       payLinksTable: {
         pagination: {
           rowsPerPage: 10
@@ -38,6 +39,10 @@ window.app = Vue.createApp({
         fixedAmount: true,
         data: {
           haircut: 0,
+          rolls: 1,
+          rate_limit: 0,
+          client_rate_limit: 0,
+          pool_size: 0,
           min_bet: 10,
           max_bet: 1000,
           currency: 'satoshis',
@@ -85,6 +90,36 @@ window.app = Vue.createApp({
           LNbits.utils.notifyApiError(err)
         })
     },
+    async getAnalytics() {
+      // the last 30 days, read from the hourly rollups
+      const start = Math.floor(Date.now() / 1000) - 30 * 24 * 3600
+      await LNbits.api
+        .request(
+          'GET',
+          `/satsdice/api/v1/analytics?all_wallets=true&start=${start}`,
+          this.g.user.wallets[0].inkey
+        )
+        .then(response => {
+          this.analytics = _.indexBy(response.data, 'satsdice_pay')
+        })
+        .catch(LNbits.utils.notifyApiError)
+    },
+    rtpText(linkId) {
+      const row = this.analytics[linkId]
+      if (!row || !row.bets) return '-'
+      const [rtp, low, high] = [row.rtp, row.rtp_low, row.rtp_high].map(value =>
+        (value * 100).toFixed(1)
+      )
+      return `${rtp}% (${low}-${high}%)`
+    },
+    expectedRtpText(linkId) {
+      const row = this.analytics[linkId]
+      return row ? `${(row.theoretical_rtp * 100).toFixed(1)}%` : '-'
+    },
+    liabilityText(linkId) {
+      const row = this.analytics[linkId]
+      return row ? new Intl.NumberFormat(LOCALE).format(row.liability) : '-'
+    },
     closeFormDialog() {
       this.resetFormData()
     },
@@ -136,6 +171,10 @@ window.app = Vue.createApp({
       data.max_bet = parseInt(data.max_bet)
       data.multiplier = parseFloat(this.multiValue)
       data.haircut = parseFloat(data.haircut)
+      data.rolls = parseInt(data.rolls) || 1
+      data.rate_limit = parseInt(data.rate_limit) || 0
+      data.client_rate_limit = parseInt(data.client_rate_limit) || 0
+      data.pool_size = parseInt(data.pool_size) || 0
       data.chance = parseFloat(this.chanceValue)
       data.base_url = window.location.origin
 
@@ -154,6 +193,10 @@ window.app = Vue.createApp({
         fixedAmount: true,
         data: {
           haircut: 0,
+          rolls: 1,
+          rate_limit: 0,
+          client_rate_limit: 0,
+          pool_size: 0,
           min_bet: 10,
           max_bet: 1000,
           currency: 'satoshis',
@@ -178,7 +221,11 @@ window.app = Vue.createApp({
           'success_url',
           'comment_chars',
           'currency',
-          'disposable'
+          'disposable',
+          'rolls',
+          'rate_limit',
+          'client_rate_limit',
+          'pool_size'
         ),
         (value, key) =>
           (key === 'webhook_url' ||
@@ -253,5 +300,6 @@ window.app = Vue.createApp({
   async created() {
     // CHECK SATSDICE LINKS
     await this.getPayLinks()
+    await this.getAnalytics()
   }
 })
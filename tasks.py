@@ -0,0 +1,57 @@
+import asyncio
+
+from lnbits.core.models import Payment
+from lnbits.tasks import register_invoice_listener
+from loguru import logger
+
+from .counters import link_counters
+from .crud import add_satsdice_pay_counters
+from .services import backfill_rollups, resolve_satsdice_bet, run_satsdice_retention
+from .settings import satsdice_settings
+
+
+async def wait_for_paid_invoices():
+    invoice_queue = asyncio.Queue()
+    register_invoice_listener(invoice_queue, "ext_satsdice")
+
+    while True:
+        payment = await invoice_queue.get()
+        await on_invoice_paid(payment)
+
+
+async def on_invoice_paid(payment: Payment) -> None:
+    if payment.extra.get("tag") != "satsdice":
+        return
+    try:
+        await resolve_satsdice_bet(payment.payment_hash)
+    except Exception as exc:
+        # the listener has to survive, the retention sweep resolves it later
+        logger.error(f"satsdice: resolving bet {payment.payment_hash} failed: {exc}")
+
+
+async def flush_link_counters() -> None:
+    deltas = link_counters.take()
+    if not deltas:
+        return
+    try:
+        await add_satsdice_pay_counters(deltas)
+    except Exception as exc:
+        # never retry, the increments might have been applied already
+        logger.warning(f"satsdice: dropped counters of {len(deltas)} links: {exc}")
+
+
+async def run_link_counter_flush(interval: float = 5) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        await flush_link_counters()
+
+
+async def run_retention() -> None:
+    while True:
+        try:
+            # bets have to be in the rollups before retention may remove them
+            await backfill_rollups(satsdice_settings.retention_batch_size)
+            await run_satsdice_retention()
+        except Exception as exc:
+            logger.warning(f"satsdice: retention failed: {exc}")
+        await asyncio.sleep(satsdice_settings.retention_interval)
@@ -0,0 +1,113 @@
+import os
+import re
+from pathlib import Path
+from tempfile import mkdtemp
+from typing import Any
+
+import lnbits
+import pytest
+import pytest_asyncio
+from lnbits.db import SQLITE
+from lnbits.helpers import template_renderer, urlsafe_short_hash
+from lnbits.wallets.fake import FakeWallet
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from .. import migrations, views
+from ..crud import create_satsdice_pay, db
+from ..metrics import instrument_database
+from ..models import CreateSatsDiceLink, SatsdiceLink
+
+if db.type == SQLITE:
+    # never touch the data folder of a real install, use a scratch database
+    db.path = os.path.join(mkdtemp(), "ext_satsdice.sqlite3")
+    db.engine = create_async_engine(f"sqlite+aiosqlite:///{db.path}")
+    instrument_database(db)
+
+
+@pytest_asyncio.fixture(scope="session", autouse=True)
+async def migrated_db():
+    async with db.connect() as conn:
+        if conn.type != SQLITE:
+            await conn.execute("DROP SCHEMA IF EXISTS satsdice CASCADE")
+            await conn.execute("CREATE SCHEMA satsdice")
+        for key, migrate in migrations.__dict__.items():
+            if re.match(r"^m\d\d\d_", key):
+                await migrate(conn)
+    yield db
+
+
+class StatementRecorder:
+    """Records every statement the extension database sends to the driver."""
+
+    def __init__(self) -> None:
+        self.statements: list[tuple[str, Any]] = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append((statement, parameters))
+
+    def __enter__(self) -> "StatementRecorder":
+        event.listen(db.engine.sync_engine, "before_cursor_execute", self._record)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        event.remove(db.engine.sync_engine, "before_cursor_execute", self._record)
+
+    @property
+    def queries(self) -> list[tuple[str, Any]]:
+        """Statements that read or write rows, leaving out connection setup."""
+        return [
+            (statement, parameters)
+            for statement, parameters in self.statements
+            if statement.lstrip().split(" ", 1)[0].upper()
+            in ("SELECT", "INSERT", "UPDATE", "DELETE")
+        ]
+
+
+@pytest.fixture
+def recorder():
+    with StatementRecorder() as recorder:
+        yield recorder
+
+
+@pytest_asyncio.fixture
+async def link() -> SatsdiceLink:
+    return await create_satsdice_pay(
+        CreateSatsDiceLink(
+            wallet=urlsafe_short_hash(),
+            title="dice",
+            base_url="http://localhost:5000",
+            min_bet=10,
+            max_bet=1000,
+            multiplier=2,
+            chance=45,
+            haircut=0,
+        )
+    )
+
+
+@pytest.fixture
+def renderer(monkeypatch):
+    # lnbits resolves its template folders relative to its own checkout
+    renderer = template_renderer()
+    renderer.env.loader.searchpath.extend(  # type: ignore[union-attr]
+        [
+            Path(lnbits.__file__).parent.joinpath("templates").as_posix(),
+            Path(__file__).parent.parent.joinpath("templates").as_posix(),
+        ]
+    )
+    monkeypatch.setattr(views, "satsdice_renderer", lambda: renderer)
+    return renderer
+
+
+@pytest.fixture
+def invoice():
+    """Creates invoices the way a winner's wallet would."""
+    funding_source = FakeWallet()
+
+    async def create(amount: int) -> str:
+        response = await funding_source.create_invoice(amount=amount, memo="winnings")
+        assert response.payment_request
+        return response.payment_request
+
+    return create
@@ -0,0 +1,76 @@
+from types import SimpleNamespace
+
+import pytest
+from lnbits.helpers import urlsafe_short_hash
+
+from ..crud import get_satsdice_pay, get_satsdice_pays
+from ..models import (
+    CreateSatsDiceLink,
+    CreateSatsDiceLinks,
+    DeleteSatsDiceLinks,
+    UpdateSatsDiceLink,
+    UpdateSatsDiceLinks,
+)
+from ..views_api import (
+    api_bulk_create_links,
+    api_bulk_delete_links,
+    api_bulk_update_links,
+)
+
+
+def _link(**kwargs) -> CreateSatsDiceLink:
+    data = {
+        "title": "tier",
+        "base_url": "https://satsdice.test/",
+        "min_bet": 10,
+        "max_bet": 100,
+        "multiplier": 2,
+        "chance": 45,
+    }
+    return CreateSatsDiceLink(**{**data, **kwargs})
+
+
+@pytest.mark.asyncio
+async def test_bulk_links(link, recorder):
+    wallet = SimpleNamespace(wallet=SimpleNamespace(id=urlsafe_short_hash()))
+
+    results = await api_bulk_create_links(
+        CreateSatsDiceLinks(
+            links=[_link(title=f"tier {i}", chance=10 * i) for i in range(1, 6)]
+            + [_link(min_bet=1000), _link(wallet="someone_else")]
+        ),
+        wallet,  # type: ignore[arg-type]
+    )
+    assert [result.ok for result in results] == [True] * 5 + [False] * 2
+    assert results[5].detail == "Bad request"
+    created = [result.id for result in results if result.id]
+    links = await get_satsdice_pays(wallet.wallet.id)
+    assert sorted(link.id for link in links) == sorted(created)
+
+    recorder.statements.clear()
+    results = await api_bulk_update_links(
+        UpdateSatsDiceLinks(
+            links=[
+                UpdateSatsDiceLink(**_link(title="renamed").dict(), id=link_id)
+                for link_id in [*created, "missing", link.id]
+            ]
+        ),
+        wallet,  # type: ignore[arg-type]
+    )
+    assert [result.detail for result in results[-2:]] == [
+        "Satsdice does not exist",
+        "Come on, seriously, this isn't your satsdice!",
+    ]
+    assert all(result.ok for result in results[:-2])
+    updated = await get_satsdice_pay(created[0])
+    assert updated and updated.title == "renamed" and updated.chance == 45
+    # one lookup and one batched update for all links
+    assert [s.split()[0] for s, _ in recorder.queries] == ["SELECT", "UPDATE"]
+
+    results = await api_bulk_delete_links(
+        DeleteSatsDiceLinks(ids=[*created, link.id]),
+        wallet,  # type: ignore[arg-type]
+    )
+    assert [result.ok for result in results] == [True] * 5 + [False]
+    assert await get_satsdice_pays(wallet.wallet.id) == []
+    assert await get_satsdice_pay(link.id)
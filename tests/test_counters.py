@@ -0,0 +1,30 @@
+import pytest
+
+from ..counters import LinkCounters, link_counters
+from ..crud import get_satsdice_pays, update_satsdice_pay
+from ..tasks import flush_link_counters
+
+
+def test_take_swaps_buffer():
+    counters = LinkCounters()
+    counters.add("a", served_meta=1)
+    counters.add("a", amount=10, served_pr=1)
+    counters.add("b", served_meta=2)
+    assert counters.take() == {"a": (10, 1, 1), "b": (0, 2, 0)}
+    assert counters.take() == {}
+
+
+@pytest.mark.asyncio
+async def test_flush_increments_links(link):
+    link_counters.add(link.id, served_meta=3)
+    link_counters.add(link.id, amount=100, served_pr=2)
+    await flush_link_counters()
+    await flush_link_counters()
+
+    # a full update of the link must not overwrite the counters
+    link.title = "renamed"
+    await update_satsdice_pay(link)
+
+    [stored] = await get_satsdice_pays(link.wallet)
+    assert stored.title == "renamed"
+    assert (stored.amount, stored.served_meta, stored.served_pr) == (100, 3, 2)
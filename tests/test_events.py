@@ -0,0 +1,75 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from .. import payouts
+from ..crud import create_satsdice_payment, get_satsdice_bet
+from ..events import bet_events
+from ..models import CreateSatsDicePayment
+from ..payouts import payout_queue
+from ..tasks import on_invoice_paid
+from ..views_api import api_bet_events
+from ..views_lnurl import api_lnurlw_callback
+
+
+@pytest.mark.asyncio
+async def test_bet_stream_follows_the_bet(link, invoice, monkeypatch):
+    await create_satsdice_payment(
+        CreateSatsDicePayment(satsdice_pay=link.id, value=100, payment_hash="sse1")
+    )
+    link_queue = bet_events.subscribe(f"link:{link.id}")
+    response = await api_bet_events(link.id, "sse1")
+    stream = response.body_iterator
+
+    await on_invoice_paid(
+        SimpleNamespace(payment_hash="sse1", extra={"tag": "satsdice"})
+    )
+    paid = await anext(stream)  # type: ignore[call-overload]
+    outcome = await anext(stream)  # type: ignore[call-overload]
+    assert paid["event"] == "paid"
+
+    bet = await get_satsdice_bet(link.id, "sse1")
+    assert bet
+    assert outcome["event"] == ("won" if bet.paid else "lost")
+    if bet.paid:
+        assert json.loads(outcome["data"])["unique_hash"] == bet.unique_hash
+
+        async def pay_invoice(**_):
+            return None
+
+        monkeypatch.setattr(payouts, "pay_invoice", pay_invoice)
+        pr = await invoice(200)
+        await api_lnurlw_callback(bet.unique_hash, pr=pr)  # type: ignore[arg-type]
+        await payout_queue.drain()
+        claimed = await anext(stream)  # type: ignore[call-overload]
+        assert claimed["event"] == "claimed"
+
+    # the stream ends once nothing can happen to the bet anymore
+    assert [event async for event in stream] == []  # type: ignore[attr-defined]
+    assert "sse1" not in bet_events._subscribers
+
+    # the public link channel never carries the hashes needed to claim
+    event, data = link_queue.get_nowait()
+    assert event == outcome["event"]
+    assert set(data) <= {"value", "roll", "winnings"}
+    bet_events.unsubscribe(f"link:{link.id}", link_queue)
+
+
+@pytest.mark.asyncio
+async def test_stream_of_resolved_bet_starts_with_its_state(link):
+    await create_satsdice_payment(
+        CreateSatsDicePayment(satsdice_pay=link.id, value=100, payment_hash="sse2")
+    )
+    await on_invoice_paid(
+        SimpleNamespace(payment_hash="sse2", extra={"tag": "satsdice"})
+    )
+
+    response = await api_bet_events(link.id, "sse2")
+    stream = response.body_iterator
+    first = await anext(stream)  # type: ignore[call-overload]
+    bet = await get_satsdice_bet(link.id, "sse2")
+    assert bet
+    assert first["event"] == ("lost" if bet.lost else "won")
+    await stream.aclose()  # type: ignore[attr-defined]
+    assert "sse2" not in bet_events._subscribers
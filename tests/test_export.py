@@ -0,0 +1,65 @@
+import csv
+import io
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from ..crud import (
+    EXPORT_COLUMNS,
+    create_satsdice_payment,
+    db,
+    stream_satsdice_export,
+)
+from ..models import CreateSatsDicePayment, ExportFormat, SatsdicePayment
+from ..services import resolve_satsdice_bet
+from ..views_api import api_link_export
+
+
+async def _body(response) -> str:
+    return "".join([chunk async for chunk in response.body_iterator])
+
+
+@pytest.mark.asyncio
+async def test_export_streams_every_bet(link):
+    hashes = [f"{link.id}_export{i}" for i in range(7)]
+    for i, payment_hash in enumerate(hashes):
+        await create_satsdice_payment(
+            CreateSatsDicePayment(
+                satsdice_pay=link.id, value=100, payment_hash=payment_hash
+            )
+        )
+        if i % 3:
+            await resolve_satsdice_bet(payment_hash)
+    archived = SatsdicePayment(
+        payment_hash=f"{link.id}_archived", satsdice_pay=link.id, value=50, lost=True
+    )
+    await db.insert("satsdice.satsdice_payment_archive", archived)
+
+    chunks = [rows async for rows in stream_satsdice_export(link.id, chunk_size=3)]
+    assert all(0 < len(rows) <= 3 for rows in chunks)
+    rows = [dict(zip(EXPORT_COLUMNS, row, strict=True)) for c in chunks for row in c]
+    assert [row["payment_hash"] for row in rows] == [archived.payment_hash, *hashes]
+    assert rows[0]["archived"] == 1 and rows[0]["outcome"] == "lost"
+    for i, row in enumerate(rows[1:]):
+        if i % 3 == 0:
+            assert row["outcome"] == "pending" and row["claim"] is None
+        elif row["outcome"] == "won":
+            assert row["winnings"] == 200 and row["claim"] == "unclaimed"
+        else:
+            assert row["outcome"] == "lost" and row["winnings"] == 0
+
+    key_info = SimpleNamespace(wallet=SimpleNamespace(id=link.wallet))
+    response = await api_link_export(
+        link.id, key_info, ExportFormat.ndjson  # type: ignore
+    )
+    assert response.media_type == "application/x-ndjson"
+    lines = (await _body(response)).splitlines()
+    assert [json.loads(line) for line in lines] == rows
+
+    response = await api_link_export(
+        link.id, key_info, ExportFormat.csv  # type: ignore
+    )
+    table = list(csv.reader(io.StringIO(await _body(response))))
+    assert table[0] == list(EXPORT_COLUMNS)
+    assert [row[0] for row in table[1:]] == [row["payment_hash"] for row in rows]
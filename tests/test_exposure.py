@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+import pytest
+
+from .. import exposure, payouts
+from ..crud import create_satsdice_withdraw
+from ..exposure import house_exposure
+from ..models import CreateSatsDiceWithdraw
+from ..payouts import payout_queue
+from ..views_lnurl import api_lnurlp_callback, api_lnurlw_callback
+
+
+@pytest.fixture
+def balance(monkeypatch):
+    wallet = SimpleNamespace(balance=1000)
+
+    async def get_wallet(wallet_id: str):
+        return wallet
+
+    monkeypatch.setattr(exposure, "get_wallet", get_wallet)
+    return wallet
+
+
+@pytest.mark.asyncio
+async def test_liability_seeded_once_and_tracked(link, invoice, monkeypatch):
+    withdraw = await create_satsdice_withdraw(
+        CreateSatsDiceWithdraw(payment_hash="expo1", satsdice_pay=link.id, value=300)
+    )
+    assert await house_exposure.liability(link.wallet) == 300
+
+    async def pay_invoice(**_):
+        return None
+
+    monkeypatch.setattr(payouts, "pay_invoice", pay_invoice)
+    response = await api_lnurlw_callback(withdraw.unique_hash, pr=await invoice(300))
+
+    assert response.ok
+    # claimed winnings are owed until their payout is paid
+    assert await house_exposure.liability(link.wallet) == 300
+    house_exposure.reset()
+    assert await house_exposure.liability(link.wallet) == 300
+    await payout_queue.drain()
+    assert await house_exposure.liability(link.wallet) == 0
+    house_exposure.reset()
+    assert await house_exposure.liability(link.wallet) == 0
+
+
+@pytest.mark.asyncio
+async def test_bet_rejected_when_house_cannot_cover(link, balance):
+    await create_satsdice_withdraw(
+        CreateSatsDiceWithdraw(payment_hash="expo2", satsdice_pay=link.id, value=900)
+    )
+
+    # 100 sats at a multiplier of 2 would pay 200 on top of the 900 owed
+    response = await api_lnurlp_callback(
+        None, link.id, amount="100000", comment=None, payerdata=None  # type: ignore
+    )
+
+    assert not response.ok
+    assert response.reason.startswith("The house cannot cover this bet")
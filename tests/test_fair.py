@@ -0,0 +1,163 @@
+import hashlib
+from types import SimpleNamespace
+from typing import cast
+
+import pytest
+from bolt11 import decode as bolt11_decode
+from lnbits.core.models import Payment
+from lnbits.wallets.fake import FakeWallet
+from lnurl import LnurlPayActionResponse
+
+from .. import exposure, views_lnurl
+from ..crud import (
+    create_satsdice_payment,
+    create_satsdice_seed_chain,
+    db,
+    get_satsdice_payment,
+    get_satsdice_seed_chains,
+    reserve_satsdice_seed,
+)
+from ..fair import SeedChain, chain_commitment, new_root, roll
+from ..migrations import m020_publish_seed_chains
+from ..models import CreateSatsDicePayment, SatsdiceRollCheck, VerifySatsdiceRolls
+from ..tasks import on_invoice_paid
+from ..views_api import api_link_commitments, api_link_verify
+from ..views_lnurl import api_lnurlp_callback
+
+
+def test_seeds_hash_back_to_commitment():
+    root = new_root()
+    chain = SeedChain(root, 250)
+    assert chain.seed(0).hex() == chain_commitment(root, 250)
+    for index in (1, 99, 100, 101, 249, 250):
+        assert hashlib.sha256(chain.seed(index)).digest() == chain.seed(index - 1)
+    seeds, commitment = chain.seeds([7, 250])
+    assert seeds == {7: chain.seed(7), 250: chain.seed(250)}
+    assert commitment == chain.seed(0)
+    assert all(0 <= roll(chain.seed(1), str(i)) < 10_000 for i in range(1000))
+
+
+@pytest.mark.asyncio
+async def test_chains_are_published_before_use(link):
+    # links are created with their first commitment
+    [created] = await get_satsdice_seed_chains(link.id)
+    assert created.used == 0
+
+    await _delete_chains(link.id)
+    first = await create_satsdice_seed_chain(link.id, length=2)
+    assert await reserve_satsdice_seed(link.id) == (first.id, 1)
+    # every next chain is out before the current one is used up
+    reserved = []
+    for _ in range(5):
+        published = {c.id for c in await api_link_commitments(link.id)}
+        seed = await reserve_satsdice_seed(link.id)
+        assert seed and seed[0] in published
+        reserved.append(seed)
+    assert len(set(reserved)) == 5
+
+    # only used up chains reveal their root
+    chains = await get_satsdice_seed_chains(link.id)
+    commitments = await api_link_commitments(link.id)
+    assert {c.id: c.root for c in commitments} == {
+        c.id: c.root if c.used == c.length else None for c in chains
+    }
+
+    # without a published chain no seed is handed out, one is published
+    await _delete_chains(link.id)
+    assert await reserve_satsdice_seed(link.id) is None
+    [published] = await get_satsdice_seed_chains(link.id)
+    assert await reserve_satsdice_seed(link.id) == (published.id, 1)
+
+
+@pytest.mark.asyncio
+async def test_migration_publishes_missing_chains(link):
+    await _delete_chains(link.id)
+    async with db.connect() as conn:
+        await m020_publish_seed_chains(conn)
+    [chain] = await get_satsdice_seed_chains(link.id)
+    assert chain.used == 0 and chain.commitment == chain_commitment(
+        chain.root, chain.length
+    )
+
+
+async def _delete_chains(link_id: str) -> None:
+    await db.execute(
+        "DELETE FROM satsdice.satsdice_seed_chain WHERE satsdice_pay = :link_id",
+        {"link_id": link_id},
+    )
+
+
+@pytest.mark.asyncio
+async def test_batch_verification(link):
+    hashes = [f"fair{i}" for i in range(50)]
+    for payment_hash in hashes:
+        await create_satsdice_payment(
+            CreateSatsDicePayment(
+                satsdice_pay=link.id, value=100, payment_hash=payment_hash
+            )
+        )
+        await on_invoice_paid(
+            SimpleNamespace(payment_hash=payment_hash, extra={"tag": "satsdice"})
+        )
+
+    checks = await api_link_verify(
+        link.id, VerifySatsdiceRolls(payment_hashes=[*hashes, "unknown"])
+    )
+    assert len(checks) == 50 and all(check.valid for check in checks)
+    assert all(check.won == (check.roll < 4500) for check in checks)
+
+    await db.execute(
+        "UPDATE satsdice.satsdice_payment SET roll = roll + 1 "
+        "WHERE payment_hash = :payment_hash",
+        {"payment_hash": "fair0"},
+    )
+    checks = await api_link_verify(link.id, VerifySatsdiceRolls(payment_hashes=hashes))
+    assert [check.payment_hash for check in checks if not check.valid] == ["fair0"]
+
+
+@pytest.mark.asyncio
+async def test_revealed_seeds_do_not_predict_unpaid_bets(link, monkeypatch):
+    funding_source = FakeWallet()
+
+    async def create_invoice(*, amount: int, **_):
+        invoice = await funding_source.create_invoice(amount=amount, memo="bet")
+        return SimpleNamespace(
+            payment_hash=invoice.checking_id, bolt11=invoice.payment_request
+        )
+
+    async def get_wallet(wallet_id: str):
+        return SimpleNamespace(balance=10**9)
+
+    monkeypatch.setattr(views_lnurl, "create_invoice", create_invoice)
+    monkeypatch.setattr(exposure, "get_wallet", get_wallet)
+    request = SimpleNamespace(url_for=lambda *_, **__: "http://localhost:5000/win")
+
+    async def open_invoice(amount: int) -> str:
+        response = await api_lnurlp_callback(
+            request, link.id, amount=str(amount), comment=None, payerdata=None  # type: ignore
+        )
+        assert isinstance(response, LnurlPayActionResponse)
+        return bolt11_decode(str(response.pr)).payment_hash
+
+    async def pay(payment_hash: str) -> SatsdiceRollCheck:
+        paid = SimpleNamespace(payment_hash=payment_hash, extra={"tag": "satsdice"})
+        await on_invoice_paid(cast(Payment, paid))
+        [check] = await api_link_verify(
+            link.id, VerifySatsdiceRolls(payment_hashes=[payment_hash])
+        )
+        return check
+
+    # the attacker opens a max bet, then opens and pays a min bet
+    max_bet = await open_invoice(1000_000)
+    min_bet = await open_invoice(10_000)
+    unpaid = await get_satsdice_payment(max_bet)
+    assert unpaid and unpaid.chain is None and unpaid.seed_index is None
+    revealed = await pay(min_bet)
+
+    # hashing the revealed seed only leads to seeds of bets settled before it
+    guess = hashlib.sha256(bytes.fromhex(revealed.seed)).digest()
+    settled = await pay(max_bet)
+    assert settled.chain == revealed.chain
+    assert settled.seed_index == revealed.seed_index + 1
+    assert guess.hex() != settled.seed
+    assert hashlib.sha256(bytes.fromhex(settled.seed)).hexdigest() == revealed.seed
@@ -0,0 +1,71 @@
+import pytest
+
+from ..crud import db, get_withdraw_hash_checkw, satsdice_hash_check_cache
+from .conftest import StatementRecorder
+
+
+async def _legacy_get_withdraw_hash_checkw(the_hash: str, lnurl_id: str):
+    """The select-select-insert-recurse implementation this replaced."""
+    result1 = await db.execute(
+        "SELECT * FROM satsdice.hash_checkw WHERE id = :hash", {"hash": the_hash}
+    )
+    rowid = result1.mappings().first()
+    result2 = await db.execute(
+        "SELECT * FROM satsdice.hash_checkw WHERE lnurl_id = :lnurl_id",
+        {"lnurl_id": lnurl_id},
+    )
+    rowlnurl = result2.mappings().first()
+    if not rowlnurl or not rowid:
+        await db.execute(
+            "INSERT INTO satsdice.hash_checkw (id, lnurl_id) VALUES (:id, :lnurl_id)",
+            {"id": the_hash, "lnurl_id": lnurl_id},
+        )
+        await _legacy_get_withdraw_hash_checkw(the_hash, lnurl_id)
+        return {"lnurl": True, "hash": False}
+    return {"lnurl": True, "hash": True}
+
+
+async def _statements_per_call(check, the_hash: str) -> tuple[int, int]:
+    with StatementRecorder() as first:
+        assert await check(the_hash, f"lnurl_{the_hash}") == {
+            "lnurl": True,
+            "hash": False,
+        }
+    with StatementRecorder() as repeat:
+        assert await check(the_hash, f"lnurl_{the_hash}") == {
+            "lnurl": True,
+            "hash": True,
+        }
+    return len(first.queries), len(repeat.queries)
+
+
+@pytest.mark.asyncio
+async def test_hash_check_statements_per_call():
+    before = await _statements_per_call(_legacy_get_withdraw_hash_checkw, "bench1")
+    after = await _statements_per_call(get_withdraw_hash_checkw, "bench2")
+    # a repeat that misses the in-process cache still needs only the upsert
+    satsdice_hash_check_cache.clear()
+    with StatementRecorder() as uncached_repeat:
+        await get_withdraw_hash_checkw("bench2", "lnurl_bench2")
+
+    print(
+        "\nstatements per hash check (new hash, repeated hash): "
+        f"before {before}, after {after}"
+    )
+    assert before == (5, 2)
+    assert after == (1, 0)
+    assert len(uncached_repeat.queries) == 1
+
+
+@pytest.mark.asyncio
+async def test_hash_check_of_same_hash_with_other_lnurl():
+    satsdice_hash_check_cache.clear()
+    assert await get_withdraw_hash_checkw("shared", "lnurl_a") == {
+        "lnurl": True,
+        "hash": False,
+    }
+    satsdice_hash_check_cache.clear()
+    assert await get_withdraw_hash_checkw("shared", "lnurl_b") == {
+        "lnurl": True,
+        "hash": True,
+    }
@@ -0,0 +1,64 @@
+import pytest
+
+from ..crud import create_satsdice_pay, create_satsdice_payment, get_satsdice_bets
+from ..helpers import decode_cursor, encode_cursor
+from ..models import BetStatus, CreateSatsDiceLink, CreateSatsDicePayment
+
+
+@pytest.mark.asyncio
+async def test_bets_keyset_pagination(link):
+    # created within the same second, so paging relies on the hash tie-breaker
+    for i in range(7):
+        await create_satsdice_payment(
+            CreateSatsDicePayment(
+                satsdice_pay=link.id, value=10 + i, payment_hash=f"history{i}"
+            )
+        )
+
+    seen: list[str] = []
+    cursor = None
+    while True:
+        page = await get_satsdice_bets([link.wallet], link.id, None, cursor, 3)
+        seen.extend(bet.payment_hash for bet in page)
+        if len(page) < 3:
+            break
+        cursor = decode_cursor(encode_cursor(page[-1].time, page[-1].payment_hash))
+
+    assert sorted(seen) == [f"history{i}" for i in range(7)]
+    assert len(set(seen)) == 7
+    assert await get_satsdice_bets([link.wallet], link.id, BetStatus.won) == []
+    assert len(await get_satsdice_bets([link.wallet], link.id, BetStatus.pending)) == 7
+    assert await get_satsdice_bets(["someone_else"], link.id) == []
+
+
+@pytest.mark.asyncio
+async def test_bets_paged_across_links(link):
+    other = await create_satsdice_pay(
+        CreateSatsDiceLink(**{**link.dict(), "title": "other dice"})
+    )
+    for i in range(8):
+        await create_satsdice_payment(
+            CreateSatsDicePayment(
+                satsdice_pay=(link, other)[i % 2].id,
+                value=10,
+                payment_hash=f"wallet{i}",
+            )
+        )
+
+    seen: list[str] = []
+    cursor = None
+    while page := await get_satsdice_bets([link.wallet], None, None, cursor, 3):
+        seen.extend(bet.payment_hash for bet in page)
+        cursor = (page[-1].time, page[-1].payment_hash)
+
+    # the pages of both links interleave in one (time, payment_hash) order
+    assert seen == [f"wallet{i}" for i in reversed(range(8))]
+    assert {bet.satsdice_pay for bet in await get_satsdice_bets([link.wallet])} == {
+        link.id,
+        other.id,
+    }
+
+
+def test_invalid_cursor():
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor")
@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+
+import pytest
+from bolt11 import decode as bolt11_decode
+from lnbits.helpers import urlsafe_short_hash
+from lnbits.wallets.fake import FakeWallet
+
+from .. import exposure, pool, views_lnurl
+from ..crud import create_satsdice_pay, get_satsdice_payment, update_satsdice_pay
+from ..models import CreateSatsDiceLink
+from ..pool import invoice_pool, pool_amounts
+from ..settings import satsdice_settings
+from ..views_lnurl import api_lnurlp_callback
+
+
+class FakeBackend:
+    def __init__(self) -> None:
+        self.funding_source = FakeWallet()
+        self.created: list[tuple[int, int | None]] = []
+
+    async def create_invoice(self, *, amount: int, expiry: int | None = None, **_):
+        self.created.append((amount, expiry))
+        invoice = await self.funding_source.create_invoice(amount=amount, memo="bet")
+        return SimpleNamespace(
+            payment_hash=invoice.checking_id, bolt11=invoice.payment_request
+        )
+
+
+def test_pool_amounts():
+    link = SimpleNamespace(min_bet=10, max_bet=1000, rolls=1)
+    assert pool_amounts(link) == [10, 100, 1000]  # type: ignore
+    link = SimpleNamespace(min_bet=10, max_bet=500, rolls=3)
+    assert pool_amounts(link) == [30, 100, 1000, 1500]  # type: ignore
+
+
+@pytest.mark.asyncio
+async def test_pooled_invoices_are_handed_out_once(monkeypatch):
+    async def get_wallet(wallet_id: str):
+        return SimpleNamespace(balance=10**9)
+
+    backend, on_demand = FakeBackend(), FakeBackend()
+    monkeypatch.setattr(exposure, "get_wallet", get_wallet)
+    monkeypatch.setattr(pool, "create_invoice", backend.create_invoice)
+    monkeypatch.setattr(views_lnurl, "create_invoice", on_demand.create_invoice)
+    link = await create_satsdice_pay(
+        CreateSatsDiceLink(
+            wallet=urlsafe_short_hash(),
+            title="pooled",
+            base_url="http://localhost:5000",
+            min_bet=10,
+            max_bet=1000,
+            multiplier=2,
+            chance=45,
+            pool_size=2,
+        )
+    )
+    request = SimpleNamespace(url_for=lambda *_, **__: "http://localhost:5000/win")
+
+    async def bet(amount: int) -> str:
+        response = await api_lnurlp_callback(
+            request, link.id, amount=str(amount), comment=None, payerdata=None  # type: ignore
+        )
+        return str(response.pr)  # type: ignore
+
+    assert await invoice_pool.refill() == 6
+    expiry = satsdice_settings.invoice_pool_expiry
+    assert sorted(backend.created) == [
+        (amount, expiry) for amount in (10, 10, 100, 100, 1000, 1000)
+    ]
+    bolt11s = [await bet(100_000) for _ in range(3)]
+    assert len(set(bolt11s)) == 3
+    # two came from the pool, the third was made on demand
+    assert on_demand.created == [(100, None)]
+    payment_hash = bolt11_decode(bolt11s[0]).payment_hash
+    payment = await get_satsdice_payment(payment_hash)
+    assert payment and payment.satsdice_pay == link.id and payment.value == 100
+    assert await invoice_pool.refill() == 2
+
+    # odd amounts are never pooled
+    await bet(123_000)
+    assert on_demand.created[-1] == (123, None)
+
+    # invoices for the old title no longer match the metadata
+    link.title = "renamed"
+    await update_satsdice_pay(link)
+    await bet(10_000)
+    assert on_demand.created[-1] == (10, None)
+    assert await invoice_pool.refill() == 6
+
+    # and none are handed out close to their expiry
+    monkeypatch.setattr(satsdice_settings, "invoice_pool_margin", expiry)
+    await bet(1000_000)
+    assert on_demand.created[-1] == (1000, None)
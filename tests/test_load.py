@@ -0,0 +1,201 @@
+"""
+End-to-end load test of a full satsdice round against a local stand-in
+for the LNbits payment services.
+
+Every simulated player runs lnurlp -> pay callback -> settle -> displaywin
+and, on a win, lnurlw -> withdraw callback. The test runs against the
+database LNbits is configured for, so point LNBITS_DATABASE_URL at a local
+Postgres to measure that instead of SQLite.
+
+    SATSDICE_LOAD_PLAYERS=500 SATSDICE_LOAD_SETTLE_DELAY=0.05 \\
+        pytest tests/test_load.py -s
+"""
+
+import asyncio
+import os
+import re
+from collections import defaultdict
+from time import perf_counter
+from types import SimpleNamespace
+from typing import cast
+from urllib.parse import urlparse
+
+import pytest
+from fastapi import FastAPI
+from httpx import ASGITransport, AsyncClient
+from lnbits.core.models import Payment
+from lnbits.wallets.fake import FakeWallet
+
+from .. import exposure, payouts, satsdice_ext, views_lnurl
+from ..payouts import payout_queue
+from ..tasks import on_invoice_paid
+
+PLAYERS = int(os.environ.get("SATSDICE_LOAD_PLAYERS", "25"))
+SETTLE_DELAY = float(os.environ.get("SATSDICE_LOAD_SETTLE_DELAY", "0"))
+PAYOUT_DELAY = float(os.environ.get("SATSDICE_LOAD_PAYOUT_DELAY", "0"))
+
+
+class FakeLightning:
+    """
+    In-memory stand-in for `create_invoice` and `pay_invoice`. Invoices are
+    signed by the LNbits fake wallet and settle through the satsdice invoice
+    listener, either right away or after `settle_delay` seconds.
+    """
+
+    def __init__(self, settle_delay: float = 0, payout_delay: float = 0) -> None:
+        self.settle_delay = settle_delay
+        self.payout_delay = payout_delay
+        self.funding_source = FakeWallet()
+        self.invoices: dict[str, SimpleNamespace] = {}
+        self.payouts: list[dict] = []
+
+    async def create_invoice(
+        self,
+        *,
+        wallet_id: str,
+        amount: float,
+        memo: str = "",
+        description_hash: bytes | None = None,
+        extra: dict | None = None,
+        **_,
+    ):
+        invoice = await self.funding_source.create_invoice(
+            amount=int(amount), memo=memo, description_hash=description_hash
+        )
+        assert invoice.checking_id and invoice.payment_request
+        payment = SimpleNamespace(
+            payment_hash=invoice.checking_id,
+            checking_id=invoice.checking_id,
+            bolt11=invoice.payment_request,
+            wallet_id=wallet_id,
+            amount=int(amount * 1000),
+            extra=extra or {},
+            success=False,
+        )
+        self.invoices[payment.payment_hash] = payment
+        return payment
+
+    async def settle(self, payment_hash: str) -> None:
+        await asyncio.sleep(self.settle_delay)
+        invoice = self.invoices[payment_hash]
+        invoice.success = True
+        # only the fields the listener reads are filled in
+        await on_invoice_paid(cast(Payment, invoice))
+
+    async def pay_invoice(self, **kwargs):
+        await asyncio.sleep(self.payout_delay)
+        self.payouts.append(kwargs)
+
+    async def get_wallet(self, wallet_id: str):
+        return SimpleNamespace(id=wallet_id, balance=10**12)
+
+
+class LatencyReport:
+    def __init__(self) -> None:
+        self.samples: defaultdict[str, list[float]] = defaultdict(list)
+
+    async def timed(self, endpoint: str, coro):
+        start = perf_counter()
+        try:
+            return await coro
+        finally:
+            self.samples[endpoint].append(perf_counter() - start)
+
+    def format(self, elapsed: float) -> str:
+        lines = [
+            f"{PLAYERS} players in {elapsed:.2f}s "
+            f"({PLAYERS / elapsed:.1f} rounds/s, settle delay {SETTLE_DELAY}s)",
+            f"{'endpoint':<12}{'count':>7}{'req/s':>9}"
+            f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}",
+        ]
+        for endpoint, samples in self.samples.items():
+            samples = sorted(samples)
+            lines.append(
+                f"{endpoint:<12}{len(samples):>7}{len(samples) / elapsed:>9.1f}"
+                + "".join(
+                    f"{_percentile(samples, p) * 1000:>9.1f}" for p in (50, 95, 99)
+                )
+            )
+        return "\n".join(lines)
+
+
+def _percentile(samples: list[float], percent: int) -> float:
+    index = max(0, -(-len(samples) * percent // 100) - 1)
+    return samples[index]
+
+
+def _path(url: str) -> str:
+    parsed = urlparse(url)
+    return f"{parsed.path}?{parsed.query}" if parsed.query else parsed.path
+
+
+@pytest.fixture
+def lightning(monkeypatch, renderer) -> FakeLightning:
+    fake = FakeLightning(SETTLE_DELAY, PAYOUT_DELAY)
+    monkeypatch.setattr(views_lnurl, "create_invoice", fake.create_invoice)
+    monkeypatch.setattr(payouts, "pay_invoice", fake.pay_invoice)
+    monkeypatch.setattr(exposure, "get_wallet", fake.get_wallet)
+    return fake
+
+
+async def _play(
+    client: AsyncClient, link_id: str, lightning: FakeLightning, report: LatencyReport
+) -> bool:
+    response = await report.timed(
+        "lnurlp", client.get(f"/satsdice/api/v1/lnurlp/{link_id}")
+    )
+    pay = response.json()
+    amount = pay["minSendable"]
+    response = await report.timed(
+        "lnurlp_cb", client.get(_path(pay["callback"]), params={"amount": amount})
+    )
+    invoice = response.json()
+    payment_hash = invoice["successAction"]["url"].rsplit("/", 1)[1]
+    await report.timed("settle", lightning.settle(payment_hash))
+
+    response = await report.timed(
+        "displaywin", client.get(_path(invoice["successAction"]["url"]))
+    )
+    assert response.status_code == 200
+    match = re.search(r"uniqueHash: '([\w-]+)'", response.text)
+    if not match:
+        assert "You lost." in response.text
+        return False
+
+    response = await report.timed(
+        "lnurlw", client.get(f"/satsdice/api/v1/lnurlw/{match.group(1)}")
+    )
+    withdraw = response.json()
+    player_invoice = await lightning.funding_source.create_invoice(
+        amount=withdraw["maxWithdrawable"] // 1000, memo="winnings"
+    )
+    response = await report.timed(
+        "lnurlw_cb",
+        client.get(
+            _path(withdraw["callback"]),
+            params={"k1": withdraw["k1"], "pr": player_invoice.payment_request},
+        ),
+    )
+    assert response.json()["status"] == "OK"
+    return True
+
+
+@pytest.mark.asyncio
+async def test_load(link, lightning):
+    app = FastAPI()
+    app.include_router(satsdice_ext)
+    report = LatencyReport()
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="https://satsdice.test"
+    ) as client:
+        start = perf_counter()
+        wins = await asyncio.gather(
+            *[_play(client, link.id, lightning, report) for _ in range(PLAYERS)]
+        )
+        elapsed = perf_counter() - start
+        await report.timed("payouts", payout_queue.drain())
+
+    print("\n" + report.format(elapsed))
+    assert len(report.samples["displaywin"]) == PLAYERS
+    assert len(lightning.payouts) == sum(wins)
@@ -0,0 +1,65 @@
+import pytest
+from fastapi import FastAPI
+from httpx import ASGITransport, AsyncClient
+
+from .. import satsdice_ext
+from ..metrics import Metrics
+from ..views_api import api_metrics
+
+
+def test_render_prometheus_text():
+    metrics = Metrics()
+    metrics.help["requests_total"] = "Requests."
+    metrics.inc("requests_total", (("route", '/a"b'),))
+    metrics.observe("latency_seconds", (), 0.02)
+    metrics.observe("latency_seconds", (), 20)
+    metrics.gauge("cache", lambda: {(("stat", "hits"),): 3})
+
+    assert metrics.render().splitlines() == [
+        "# HELP requests_total Requests.",
+        "# TYPE requests_total counter",
+        'requests_total{route="/a\\"b"} 1',
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.005"} 0',
+        'latency_seconds_bucket{le="0.01"} 0',
+        'latency_seconds_bucket{le="0.025"} 1',
+        'latency_seconds_bucket{le="0.05"} 1',
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="0.25"} 1',
+        'latency_seconds_bucket{le="0.5"} 1',
+        'latency_seconds_bucket{le="1"} 1',
+        'latency_seconds_bucket{le="2.5"} 1',
+        'latency_seconds_bucket{le="5"} 1',
+        'latency_seconds_bucket{le="10"} 1',
+        'latency_seconds_bucket{le="+Inf"} 2',
+        "latency_seconds_sum 20.02",
+        "latency_seconds_count 2",
+        "# TYPE cache gauge",
+        'cache{stat="hits"} 3',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_routes_and_statements_are_recorded(link):
+    app = FastAPI()
+    app.include_router(satsdice_ext)
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="https://satsdice.test"
+    ) as client:
+        await client.get(f"/satsdice/api/v1/lnurlp/{link.id}")
+        await client.get("/satsdice/does_not_exist")
+
+    text = (await api_metrics()).body.decode()
+    assert (
+        'satsdice_requests_total{route="/satsdice/api/v1/lnurlp/{link_id}",'
+        'method="GET",status="200"}' in text
+    )
+    assert (
+        'satsdice_requests_total{route="/satsdice/{link_id}",'
+        'method="GET",status="404"}' in text
+    )
+    assert (
+        'satsdice_request_duration_seconds_count{route="/satsdice/{link_id}"}' in text
+    )
+    assert 'satsdice_db_statements_total{statement="SELECT"}' in text
+    assert 'satsdice_cache{cache="link",stat="hits"}' in text
@@ -0,0 +1,102 @@
+import json
+
+import pytest
+import pytest_asyncio
+from lnbits.helpers import urlsafe_short_hash
+
+from ..crud import (
+    create_satsdice_pay,
+    create_satsdice_payment,
+    get_satsdice_bet,
+    get_satsdice_bets,
+    get_satsdice_payment,
+    get_satsdice_rollups,
+    get_satsdice_withdraw,
+)
+from ..fair import pack_rolls, unpack_rolls
+from ..helpers import lnurlp_response
+from ..models import CreateSatsDiceLink, CreateSatsDicePayment, VerifySatsdiceRolls
+from ..services import resolve_satsdice_bet
+from ..views_api import api_bet_rolls, api_link_verify
+
+
+@pytest_asyncio.fixture
+async def ten_rolls():
+    return await create_satsdice_pay(
+        CreateSatsDiceLink(
+            wallet=urlsafe_short_hash(),
+            title="ten rolls",
+            base_url="http://localhost:5000",
+            min_bet=10,
+            max_bet=1000,
+            multiplier=2,
+            chance=45,
+            haircut=0,
+            rolls=10,
+        )
+    )
+
+
+def test_pack_rolls():
+    results = [(0, True), (4499, True), (4500, False), (9999, False)]
+    assert unpack_rolls(pack_rolls(results)) == results
+    assert len(pack_rolls([(1, False)] * 1000)) == 2668
+
+
+@pytest.mark.asyncio
+async def test_one_payment_pays_out_all_rolls(ten_rolls):
+    settled = []
+    for i in range(20):
+        payment_hash = f"{ten_rolls.id}_multi{i}"
+        await create_satsdice_payment(
+            CreateSatsDicePayment(
+                satsdice_pay=ten_rolls.id,
+                value=1000,
+                payment_hash=payment_hash,
+                rolls=ten_rolls.rolls,
+            )
+        )
+        await resolve_satsdice_bet(payment_hash)
+        payment = await get_satsdice_payment(payment_hash)
+        assert payment and payment.results
+
+        rolls = await api_bet_rolls(ten_rolls.id, payment_hash)
+        assert [r.index for r in rolls] == list(range(10))
+        assert rolls[0].roll == payment.roll
+        assert all(r.won == (r.roll < 4500) for r in rolls)
+        won = sum(r.won for r in rolls)
+        assert payment.paid == (won > 0)
+
+        withdraw = await get_satsdice_withdraw(payment_hash)
+        if won:
+            # a tenth of the payment is staked on every roll
+            assert withdraw and withdraw.value == 200 * won
+        else:
+            assert withdraw is None
+        settled.append((payment_hash, won))
+
+        bet = await get_satsdice_bet(ten_rolls.id, payment_hash)
+        assert bet and bet.rolls == 10 and bet.results == payment.results
+
+    bets = await get_satsdice_bets([ten_rolls.wallet], ten_rolls.id)
+    assert {(bet.rolls, bet.results is not None) for bet in bets} == {(10, True)}
+
+    rollups = await get_satsdice_rollups(ten_rolls.id, 0, 2**31)
+    assert sum(r.bets for r in rollups) == 200
+    assert sum(r.wins for r in rollups) == sum(won for _, won in settled)
+    assert sum(r.payouts for r in rollups) == 200 * sum(won for _, won in settled)
+
+    checks = await api_link_verify(
+        ten_rolls.id,
+        VerifySatsdiceRolls(payment_hashes=[h for h, _ in settled]),
+    )
+    assert len(checks) == 20 and all(check.valid for check in checks)
+
+
+def test_bet_sizes_are_per_roll(ten_rolls):
+    response = json.loads(
+        lnurlp_response(ten_rolls, "https://satsdice.test/cb").content
+    )
+    assert response["minSendable"] == 100_000
+    assert response["maxSendable"] == 10_000_000
+    assert "Rolls: 10" in response["metadata"]
@@ -0,0 +1,83 @@
+import pytest
+import pytest_asyncio
+from fastapi import FastAPI
+from httpx import ASGITransport, AsyncClient
+from lnbits.settings import settings
+
+from .. import satsdice_ext
+from ..crud import update_satsdice_pay
+from ..views import display_page_cache, satsdice_renderer
+
+
+@pytest_asyncio.fixture
+async def client():
+    app = FastAPI()
+    app.include_router(satsdice_ext)
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="https://satsdice.test"
+    ) as client:
+        yield client
+
+
+@pytest.mark.asyncio
+async def test_display_page_is_rendered_once(link, renderer, client, monkeypatch):
+    renders = []
+    template_response = renderer.TemplateResponse
+    monkeypatch.setattr(
+        renderer,
+        "TemplateResponse",
+        lambda *args, **kwargs: renders.append(args)
+        or template_response(*args, **kwargs),
+    )
+    display_page_cache.clear()
+
+    first = await client.get(f"/satsdice/{link.id}")
+    second = await client.get(f"/satsdice/{link.id}")
+    assert first.status_code == second.status_code == 200
+    assert first.text == second.text and len(renders) == 1
+    page_etag = first.headers["etag"]
+
+    response = await client.get(
+        f"/satsdice/{link.id}", headers={"If-None-Match": page_etag}
+    )
+    assert response.status_code == 304 and response.content == b""
+
+    link.chance = 40
+    await update_satsdice_pay(link)
+    response = await client.get(
+        f"/satsdice/{link.id}", headers={"If-None-Match": page_etag}
+    )
+    assert response.status_code == 200
+    assert response.headers["etag"] != page_etag and len(renders) == 2
+
+
+@pytest.mark.asyncio
+async def test_display_page_follows_site_settings(link, renderer, client, monkeypatch):
+    display_page_cache.clear()
+    first = await client.get(f"/satsdice/{link.id}")
+    page_etag = first.headers["etag"]
+
+    monkeypatch.setattr(settings, "lnbits_site_title", "Dice Hall")
+    response = await client.get(
+        f"/satsdice/{link.id}", headers={"If-None-Match": page_etag}
+    )
+    assert response.status_code == 200 and response.headers["etag"] != page_etag
+
+
+def test_renderer_follows_site_settings(monkeypatch):
+    renderer = satsdice_renderer()
+    assert satsdice_renderer() is renderer
+    monkeypatch.setattr(settings, "lnbits_denomination", "dice")
+    assert satsdice_renderer() is not renderer
+    assert satsdice_renderer().env.globals["LNBITS_DENOMINATION"] == "dice"
+
+
+@pytest.mark.asyncio
+async def test_lnurlp_response_etag(link, client):
+    first = await client.get(f"/satsdice/api/v1/lnurlp/{link.id}")
+    assert first.json()["tag"] == "payRequest"
+    response = await client.get(
+        f"/satsdice/api/v1/lnurlp/{link.id}",
+        headers={"If-None-Match": f'"other", {first.headers["etag"]}'},
+    )
+    assert response.status_code == 304
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import socket
+from types import SimpleNamespace
+
+import pytest
+import pytest_asyncio
+from lnbits.helpers import urlsafe_short_hash
+
+from .. import exposure, payouts, views_lnurl
+from ..crud import (
+    create_satsdice_pay,
+    create_satsdice_payment,
+    get_satsdice_bet,
+    get_satsdice_withdraw,
+)
+from ..helpers import lnurlp_metadata, lnurlp_response, payout_address
+from ..models import CreateSatsDiceLink, CreateSatsDicePayment, PayoutStatus
+from ..payouts import LnurlPayResolver, payout_queue
+from ..pool import invoice_pool
+from ..services import resolve_satsdice_bet
+from ..settings import satsdice_settings
+from ..views_lnurl import api_lnurlp_callback, api_lnurlw_callback
+
+
+class FakeResolver:
+    """Local stand-in for the LNURL-pay server behind a Lightning address."""
+
+    def __init__(self, invoice, fail: bool = False) -> None:
+        self.create_invoice = invoice
+        self.fail = fail
+        self.requests: list[tuple[str, int]] = []
+
+    async def invoice(self, address: str, amount_msat: int) -> str:
+        self.requests.append((address, amount_msat))
+        if self.fail:
+            raise ValueError("address not found")
+        return await self.create_invoice(amount_msat // 1000)
+
+
+@pytest_asyncio.fixture
+async def sure_win():
+    return await create_satsdice_pay(
+        CreateSatsDiceLink(
+            wallet=urlsafe_short_hash(),
+            title="sure win",
+            base_url="http://localhost:5000",
+            min_bet=10,
+            max_bet=1000,
+            multiplier=1,
+            chance=100,
+            haircut=0,
+        )
+    )
+
+
+async def _win(link, payment_hash: str) -> None:
+    await create_satsdice_payment(
+        CreateSatsDicePayment(
+            satsdice_pay=link.id,
+            value=100,
+            payment_hash=payment_hash,
+            payout_address="alice@example.com",
+        )
+    )
+    await resolve_satsdice_bet(payment_hash)
+
+
+@pytest.mark.asyncio
+async def test_winnings_are_paid_to_the_address(sure_win, invoice, monkeypatch):
+    resolver = FakeResolver(invoice)
+    paid = []
+
+    async def pay_invoice(**kwargs):
+        paid.append(kwargs)
+
+    monkeypatch.setattr(payout_queue, "resolver", resolver)
+    monkeypatch.setattr(payouts, "pay_invoice", pay_invoice)
+    await _win(sure_win, "address1")
+
+    withdraw = await get_satsdice_withdraw("address1")
+    assert withdraw and withdraw.is_spent
+    assert withdraw.payout_status == PayoutStatus.queued
+    await payout_queue.drain()
+
+    assert resolver.requests == [("alice@example.com", 100_000)]
+    assert [p["max_sat"] for p in paid] == [100]
+    bet = await get_satsdice_bet(sure_win.id, "address1")
+    assert bet and bet.payout_status == PayoutStatus.paid
+
+
+@pytest.mark.asyncio
+async def test_lnurl_withdraw_is_the_fallback(sure_win, invoice, monkeypatch):
+    monkeypatch.setattr(satsdice_settings, "payout_retry_backoff", 0)
+    monkeypatch.setattr(satsdice_settings, "payout_max_attempts", 2)
+    monkeypatch.setattr(payout_queue, "resolver", FakeResolver(invoice, fail=True))
+    await _win(sure_win, "address2")
+    await payout_queue.drain()
+
+    withdraw = await get_satsdice_withdraw("address2")
+    assert withdraw and not withdraw.is_spent
+    assert withdraw.error == "alice@example.com: address not found"
+
+    async def pay_invoice(**_):
+        return None
+
+    monkeypatch.setattr(payouts, "pay_invoice", pay_invoice)
+    response = await api_lnurlw_callback(withdraw.unique_hash, pr=await invoice(100))
+    assert response.ok
+    await payout_queue.drain()
+    withdraw = await get_satsdice_withdraw("address2")
+    assert withdraw and withdraw.payout_status == PayoutStatus.paid
+
+
+def test_payout_address(link):
+    payerdata = json.dumps({"identifier": "bob@wallet.example"})
+    assert payout_address(None, payerdata) == "bob@wallet.example"
+    assert payout_address("alice@example.com", payerdata) == "bob@wallet.example"
+    assert payout_address(" alice@example.com ", None) == "alice@example.com"
+    assert payout_address("good luck!", "{not json") is None
+
+    response = json.loads(lnurlp_response(link, "https://satsdice.test/cb").content)
+    assert response["commentAllowed"] == 144
+    assert response["payerData"] == {"identifier": {"mandatory": False}}
+
+
+@pytest.mark.asyncio
+async def test_payerdata_is_part_of_the_description_hash(link, invoice, monkeypatch):
+    async def get_wallet(wallet_id: str):
+        return SimpleNamespace(balance=10**9)
+
+    created = []
+
+    async def create_invoice(**kwargs):
+        created.append(kwargs)
+        bolt11 = await invoice(kwargs["amount"])
+        return SimpleNamespace(payment_hash=urlsafe_short_hash(), bolt11=bolt11)
+
+    def take(*_):
+        raise AssertionError("pooled invoices cannot commit to payer data")
+
+    monkeypatch.setattr(exposure, "get_wallet", get_wallet)
+    monkeypatch.setattr(views_lnurl, "create_invoice", create_invoice)
+    monkeypatch.setattr(invoice_pool, "take", take)
+    request = SimpleNamespace(url_for=lambda *_, **__: "http://localhost:5000/win")
+    payerdata = '{"identifier": "bob@wallet.example"}'
+    await api_lnurlp_callback(
+        request, link.id, amount="100000", comment=None, payerdata=payerdata  # type: ignore
+    )
+
+    description = lnurlp_metadata(link).encoded + payerdata.encode()
+    assert created[0]["unhashed_description"] == description
+    assert created[0]["description_hash"] == hashlib.sha256(description).digest()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "address",
+    ["alice@localhost.localdomain", "alice@127.0.0.1.nip.io", "alice@10.0.0.1.nip.io"],
+)
+async def test_resolver_refuses_private_hosts(address, monkeypatch):
+    addresses = {"localhost.localdomain": "127.0.0.1", "127.0.0.1.nip.io": "::1"}
+
+    def getaddrinfo(host, *_, **__):
+        ip = addresses.get(host, "::ffff:10.0.0.1")
+        return [(socket.AF_INET6, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (ip, 0))]
+
+    async def handle(*_, **__):
+        raise AssertionError("private hosts are never asked")
+
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+    monkeypatch.setattr(payouts, "handle", handle)
+    with pytest.raises(ValueError, match="not a public host"):
+        await LnurlPayResolver().invoice(address, 100_000)
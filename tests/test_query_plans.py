@@ -0,0 +1,156 @@
+import pytest
+from lnbits.db import SQLITE
+
+from ..crud import (
+    add_satsdice_pay_counters,
+    backfill_satsdice_rollups,
+    claim_satsdice_withdraw,
+    create_satsdice_payment,
+    create_satsdice_withdraw,
+    db,
+    delete_satsdice_pay,
+    delete_satsdice_pays,
+    delete_satsdice_withdraw,
+    delete_withdraw_hash_checks,
+    expire_satsdice_payments,
+    expire_satsdice_withdraws,
+    fail_satsdice_payout,
+    finish_satsdice_payout,
+    get_pending_satsdice_payments,
+    get_satsdice_analytics,
+    get_satsdice_bet,
+    get_satsdice_bets,
+    get_satsdice_links_paying_out,
+    get_satsdice_pay,
+    get_satsdice_payment,
+    get_satsdice_payments_by_hash,
+    get_satsdice_pays,
+    get_satsdice_pays_by_id,
+    get_satsdice_pooled_pays,
+    get_satsdice_rollups,
+    get_satsdice_seed_chain,
+    get_satsdice_seed_chains,
+    get_satsdice_stats,
+    get_satsdice_withdraw,
+    get_satsdice_withdraw_by_hash,
+    get_satsdice_withdraws,
+    get_withdraw_hash_checkw,
+    requeue_satsdice_payouts,
+    reserve_satsdice_seed,
+    retry_satsdice_payout,
+    satsdice_link_cache,
+    set_satsdice_payout_invoice,
+    settle_satsdice_payment,
+    stream_satsdice_export,
+    take_satsdice_payouts,
+    update_satsdice_pay,
+    update_satsdice_payment,
+    update_satsdice_withdraw,
+)
+from ..models import (
+    BetStatus,
+    CreateSatsDicePayment,
+    CreateSatsDiceWithdraw,
+    SatsdiceRollup,
+    WithdrawStatus,
+)
+
+
+async def _full_scans(statement: str, parameters) -> list[str]:
+    async with db.connect() as conn:
+        if conn.type == SQLITE:
+            result = await conn.conn.exec_driver_sql(
+                f"EXPLAIN QUERY PLAN {statement}", parameters
+            )
+            details = [row[3] for row in result.fetchall()]
+            return [
+                d
+                for d in details
+                if (d.startswith("SCAN") and "USING" not in d)
+                or d.startswith("USE TEMP B-TREE FOR ORDER BY")
+            ]
+        # tables in the test database are tiny, so make the planner prefer indexes
+        await conn.conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        result = await conn.conn.exec_driver_sql(f"EXPLAIN {statement}", parameters)
+        return [row[0] for row in result.fetchall() if "Seq Scan" in row[0]]
+
+
+@pytest.mark.asyncio
+async def test_crud_queries_use_indexes(link, recorder):
+    satsdice_link_cache.clear()
+    await get_satsdice_pay(link.id)
+    await get_satsdice_pays([link.wallet, "other_wallet"])
+    await get_satsdice_pays_by_id([link.id, "other_link"])
+    await get_satsdice_pooled_pays()
+    await update_satsdice_pay(link)
+    await add_satsdice_pay_counters({link.id: (1, 2, 3), "other_link": (4, 5, 6)})
+
+    payment = await create_satsdice_payment(
+        CreateSatsDicePayment(satsdice_pay=link.id, value=100, payment_hash="hash1")
+    )
+    await get_satsdice_payment(payment.payment_hash)
+    await update_satsdice_payment(payment)
+    payment.paid = True
+    await settle_satsdice_payment(
+        payment, SatsdiceRollup(satsdice_pay=link.id, hour=3600, bets=1)
+    )
+    await get_satsdice_payments_by_hash(link.id, [payment.payment_hash, "hash2"])
+    await get_pending_satsdice_payments(2**31)
+    await get_pending_satsdice_payments(2**31, (1, "a"))
+    chain_id, _ = await reserve_satsdice_seed(link.id)
+    await reserve_satsdice_seed(link.id)
+    await get_satsdice_seed_chain(chain_id)
+    await get_satsdice_seed_chains(link.id)
+
+    withdraw = await create_satsdice_withdraw(
+        CreateSatsDiceWithdraw(
+            payment_hash=payment.payment_hash, satsdice_pay=link.id, value=200
+        )
+    )
+    await get_satsdice_withdraw(withdraw.id)
+    await get_satsdice_bet(link.id, payment.payment_hash)
+    for status in [None, *BetStatus]:
+        await get_satsdice_bets([link.wallet], link.id, status)
+        await get_satsdice_bets([link.wallet], status=status, cursor=(1, "a"))
+        await get_satsdice_bets([link.wallet], link.id, status, (1, "a"))
+    for status in [None, *WithdrawStatus]:
+        await get_satsdice_withdraws([link.wallet], link.id, status)
+        await get_satsdice_withdraws([link.wallet], status=status, cursor=(1, "a"))
+        await get_satsdice_withdraws([link.wallet], link.id, status, (1, "a"))
+    await get_satsdice_withdraw_by_hash(withdraw.unique_hash)
+    await update_satsdice_withdraw(withdraw)
+    await claim_satsdice_withdraw(withdraw.unique_hash, "lnbc1", 200_000)
+    # other tests drain their payouts, so this only takes the one claimed here
+    await take_satsdice_payouts(2**31, 10)
+    await get_satsdice_links_paying_out([link.id, "other_link"])
+    await set_satsdice_payout_invoice(withdraw.id, "lnbc1")
+    await retry_satsdice_payout(withdraw.id, 2**31, "no route")
+    await finish_satsdice_payout(withdraw.id)
+    await fail_satsdice_payout(withdraw.id, "no route")
+    await requeue_satsdice_payouts()
+    await get_withdraw_hash_checkw("the_hash", withdraw.unique_hash)
+    await get_withdraw_hash_checkw("the_hash", withdraw.unique_hash)
+    await delete_satsdice_withdraw(withdraw.id)
+    await expire_satsdice_payments(1, lost=True)
+    await expire_satsdice_payments(1, lost=False, archive=False)
+    await expire_satsdice_withdraws(1, claimed=True)
+    await expire_satsdice_withdraws(1, claimed=False)
+    await delete_withdraw_hash_checks(1)
+    await backfill_satsdice_rollups()
+    await get_satsdice_rollups(link.id, 0, 7200)
+    await get_satsdice_stats([link.wallet], None, 0, 7200)
+    await get_satsdice_stats([link.wallet], link.id, 0, 7200)
+    await get_satsdice_analytics([link.wallet], None, 0, 7200)
+    await get_satsdice_analytics([link.wallet], link.id, 0, 7200)
+    assert [rows async for rows in stream_satsdice_export(link.id, chunk_size=1)]
+    await delete_satsdice_pays(["other_link"])
+    await delete_satsdice_pay(link.id)
+
+    queries = [
+        (statement, parameters)
+        for statement, parameters in recorder.queries
+        if not statement.lstrip().upper().startswith("INSERT")
+    ]
+    assert queries
+    for statement, parameters in queries:
+        assert await _full_scans(statement, parameters) == [], statement
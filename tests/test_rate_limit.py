@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+import pytest
+from lnbits.helpers import urlsafe_short_hash
+from lnurl import LnurlErrorResponse
+
+from .. import exposure, ratelimit
+from ..crud import create_satsdice_pay
+from ..metrics import metrics
+from ..models import CreateSatsDiceLink
+from ..ratelimit import TokenBuckets
+from ..views_lnurl import api_lnurlp_callback
+
+
+def test_token_buckets_refill(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(ratelimit, "monotonic", lambda: now[0])
+    buckets = TokenBuckets(maxsize=2)
+
+    assert [buckets.take("a", 1, 3) for _ in range(4)] == [True] * 3 + [False]
+    now[0] += 1.5
+    assert [buckets.take("a", 1, 3) for _ in range(2)] == [True, False]
+    now[0] += 100
+    assert [buckets.take("a", 1, 3) for _ in range(4)] == [True] * 3 + [False]
+
+    # the least recently used bucket is dropped, and comes back full
+    buckets.take("b", 1, 3)
+    buckets.take("c", 1, 3)
+    assert len(buckets) == 2
+    assert buckets.take("a", 1, 3)
+
+
+@pytest.mark.asyncio
+async def test_callbacks_over_the_limit_are_refused(monkeypatch):
+    async def get_wallet(wallet_id: str):
+        return SimpleNamespace(balance=0)
+
+    # admitted bets stop at the exposure check, before any invoice is made
+    monkeypatch.setattr(exposure, "get_wallet", get_wallet)
+    link = await create_satsdice_pay(
+        CreateSatsDiceLink(
+            wallet=urlsafe_short_hash(),
+            title="limited",
+            base_url="http://localhost:5000",
+            min_bet=10,
+            max_bet=1000,
+            multiplier=2,
+            chance=45,
+            rate_limit=3,
+            client_rate_limit=2,
+        )
+    )
+    refused = metrics.counters["satsdice_rate_limited_total"]
+    before = dict(refused)
+
+    async def bet(host: str) -> str:
+        request = SimpleNamespace(client=SimpleNamespace(host=host))
+        response = await api_lnurlp_callback(
+            request, link.id, amount="100000", comment=None, payerdata=None  # type: ignore
+        )
+        assert isinstance(response, LnurlErrorResponse)
+        return "limited" if response.reason.startswith("Too many") else "admitted"
+
+    assert [await bet("10.0.0.1") for _ in range(3)] == [
+        "admitted",
+        "admitted",
+        "limited",
+    ]
+    assert [await bet("10.0.0.2") for _ in range(2)] == ["admitted", "limited"]
+
+    client, link_scope = (("scope", "client"),), (("scope", "link"),)
+    assert refused[client] - before.get(client, 0) == 1
+    assert refused[link_scope] - before.get(link_scope, 0) == 1
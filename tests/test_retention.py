@@ -0,0 +1,130 @@
+import pytest
+
+from ..crud import (
+    create_satsdice_payment,
+    create_satsdice_withdraw,
+    db,
+    get_satsdice_payment,
+    get_satsdice_withdraw,
+    get_withdraw_hash_checkw,
+)
+from ..migrations import m021_date_untimed_payments
+from ..models import CreateSatsDicePayment, CreateSatsDiceWithdraw
+from ..services import run_satsdice_retention
+from ..settings import satsdice_settings
+from ..views_lnurl import api_lnurlw_callback
+
+
+async def _bet(link, payment_hash: str, old: bool, **state) -> None:
+    await create_satsdice_payment(
+        CreateSatsDicePayment(
+            satsdice_pay=link.id, value=100, payment_hash=payment_hash
+        )
+    )
+    await db.execute(
+        """
+        UPDATE satsdice.satsdice_payment
+        SET time = :time, paid = :paid, lost = :lost
+        WHERE payment_hash = :payment_hash
+        """,
+        {
+            "time": 1000 if old else 2**31,
+            "paid": state.get("paid", False),
+            "lost": state.get("lost", False),
+            "payment_hash": payment_hash,
+        },
+    )
+
+
+async def _win(link, payment_hash: str, used: int) -> str:
+    await _bet(link, payment_hash, old=True, paid=True)
+    withdraw = await create_satsdice_withdraw(
+        CreateSatsDiceWithdraw(
+            payment_hash=payment_hash, satsdice_pay=link.id, value=200, used=used
+        )
+    )
+    await db.execute(
+        "UPDATE satsdice.satsdice_withdraw SET open_time = 1000 WHERE id = :id",
+        {"id": withdraw.id},
+    )
+    return withdraw.unique_hash
+
+
+@pytest.mark.asyncio
+async def test_retention_archives_expired_rows(link, invoice, monkeypatch):
+    monkeypatch.setattr(satsdice_settings, "retention_batch_size", 2)
+    for i in range(5):
+        await _bet(link, f"lost{i}", old=True, lost=True)
+    await _bet(link, "recent_lost", old=False, lost=True)
+    await _bet(link, "unpaid", old=True)
+    await _win(link, "claimed", used=1)
+    unclaimed = await _win(link, "unclaimed", used=0)
+    await _win(link, "paying", used=1)
+    await db.execute(
+        "UPDATE satsdice.satsdice_withdraw SET payout_status = 'paying'"
+        " WHERE id = 'paying'"
+    )
+    await get_withdraw_hash_checkw("old_hash", "lnurl")
+    await db.execute(
+        "UPDATE satsdice.hash_checkw SET time = 1000 WHERE id = 'old_hash'"
+    )
+
+    response = await api_lnurlw_callback(unclaimed, pr=await invoice(200))
+    assert response.reason == "Withdraw expired."  # type: ignore[union-attr]
+
+    report = await run_satsdice_retention()
+    assert report.rows == {
+        "lost_payments": 5,
+        "unpaid_payments": 1,
+        "claimed_withdraws": 1,
+        "expired_withdraws": 1,
+        "hash_checks": 1,
+    }
+    assert await get_satsdice_payment("recent_lost")
+    for payment_hash in ("lost0", "unpaid", "claimed", "unclaimed"):
+        assert not await get_satsdice_payment(payment_hash)
+    assert not await get_satsdice_withdraw("claimed")
+
+    archived = await db.fetchall(
+        "SELECT payment_hash FROM satsdice.satsdice_payment_archive"
+        " WHERE satsdice_pay = :link",
+        {"link": link.id},
+    )
+    assert sorted(row["payment_hash"] for row in archived) == sorted(
+        [*(f"lost{i}" for i in range(5)), "claimed", "unclaimed"]
+    )
+    assert (await get_withdraw_hash_checkw("old_hash", "lnurl"))["hash"] is False
+    assert (await run_satsdice_retention()).rows["lost_payments"] == 0
+
+    # a claimed withdraw is only removed once its payout ended
+    assert await get_satsdice_withdraw("paying")
+    await db.execute(
+        "UPDATE satsdice.satsdice_withdraw SET payout_status = 'paid'"
+        " WHERE id = 'paying'"
+    )
+    assert (await run_satsdice_retention()).rows["claimed_withdraws"] == 1
+    assert not await get_satsdice_withdraw("paying")
+
+
+@pytest.mark.asyncio
+async def test_migration_dates_untimed_bets(link, monkeypatch):
+    monkeypatch.setattr(satsdice_settings, "lost_payment_days", 30)
+    await _win(link, "untimed_win", used=1)
+    await _bet(link, "untimed_lost", old=True, lost=True)
+    await db.execute(
+        """
+        UPDATE satsdice.satsdice_payment SET time = 0
+        WHERE payment_hash IN ('untimed_win', 'untimed_lost')
+        """
+    )
+    async with db.connect() as conn:
+        await m021_date_untimed_payments(conn)
+
+    won = await get_satsdice_payment("untimed_win")
+    assert won and won.time == 1000
+    lost = await get_satsdice_payment("untimed_lost")
+    assert lost and lost.time > 2**30
+    # dated by the migration, the lost bet is not expired as ancient
+    report = await run_satsdice_retention()
+    assert report.rows["lost_payments"] == 0
+    assert await get_satsdice_payment("untimed_lost")
@@ -0,0 +1,81 @@
+from time import perf_counter
+
+import pytest
+from fastapi import HTTPException
+
+from .. import simulation
+from ..models import CreateSatsDiceLink, SimulateSatsdiceLink
+from ..simulation import house_edge, simulate
+from ..views_api import api_create_satsdice_link
+
+np = pytest.importorskip("numpy")
+
+
+class ColumnRng:
+    """Hands out the columns of fixed bets and rolls, however they are chunked."""
+
+    def __init__(self, bets, rolls) -> None:
+        self.arrays = [bets, rolls]
+        self.calls = 0
+        self.column = 0
+
+    def integers(self, *_, size, **__):
+        array = self.arrays[self.calls % 2]
+        columns = array[:, self.column : self.column + size[1]]
+        self.calls += 1
+        if self.calls % 2 == 0:
+            self.column += size[1]
+        return columns
+
+
+def test_simulation_matches_exact_edge():
+    data = SimulateSatsdiceLink(
+        chance=45, multiplier=2, min_bet=10, max_bet=1000, bankroll=100_000, seed=1
+    )
+    start = perf_counter()
+    result = simulate(data)
+    assert perf_counter() - start < 1
+
+    assert result.bets == 1_000_000
+    assert result.expected_edge == pytest.approx(0.1)
+    assert result.house_edge == pytest.approx(0.1, abs=0.01)
+    assert result.drawdown_p50 <= result.drawdown_p95 <= result.drawdown_p99
+    assert 0 <= result.ruin_probability < 0.5
+
+
+def test_chunks_do_not_change_the_result(monkeypatch):
+    data = SimulateSatsdiceLink(
+        chance=45, multiplier=2, min_bet=10, max_bet=1000, bankroll=2000, bets=3000
+    )
+    rng = np.random.default_rng(1)
+    bets = rng.integers(10, 1000, size=(1000, 3), endpoint=True)
+    rolls = rng.integers(0, 10_000, size=(1000, 3))
+
+    results = []
+    for chunk_size in (10**6, 7):
+        monkeypatch.setattr(simulation, "CHUNK_SIZE", chunk_size)
+        monkeypatch.setattr(
+            simulation.np.random, "default_rng", lambda _: ColumnRng(bets, rolls)
+        )
+        results.append(simulate(data))
+    whole, chunked = results
+    assert chunked.dict() == pytest.approx(whole.dict())
+    assert 0 < whole.ruin_probability < 1
+
+
+def test_negative_edge_is_ruinous():
+    data = SimulateSatsdiceLink(
+        chance=60, multiplier=2, min_bet=10, max_bet=1000, bankroll=10_000, seed=1
+    )
+    assert house_edge(data.chance, data.multiplier) < 0
+    assert simulate(data).ruin_probability == 1
+
+
+@pytest.mark.asyncio
+async def test_negative_edge_link_is_rejected():
+    data = CreateSatsDiceLink(
+        title="unfair", min_bet=10, max_bet=100, multiplier=2, chance=55
+    )
+    with pytest.raises(HTTPException) as exc:
+        await api_create_satsdice_link(data, wallet=None)  # type: ignore[arg-type]
+    assert "negative edge" in exc.value.detail
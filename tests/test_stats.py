@@ -0,0 +1,140 @@
+import pytest
+from fastapi import HTTPException
+
+from .. import crud
+from ..crud import (
+    create_satsdice_payment,
+    db,
+    get_satsdice_analytics,
+    get_satsdice_bet,
+    get_satsdice_bets,
+    get_satsdice_rollups,
+    get_satsdice_stats,
+)
+from ..models import CreateSatsDicePayment, SatsdiceAnalytics, SatsdiceRollup
+from ..services import backfill_rollups, resolve_satsdice_bet
+from ..views_api import _stats_range
+
+
+def _totals(rollups: list[SatsdiceRollup]) -> tuple[int, int, int, int]:
+    return (
+        sum(r.bets for r in rollups),
+        sum(r.volume for r in rollups),
+        sum(r.wins for r in rollups),
+        sum(r.payouts for r in rollups),
+    )
+
+
+@pytest.mark.asyncio
+async def test_settled_bets_are_rolled_up_once(link):
+    for i in range(5):
+        payment_hash = f"{link.id}_stats{i}"
+        await create_satsdice_payment(
+            CreateSatsDicePayment(
+                satsdice_pay=link.id, value=100, payment_hash=payment_hash
+            )
+        )
+        await resolve_satsdice_bet(payment_hash)
+    wins = sum(bet.paid for bet in await get_satsdice_bets([link.wallet], link.id))
+    expected = (5, 500, wins, 200 * wins)
+
+    rollups = await get_satsdice_rollups(link.id, 0, 2**31)
+    assert _totals(rollups) == expected
+    await backfill_rollups()
+    assert await get_satsdice_rollups(link.id, 0, 2**31) == rollups
+
+    # bets settled before the rollups existed are counted by the backfill
+    await db.execute(
+        "DELETE FROM satsdice.satsdice_rollup WHERE satsdice_pay = :id",
+        {"id": link.id},
+    )
+    await db.execute(
+        """
+        UPDATE satsdice.satsdice_payment SET rolled_up = FALSE
+        WHERE satsdice_pay = :id
+        """,
+        {"id": link.id},
+    )
+    assert await backfill_rollups(batch_size=2) >= 5
+    assert await backfill_rollups(batch_size=2) == 0
+    assert await get_satsdice_rollups(link.id, 0, 2**31) == rollups
+
+    [stats] = await get_satsdice_stats([link.wallet], None, 0, 2**31)
+    assert (stats.bets, stats.volume, stats.wins, stats.payouts) == expected
+    assert stats.win_rate == wins / 5
+    assert stats.rtp == 2 * wins / 5
+    assert stats.biggest_win == (200 if wins else 0)
+
+
+@pytest.mark.asyncio
+async def test_bet_is_not_settled_without_its_rollup(link, monkeypatch):
+    payment_hash = f"{link.id}_norollup"
+    await create_satsdice_payment(
+        CreateSatsDicePayment(
+            satsdice_pay=link.id, value=100, payment_hash=payment_hash
+        )
+    )
+    monkeypatch.setattr(crud, "_ROLLUP_UPSERT", "INSERT INTO no_such_table VALUES (1)")
+    with pytest.raises(Exception, match="no_such_table"):
+        await resolve_satsdice_bet(payment_hash)
+
+    bet = await get_satsdice_bet(link.id, payment_hash)
+    assert bet and bet.pending
+    assert await get_satsdice_rollups(link.id, 0, 2**31) == []
+
+
+def test_stats_range_is_bounded():
+    assert _stats_range(7300, 10000) == (7200, 10000)
+    with pytest.raises(HTTPException):
+        _stats_range(10000, 10000)
+    with pytest.raises(HTTPException):
+        _stats_range(0, 400 * 24 * 3600)
+
+
+@pytest.mark.asyncio
+async def test_analytics_compare_realized_and_theoretical_rtp(link):
+    for i in range(10):
+        payment_hash = f"{link.id}_analytics{i}"
+        await create_satsdice_payment(
+            CreateSatsDicePayment(
+                satsdice_pay=link.id, value=10 * (i + 1), payment_hash=payment_hash
+            )
+        )
+        await resolve_satsdice_bet(payment_hash)
+    bets = await get_satsdice_bets([link.wallet], link.id)
+    winnings = sum(bet.winnings or 0 for bet in bets)
+
+    [row] = await get_satsdice_analytics([link.wallet], link.id, 0, 2**31)
+    assert (row.bets, row.volume, row.payouts) == (10, 550, winnings)
+    assert row.wins == sum(bet.paid for bet in bets)
+    # nothing was claimed yet
+    assert row.liability == winnings
+    assert row.theoretical_rtp == 0.9
+    assert row.rtp_low <= row.rtp == winnings / 550 <= row.rtp_high
+    assert "volume_sq" not in row.dict()
+
+    # links without bets in the window still show their liability
+    [empty] = await get_satsdice_analytics([link.wallet], link.id, 0, 3600)
+    assert (empty.bets, empty.rtp, empty.liability) == (0, 0, winnings)
+
+
+def test_rtp_interval_narrows_with_more_bets():
+    def interval(bets: int) -> tuple[float, float]:
+        row = SatsdiceAnalytics(
+            satsdice_pay="link",
+            chance=45,
+            multiplier=2,
+            bets=bets,
+            volume=100 * bets,
+            volume_sq=100**2 * bets,
+            wins=bets * 45 // 100,
+            payouts=200 * (bets * 45 // 100),
+            liability=0,
+        )
+        return row.rtp_low, row.rtp_high
+
+    low, high = interval(10_000)
+    assert low == pytest.approx(0.9 - 0.0195, abs=1e-3)
+    assert high == pytest.approx(0.9 + 0.0195, abs=1e-3)
+    low, high = interval(1_000_000)
+    assert high - low == pytest.approx(0.0039, abs=1e-4)
@@ -0,0 +1,91 @@
+from types import SimpleNamespace
+
+import pytest
+
+from .. import services, tasks
+from ..crud import create_satsdice_payment, db, get_satsdice_bet
+from ..models import CreateSatsDicePayment
+from ..services import sweep_pending_bets
+from ..tasks import on_invoice_paid
+
+
+@pytest.mark.asyncio
+async def test_paid_invoice_resolves_bet_once(link):
+    await create_satsdice_payment(
+        CreateSatsDicePayment(satsdice_pay=link.id, value=100, payment_hash="paid1")
+    )
+    bet = await get_satsdice_bet(link.id, "paid1")
+    assert bet and bet.pending
+
+    paid = SimpleNamespace(payment_hash="paid1", extra={"tag": "satsdice"})
+    await on_invoice_paid(paid)
+    bet = await get_satsdice_bet(link.id, "paid1")
+    assert bet and not bet.pending
+    assert bet.paid != bet.lost
+    if bet.paid:
+        assert bet.winnings == 200
+
+    await on_invoice_paid(paid)
+    assert await get_satsdice_bet(link.id, "paid1") == bet
+
+
+@pytest.mark.asyncio
+async def test_other_invoices_are_ignored(link):
+    await create_satsdice_payment(
+        CreateSatsDicePayment(satsdice_pay=link.id, value=100, payment_hash="other1")
+    )
+    await on_invoice_paid(SimpleNamespace(payment_hash="other1", extra={}))
+    bet = await get_satsdice_bet(link.id, "other1")
+    assert bet and bet.pending
+
+
+@pytest.mark.asyncio
+async def test_listener_survives_failed_bets(link, monkeypatch):
+    async def resolve(payment_hash: str):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(tasks, "resolve_satsdice_bet", resolve)
+    await on_invoice_paid(
+        SimpleNamespace(payment_hash="failed1", extra={"tag": "satsdice"})
+    )
+
+
+@pytest.mark.asyncio
+async def test_sweep_resolves_missed_bets(link, monkeypatch):
+    for payment_hash in ("missed1", "missed2", "missed3", "unpaid1"):
+        await create_satsdice_payment(
+            CreateSatsDicePayment(
+                satsdice_pay=link.id, value=100, payment_hash=payment_hash
+            )
+        )
+    await db.execute(
+        """
+        UPDATE satsdice.satsdice_payment SET time = 1000
+        WHERE payment_hash IN ('missed1', 'missed2', 'missed3', 'unpaid1')
+        """
+    )
+    # missed1 is paid in core, missed2 only at the funding source
+    core = {
+        "missed1": SimpleNamespace(success=True, pending=False),
+        "missed2": SimpleNamespace(success=False, pending=True),
+        "unpaid1": SimpleNamespace(success=False, pending=True),
+    }
+
+    async def get_standalone_payment(payment_hash: str, incoming: bool):
+        return core.get(payment_hash)
+
+    async def check_payment_status(payment):
+        return SimpleNamespace(success=payment is core["missed2"])
+
+    monkeypatch.setattr(services, "get_standalone_payment", get_standalone_payment)
+    monkeypatch.setattr(services, "check_payment_status", check_payment_status)
+
+    assert await sweep_pending_bets(2000, batch_size=1) == 2
+    for payment_hash, pending in (
+        ("missed1", False),
+        ("missed2", False),
+        ("missed3", True),
+        ("unpaid1", True),
+    ):
+        bet = await get_satsdice_bet(link.id, payment_hash)
+        assert bet and bet.pending == pending
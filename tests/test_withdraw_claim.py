@@ -0,0 +1,190 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from lnbits.exceptions import PaymentError
+from lnbits.helpers import urlsafe_short_hash
+from lnurl import LnurlSuccessResponse
+
+from .. import payouts
+from ..crud import (
+    create_satsdice_pay,
+    create_satsdice_withdraw,
+    delete_satsdice_pay,
+    delete_satsdice_withdraw,
+    get_satsdice_withdraw,
+)
+from ..exposure import house_exposure
+from ..models import (
+    CreateSatsDiceLink,
+    CreateSatsDiceWithdraw,
+    DeleteSatsDiceLinks,
+    PayoutStatus,
+)
+from ..payouts import payout_queue
+from ..settings import satsdice_settings
+from ..views_api import api_bulk_delete_links, api_link_delete, api_payout_status
+from ..views_lnurl import api_lnurlw_callback
+
+
+@pytest.fixture
+def retry_now(monkeypatch):
+    monkeypatch.setattr(satsdice_settings, "payout_retry_backoff", 0)
+    monkeypatch.setattr(satsdice_settings, "payout_max_attempts", 3)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_callbacks_pay_out_once(link, invoice, monkeypatch):
+    withdraw = await create_satsdice_withdraw(
+        CreateSatsDiceWithdraw(payment_hash="claim1", satsdice_pay=link.id, value=200)
+    )
+    pr = await invoice(200)
+    payouts_made = []
+
+    async def pay_invoice(**kwargs):
+        await asyncio.sleep(0.01)
+        payouts_made.append(kwargs)
+
+    monkeypatch.setattr(payouts, "pay_invoice", pay_invoice)
+    responses = await asyncio.gather(
+        *[api_lnurlw_callback(withdraw.unique_hash, pr=pr) for _ in range(300)]
+    )
+    assert sum(isinstance(r, LnurlSuccessResponse) for r in responses) == 1
+    assert {r.reason for r in responses if not r.ok} == {"Withdraw already used."}
+
+    # the callbacks only queue the payout
+    assert payouts_made == []
+    await payout_queue.drain()
+    assert payouts_made == [
+        {"wallet_id": link.wallet, "payment_request": pr, "max_sat": 200}
+    ]
+    status = await api_payout_status(withdraw.unique_hash)
+    assert status.status == PayoutStatus.paid and status.attempts == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_payout_is_retried_then_released(
+    link, invoice, monkeypatch, retry_now
+):
+    withdraw = await create_satsdice_withdraw(
+        CreateSatsDiceWithdraw(payment_hash="claim2", satsdice_pay=link.id, value=200)
+    )
+    assert await house_exposure.liability(link.wallet) == 200
+    attempts = []
+
+    async def pay_invoice(**kwargs):
+        attempts.append(kwargs)
+        raise ValueError("no route")
+
+    monkeypatch.setattr(payouts, "pay_invoice", pay_invoice)
+    response = await api_lnurlw_callback(withdraw.unique_hash, pr=await invoice(200))
+    assert response.ok
+    await payout_queue.drain()
+
+    assert len(attempts) == 3
+    released = await get_satsdice_withdraw(withdraw.id)
+    assert released and not released.is_spent
+    assert released.payout_status == PayoutStatus.failed
+    assert released.error == "no route"
+    # released winnings are still owed
+    assert await house_exposure.liability(link.wallet) == 200
+
+    # the winnings can be withdrawn again
+    monkeypatch.setattr(payouts, "pay_invoice", lambda **_: asyncio.sleep(0))
+    response = await api_lnurlw_callback(withdraw.unique_hash, pr=await invoice(200))
+    assert response.ok
+    await payout_queue.drain()
+    status = await api_payout_status(withdraw.unique_hash)
+    assert status.status == PayoutStatus.paid and status.error is None
+    assert await house_exposure.liability(link.wallet) == 0
+
+
+@pytest.mark.asyncio
+async def test_pending_payout_is_never_released(link, invoice, monkeypatch, retry_now):
+    withdraw = await create_satsdice_withdraw(
+        CreateSatsDiceWithdraw(payment_hash="claim3", satsdice_pay=link.id, value=200)
+    )
+    results = [PaymentError("Payment is still pending.", status="pending")] * 5 + [
+        PaymentError("Payment already paid.", status="success")
+    ]
+
+    async def pay_invoice(**_):
+        raise results.pop(0)
+
+    monkeypatch.setattr(payouts, "pay_invoice", pay_invoice)
+    await api_lnurlw_callback(withdraw.unique_hash, pr=await invoice(200))
+    await payout_queue.drain()
+
+    assert results == []
+    paid = await get_satsdice_withdraw(withdraw.id)
+    assert paid and paid.is_spent and paid.payout_status == PayoutStatus.paid
+
+
+@pytest.mark.asyncio
+async def test_links_paying_out_are_kept(link, invoice, monkeypatch):
+    other = await create_satsdice_pay(
+        CreateSatsDiceLink(
+            wallet=urlsafe_short_hash(),
+            title="other",
+            base_url="http://localhost:5000",
+            min_bet=10,
+            max_bet=1000,
+            multiplier=2,
+            chance=45,
+        )
+    )
+    orphan, kept = [
+        await create_satsdice_withdraw(
+            CreateSatsDiceWithdraw(payment_hash=hash_, satsdice_pay=pay, value=200)
+        )
+        for hash_, pay in (("claim5", link.id), ("claim6", other.id))
+    ]
+    paid = []
+
+    async def pay_invoice(**kwargs):
+        paid.append(kwargs["wallet_id"])
+
+    monkeypatch.setattr(payouts, "pay_invoice", pay_invoice)
+    monkeypatch.setattr(payout_queue, "notify", lambda: None)
+    for withdraw in (orphan, kept):
+        response = await api_lnurlw_callback(
+            withdraw.unique_hash, pr=await invoice(200)
+        )
+        assert response.ok
+
+    key_info = SimpleNamespace(wallet=SimpleNamespace(id=link.wallet))
+    with pytest.raises(HTTPException) as exc:
+        await api_link_delete(link.id, key_info)  # type: ignore[arg-type]
+    assert exc.value.status_code == 409
+    [result] = await api_bulk_delete_links(
+        DeleteSatsDiceLinks(ids=[link.id]), key_info  # type: ignore[arg-type]
+    )
+    assert not result.ok and result.detail.startswith("Pay link is still paying")
+
+    # a link deleted anyway must not strand the payouts of other links
+    await delete_satsdice_pay(link.id)
+    await payout_queue.drain()
+    assert paid == [other.wallet]
+    stranded = await get_satsdice_withdraw(orphan.id)
+    assert stranded and stranded.payout_status == PayoutStatus.queued
+    await delete_satsdice_withdraw(orphan.id)
+
+
+@pytest.mark.asyncio
+async def test_invalid_invoices_are_refused(link, invoice):
+    withdraw = await create_satsdice_withdraw(
+        CreateSatsDiceWithdraw(payment_hash="claim4", satsdice_pay=link.id, value=200)
+    )
+    response = await api_lnurlw_callback(withdraw.unique_hash, pr="lnbc1")
+    assert not response.ok and response.reason == "Invalid payment request."
+    response = await api_lnurlw_callback(withdraw.unique_hash, pr=await invoice(201))
+    assert not response.ok and response.reason == "Invoice amount is too high."
+    unclaimed = await get_satsdice_withdraw(withdraw.id)
+    assert unclaimed and not unclaimed.is_spent
+
+
+@pytest.mark.asyncio
+async def test_unknown_withdraw(invoice):
+    response = await api_lnurlw_callback("does_not_exist", pr=await invoice(200))
+    assert not response.ok and response.reason == "Withdraw not found."
@@ -1,29 +1,50 @@
-import random
+from functools import lru_cache
 from http import HTTPStatus
+from pathlib import Path
 
 from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import HTMLResponse
-from lnbits.core.crud import get_payment
+from fastapi.responses import HTMLResponse, Response
 from lnbits.core.models import User
 from lnbits.decorators import check_user_exists
 from lnbits.helpers import template_renderer
+from lnbits.settings import settings
 
-from .crud import (
-    create_satsdice_withdraw,
-    get_satsdice_pay,
-    get_satsdice_payment,
-    get_satsdice_withdraw,
-    update_satsdice_payment,
+from .cache import LRUCache
+from .crud import get_satsdice_bet, get_satsdice_pay
+from .helpers import etag, not_modified
+from .metrics import MetricsRoute
+from .services import invoice_paid, resolve_satsdice_bet
+
+satsdice_generic_router: APIRouter = APIRouter(route_class=MetricsRoute)
+
+# rendered display pages by ETag, a page only depends on its link's odds
+# and the site settings
+display_page_cache = LRUCache(maxsize=256, ttl=600)
+# changes the ETags of display pages when lnbits or the template change
+display_version = etag(
+    settings.version,
+    Path(__file__).parent.joinpath("templates/satsdice/display.html").read_bytes(),
 )
-from .models import CreateSatsDiceWithdraw
 
-satsdice_generic_router: APIRouter = APIRouter()
 
+def site_version() -> str:
+    """
+    Changes with the lnbits settings that base.html renders, such as the
+    site title, theme, denomination and logos. Admins change them at runtime.
+    """
+    return etag(settings.lnbits_apple_touch_icon, settings.to_public().json())
 
-def satsdice_renderer():
+
+@lru_cache(maxsize=1)
+def _site_renderer(site: str):
     return template_renderer(["satsdice/templates"])
 
 
+def satsdice_renderer():
+    # a renderer copies the site settings into its globals when it is made
+    return _site_renderer(site_version())
+
+
 @satsdice_generic_router.get("/", response_class=HTMLResponse)
 async def index(request: Request, user: User = Depends(check_user_exists)):
     return satsdice_renderer().TemplateResponse(
@@ -39,16 +60,31 @@ async def display(request: Request, link_id: str):
             status_code=HTTPStatus.NOT_FOUND, detail="satsdice link does not exist."
         )
 
-    return satsdice_renderer().TemplateResponse(
-        "satsdice/display.html",
-        {
-            "request": request,
-            "link_id": link_id,
-            "chance": link.chance,
-            "multiplier": link.multiplier,
-            "unique": True,
-        },
+    page_etag = etag(
+        display_version, site_version(), link.id, link.chance, link.multiplier
     )
+    headers = {"ETag": page_etag, "Cache-Control": "no-cache"}
+    if not_modified(request.headers.get("if-none-match"), page_etag):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+    page = display_page_cache.get(page_etag)
+    if page is None:
+        page = (
+            satsdice_renderer()
+            .TemplateResponse(
+                "satsdice/display.html",
+                {
+                    "request": request,
+                    "link_id": link_id,
+                    "chance": link.chance,
+                    "multiplier": link.multiplier,
+                    "unique": True,
+                },
+            )
+            .body
+        )
+        display_page_cache.set(page_etag, page)
+    return HTMLResponse(page, headers=headers)
 
 
 @satsdice_generic_router.get(
@@ -57,60 +93,31 @@ async def display(request: Request, link_id: str):
     response_class=HTMLResponse,
 )
 async def displaywin(request: Request, link_id: str, payment_hash: str):
-    satsdicelink = await get_satsdice_pay(link_id)
-    if not satsdicelink:
+    bet = await get_satsdice_bet(link_id, payment_hash)
+    if not bet:
         raise HTTPException(
-            status_code=HTTPStatus.NOT_FOUND, detail="satsdice link does not exist."
+            status_code=HTTPStatus.NOT_FOUND, detail="satsdice bet does not exist."
         )
-    withdraw_link = await get_satsdice_withdraw(payment_hash)
-    payment = await get_satsdice_payment(payment_hash)
-    if not payment or payment.lost:
+    if bet.pending and await invoice_paid(payment_hash):
+        # the listener missed the paid invoice, only core is asked here
+        await resolve_satsdice_bet(payment_hash)
+        bet = await get_satsdice_bet(link_id, payment_hash) or bet
+    if bet.lost:
         return satsdice_renderer().TemplateResponse(
             "satsdice/error.html",
-            {"request": request, "link": satsdicelink.id, "paid": False, "lost": True},
+            {"request": request, "link": link_id, "paid": False, "lost": True},
         )
-    if withdraw_link:
-        return satsdice_renderer().TemplateResponse(
-            "satsdice/displaywin.html",
-            {
-                "request": request,
-                "unique_hash": withdraw_link.unique_hash,
-                "value": withdraw_link.value,
-                "chance": satsdicelink.chance,
-                "multiplier": satsdicelink.multiplier,
-                "paid": False,
-                "lost": False,
-            },
-        )
-    rand = random.randint(0, 100)
-    chance = satsdicelink.chance
-    core_payment = await get_payment(payment_hash)
-    if not rand < chance or not core_payment.success:
-        payment.lost = True
-        await update_satsdice_payment(payment)
-        return satsdice_renderer().TemplateResponse(
-            "satsdice/error.html",
-            {"request": request, "link": satsdicelink.id, "paid": False, "lost": True},
-        )
-    payment.paid = True
-    await update_satsdice_payment(payment)
-
-    data = CreateSatsDiceWithdraw(
-        satsdice_pay=satsdicelink.id,
-        value=int(payment.value * satsdicelink.multiplier),
-        payment_hash=payment_hash,
-        used=0,
-    )
-
-    withdraw_link = await create_satsdice_withdraw(data)
     return satsdice_renderer().TemplateResponse(
         "satsdice/displaywin.html",
         {
             "request": request,
-            "unique_hash": withdraw_link.unique_hash,
-            "value": withdraw_link.value,
-            "chance": satsdicelink.chance,
-            "multiplier": satsdicelink.multiplier,
+            "link_id": link_id,
+            "payment_hash": payment_hash,
+            "unique_hash": bet.unique_hash,
+            "value": bet.winnings,
+            "chance": bet.chance,
+            "multiplier": bet.multiplier,
+            "pending": bet.pending,
             "paid": False,
             "lost": False,
         },
@@ -1,33 +1,180 @@
+import asyncio
+import csv
+import io
+import json
+import time
+from collections.abc import AsyncIterator
 from http import HTTPStatus
 
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from lnbits.core.crud import get_user
 from lnbits.core.models import WalletTypeInfo
 from lnbits.decorators import require_admin_key, require_invoice_key
+from sse_starlette.sse import EventSourceResponse
 
 from .crud import (
+    EXPORT_COLUMNS,
     create_satsdice_pay,
+    create_satsdice_pays,
     delete_satsdice_pay,
+    delete_satsdice_pays,
+    get_satsdice_analytics,
+    get_satsdice_bet,
+    get_satsdice_bets,
+    get_satsdice_links_paying_out,
     get_satsdice_pay,
+    get_satsdice_payment,
     get_satsdice_pays,
+    get_satsdice_pays_by_id,
+    get_satsdice_rollups,
+    get_satsdice_seed_chains,
+    get_satsdice_stats,
+    get_satsdice_withdraw_by_hash,
+    get_satsdice_withdraws,
     get_withdraw_hash_checkw,
+    rollup_hour,
+    satsdice_link_cache,
+    stream_satsdice_export,
     update_satsdice_pay,
+    update_satsdice_pays,
 )
-from .models import CreateSatsDiceLink, SatsdiceLink
+from .events import bet_events
+from .fair import unpack_rolls
+from .helpers import decode_cursor, encode_cursor
+from .metrics import MetricsRoute, metrics
+from .models import (
+    BetStatus,
+    CreateSatsDiceLink,
+    CreateSatsDiceLinks,
+    DeleteSatsDiceLinks,
+    ExportFormat,
+    PayoutStatus,
+    SatsdiceAnalytics,
+    SatsdiceBet,
+    SatsdiceBetPage,
+    SatsdiceBulkResult,
+    SatsdiceCommitment,
+    SatsdiceLink,
+    SatsdicePayoutState,
+    SatsdiceRoll,
+    SatsdiceRollCheck,
+    SatsdiceRollup,
+    SatsdiceSimulation,
+    SatsdiceStats,
+    SatsdiceWithdrawPage,
+    SimulateSatsdiceLink,
+    StatsOrder,
+    UpdateSatsDiceLinks,
+    VerifySatsdiceRolls,
+    WithdrawStatus,
+)
+from .services import backfill_rollups, verify_satsdice_rolls
+from .simulation import house_edge, simulate
 
-satsdice_api_router = APIRouter()
+satsdice_api_router = APIRouter(route_class=MetricsRoute)
 
+PAYING_OUT_DETAIL = "Pay link is still paying out winnings, try again later."
 
-@satsdice_api_router.get("/api/v1/links")
-async def api_links(
-    key_info: WalletTypeInfo = Depends(require_invoice_key),
-    all_wallets: bool = Query(False),
-) -> list[SatsdiceLink]:
+
+async def _wallet_ids(key_info: WalletTypeInfo, all_wallets: bool) -> list[str]:
     wallet_ids = [key_info.wallet.id]
     if all_wallets:
         user = await get_user(key_info.wallet.user)
         if user:
             wallet_ids = user.wallet_ids
+    return wallet_ids
+
+
+def _cursor(cursor: str | None) -> tuple[int, str] | None:
+    if not cursor:
+        return None
+    try:
+        return decode_cursor(cursor)
+    except ValueError as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail=str(exc)
+        ) from exc
+
+
+def _check_link(data: CreateSatsDiceLink) -> None:
+    if data.min_bet > data.max_bet:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Bad request")
+    if house_edge(data.chance, data.multiplier) < 0:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="Chance and multiplier give the house a negative edge.",
+        )
+
+
+def _check_wallet(data: CreateSatsDiceLink, wallet_id: str) -> None:
+    if data.wallet and data.wallet != wallet_id:
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN,
+            detail="Come on, seriously, this isn't your satsdice!",
+        )
+
+
+def _bet_state(bet: SatsdiceBet) -> list[tuple[str, dict]]:
+    outcome = {"value": bet.value, "roll": bet.roll}
+    if bet.lost:
+        return [("lost", outcome)]
+    if not bet.unique_hash:
+        return []
+    won = {**outcome, "winnings": bet.winnings, "unique_hash": bet.unique_hash}
+    if bet.payout_address and bet.used:
+        won["payout_address"] = bet.payout_address
+    state = [("won", won)]
+    # queued payouts are not claimed until they have been paid
+    if bet.used and bet.payout_status in (None, PayoutStatus.paid):
+        state.append(("claimed", {"winnings": bet.winnings}))
+    return state
+
+
+async def _event_stream(
+    channel: str,
+    queue: asyncio.Queue,
+    events: list[tuple[str, dict]],
+    final: tuple[str, ...] = (),
+) -> AsyncIterator[dict]:
+    try:
+        while True:
+            event, data = events.pop(0) if events else await queue.get()
+            yield {"event": event, "data": json.dumps(data)}
+            if event in final:
+                return
+    finally:
+        bet_events.unsubscribe(channel, queue)
+
+
+async def _export_stream(
+    link_id: str, export_format: ExportFormat
+) -> AsyncIterator[str]:
+    # rows are written as they come, one chunk of text per chunk of rows
+    if export_format == ExportFormat.csv:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        async for rows in stream_satsdice_export(link_id):
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+        return
+    async for rows in stream_satsdice_export(link_id):
+        yield "".join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, row, strict=True))) + "\n"
+            for row in rows
+        )
+
+
+@satsdice_api_router.get("/api/v1/links")
+async def api_links(
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    all_wallets: bool = Query(False),
+) -> list[SatsdiceLink]:
+    wallet_ids = await _wallet_ids(key_info, all_wallets)
     return await get_satsdice_pays(wallet_ids)
 
 
@@ -55,14 +202,8 @@ async def api_create_satsdice_link(
     data: CreateSatsDiceLink,
     wallet: WalletTypeInfo = Depends(require_admin_key),
 ) -> SatsdiceLink:
-    if data.min_bet > data.max_bet:
-        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Bad request")
-
-    if data.wallet and data.wallet != wallet.wallet.id:
-        raise HTTPException(
-            status_code=HTTPStatus.FORBIDDEN,
-            detail="Come on, seriously, this isn't your satsdice!",
-        )
+    _check_link(data)
+    _check_wallet(data, wallet.wallet.id)
 
     data.wallet = data.wallet or wallet.wallet.id
     link = await create_satsdice_pay(data=data)
@@ -87,8 +228,7 @@ async def api_update_satsdice_link(
             detail="Come on, seriously, this isn't your satsdice!",
         )
 
-    if data.min_bet > data.max_bet:
-        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Bad request")
+    _check_link(data)
 
     data.wallet = data.wallet or wallet.wallet.id
     for k, v in data.dict().items():
@@ -112,10 +252,335 @@ async def api_link_delete(
         raise HTTPException(
             status_code=HTTPStatus.FORBIDDEN, detail="Not your pay link."
         )
+    if await get_satsdice_links_paying_out([link_id]):
+        # the payout queue needs the link to know which wallet pays
+        raise HTTPException(status_code=HTTPStatus.CONFLICT, detail=PAYING_OUT_DETAIL)
 
     await delete_satsdice_pay(link_id)
 
 
+@satsdice_api_router.post("/api/v1/bulk/links")
+async def api_bulk_create_links(
+    data: CreateSatsDiceLinks,
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+) -> list[SatsdiceBulkResult]:
+    results = []
+    valid: list[tuple[SatsdiceBulkResult, CreateSatsDiceLink]] = []
+    for item in data.links:
+        try:
+            _check_link(item)
+            _check_wallet(item, wallet.wallet.id)
+        except HTTPException as exc:
+            results.append(SatsdiceBulkResult(ok=False, detail=exc.detail))
+            continue
+        item.wallet = item.wallet or wallet.wallet.id
+        result = SatsdiceBulkResult()
+        results.append(result)
+        valid.append((result, item))
+
+    links = await create_satsdice_pays([item for _, item in valid])
+    for (result, _), link in zip(valid, links, strict=True):
+        result.id = link.id
+        result.link = link
+    return results
+
+
+@satsdice_api_router.put("/api/v1/bulk/links")
+async def api_bulk_update_links(
+    data: UpdateSatsDiceLinks,
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+) -> list[SatsdiceBulkResult]:
+    existing = {
+        link.id: link
+        for link in await get_satsdice_pays_by_id([item.id for item in data.links])
+    }
+    results = []
+    updated = []
+    for item in data.links:
+        link = existing.get(item.id)
+        try:
+            if not link:
+                raise HTTPException(
+                    status_code=HTTPStatus.NOT_FOUND,
+                    detail="Satsdice does not exist",
+                )
+            if link.wallet != wallet.wallet.id:
+                raise HTTPException(
+                    status_code=HTTPStatus.FORBIDDEN,
+                    detail="Come on, seriously, this isn't your satsdice!",
+                )
+            _check_link(item)
+            _check_wallet(item, wallet.wallet.id)
+        except HTTPException as exc:
+            results.append(SatsdiceBulkResult(id=item.id, ok=False, detail=exc.detail))
+            continue
+        for k, v in item.dict(exclude={"id"}).items():
+            setattr(link, k, v)
+        link.wallet = item.wallet or wallet.wallet.id
+        results.append(SatsdiceBulkResult(id=link.id, link=link))
+        updated.append(link)
+
+    await update_satsdice_pays(updated)
+    return results
+
+
+@satsdice_api_router.post("/api/v1/bulk/links/delete")
+async def api_bulk_delete_links(
+    data: DeleteSatsDiceLinks,
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+) -> list[SatsdiceBulkResult]:
+    existing = {link.id: link for link in await get_satsdice_pays_by_id(data.ids)}
+    paying_out = await get_satsdice_links_paying_out(list(existing))
+    results = []
+    deleted = []
+    for link_id in data.ids:
+        link = existing.get(link_id)
+        if not link:
+            detail = "Pay link does not exist."
+        elif link.wallet != wallet.wallet.id:
+            detail = "Not your pay link."
+        elif link_id in paying_out:
+            detail = PAYING_OUT_DETAIL
+        else:
+            results.append(SatsdiceBulkResult(id=link_id))
+            deleted.append(link_id)
+            continue
+        results.append(SatsdiceBulkResult(id=link_id, ok=False, detail=detail))
+
+    await delete_satsdice_pays(deleted)
+    return results
+
+
+@satsdice_api_router.get("/api/v1/links/{link_id}/commitments")
+async def api_link_commitments(link_id: str) -> list[SatsdiceCommitment]:
+    commitments = []
+    for chain in await get_satsdice_seed_chains(link_id):
+        commitment = SatsdiceCommitment(**chain.dict(exclude={"root"}))
+        if chain.used >= chain.length:
+            commitment.root = chain.root
+        commitments.append(commitment)
+    return commitments
+
+
+@satsdice_api_router.get("/api/v1/links/{link_id}/events")
+async def api_link_events(link_id: str) -> EventSourceResponse:
+    link = await get_satsdice_pay(link_id)
+    if not link:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Pay link does not exist."
+        )
+    channel = f"link:{link_id}"
+    queue = bet_events.subscribe(channel)
+    return EventSourceResponse(_event_stream(channel, queue, []))
+
+
+@satsdice_api_router.get("/api/v1/bets/{link_id}/{payment_hash}/events")
+async def api_bet_events(link_id: str, payment_hash: str) -> EventSourceResponse:
+    # subscribe before reading the bet so no event falls in between
+    queue = bet_events.subscribe(payment_hash)
+    bet = await get_satsdice_bet(link_id, payment_hash)
+    if not bet:
+        bet_events.unsubscribe(payment_hash, queue)
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="satsdice bet does not exist."
+        )
+    return EventSourceResponse(
+        _event_stream(payment_hash, queue, _bet_state(bet), ("lost", "claimed"))
+    )
+
+
+@satsdice_api_router.get("/api/v1/bets/{link_id}/{payment_hash}/rolls")
+async def api_bet_rolls(link_id: str, payment_hash: str) -> list[SatsdiceRoll]:
+    payment = await get_satsdice_payment(payment_hash)
+    if not payment or payment.satsdice_pay != link_id:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="satsdice bet does not exist."
+        )
+    if payment.results:
+        results = unpack_rolls(payment.results)
+    elif payment.roll is not None:
+        results = [(payment.roll, payment.paid)]
+    else:
+        results = []
+    return [
+        SatsdiceRoll(index=index, roll=value, won=won)
+        for index, (value, won) in enumerate(results)
+    ]
+
+
+@satsdice_api_router.post("/api/v1/links/{link_id}/verify")
+async def api_link_verify(
+    link_id: str, data: VerifySatsdiceRolls
+) -> list[SatsdiceRollCheck]:
+    return await verify_satsdice_rolls(link_id, data.payment_hashes)
+
+
+@satsdice_api_router.post(
+    "/api/v1/simulate", dependencies=[Depends(require_invoice_key)]
+)
+async def api_simulate(data: SimulateSatsdiceLink) -> SatsdiceSimulation:
+    if data.min_bet > data.max_bet:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Bad request")
+    try:
+        # keep the event loop free while numpy crunches the bets
+        return await asyncio.to_thread(simulate, data)
+    except RuntimeError as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_IMPLEMENTED, detail=str(exc)
+        ) from exc
+
+
+@satsdice_api_router.get("/api/v1/payments")
+async def api_payments(
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    all_wallets: bool = Query(False),
+    link_id: str | None = Query(None),
+    status: BetStatus | None = Query(None),
+    cursor: str | None = Query(None),
+    limit: int = Query(50, ge=1, le=500),
+) -> SatsdiceBetPage:
+    wallet_ids = await _wallet_ids(key_info, all_wallets)
+    bets = await get_satsdice_bets(
+        wallet_ids, link_id, status, _cursor(cursor), limit + 1
+    )
+    page = SatsdiceBetPage(data=bets[:limit])
+    if len(bets) > limit:
+        last = page.data[-1]
+        page.next_cursor = encode_cursor(last.time, last.payment_hash)
+    return page
+
+
+@satsdice_api_router.get("/api/v1/withdraws")
+async def api_withdraws(
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    all_wallets: bool = Query(False),
+    link_id: str | None = Query(None),
+    status: WithdrawStatus | None = Query(None),
+    cursor: str | None = Query(None),
+    limit: int = Query(50, ge=1, le=500),
+) -> SatsdiceWithdrawPage:
+    wallet_ids = await _wallet_ids(key_info, all_wallets)
+    withdraws = await get_satsdice_withdraws(
+        wallet_ids, link_id, status, _cursor(cursor), limit + 1
+    )
+    page = SatsdiceWithdrawPage(data=withdraws[:limit])
+    if len(withdraws) > limit:
+        last = page.data[-1]
+        page.next_cursor = encode_cursor(last.open_time, last.id)
+    return page
+
+
+STATS_DEFAULT_RANGE = 24 * 3600
+STATS_MAX_RANGE = 366 * 24 * 3600
+
+
+def _stats_range(start: int | None, end: int | None) -> tuple[int, int]:
+    """Default to the last day, never read more than a year of rollups."""
+    end = end or int(time.time())
+    start = start if start is not None else end - STATS_DEFAULT_RANGE
+    if start >= end or end - start > STATS_MAX_RANGE:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="The stats range must be positive and at most 366 days.",
+        )
+    return rollup_hour(start), end
+
+
+@satsdice_api_router.get("/api/v1/stats")
+async def api_stats(
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    all_wallets: bool = Query(False),
+    link_id: str | None = Query(None),
+    start: int | None = Query(None),
+    end: int | None = Query(None),
+    order_by: StatsOrder = Query(StatsOrder.volume),
+) -> list[SatsdiceStats]:
+    wallet_ids = await _wallet_ids(key_info, all_wallets)
+    stats = await get_satsdice_stats(wallet_ids, link_id, *_stats_range(start, end))
+    return sorted(stats, key=lambda row: getattr(row, order_by.value), reverse=True)
+
+
+@satsdice_api_router.get("/api/v1/analytics")
+async def api_analytics(
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    all_wallets: bool = Query(False),
+    link_id: str | None = Query(None),
+    start: int | None = Query(None),
+    end: int | None = Query(None),
+) -> list[SatsdiceAnalytics]:
+    wallet_ids = await _wallet_ids(key_info, all_wallets)
+    rows = await get_satsdice_analytics(wallet_ids, link_id, *_stats_range(start, end))
+    return sorted(rows, key=lambda row: row.volume, reverse=True)
+
+
+@satsdice_api_router.get("/api/v1/stats/{link_id}/hourly")
+async def api_stats_hourly(
+    link_id: str,
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    start: int | None = Query(None),
+    end: int | None = Query(None),
+) -> list[SatsdiceRollup]:
+    link = await get_satsdice_pay(link_id)
+    if not link:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Pay link does not exist."
+        )
+    if link.wallet != key_info.wallet.id:
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN, detail="Not your pay link."
+        )
+    return await get_satsdice_rollups(link_id, *_stats_range(start, end))
+
+
+@satsdice_api_router.get("/api/v1/export/{link_id}")
+async def api_link_export(
+    link_id: str,
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    export_format: ExportFormat = Query(ExportFormat.ndjson, alias="format"),
+) -> StreamingResponse:
+    link = await get_satsdice_pay(link_id)
+    if not link:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Pay link does not exist."
+        )
+    if link.wallet != key_info.wallet.id:
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN, detail="Not your pay link."
+        )
+    media_type = {
+        ExportFormat.ndjson: "application/x-ndjson",
+        ExportFormat.csv: "text/csv",
+    }[export_format]
+    filename = f"satsdice-{link_id}.{export_format.value}"
+    return StreamingResponse(
+        _export_stream(link_id, export_format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@satsdice_api_router.post(
+    "/api/v1/stats/backfill", dependencies=[Depends(require_admin_key)]
+)
+async def api_stats_backfill() -> dict[str, int]:
+    return {"bets": await backfill_rollups()}
+
+
+@satsdice_api_router.get("/api/v1/payouts/{unique_hash}")
+async def api_payout_status(unique_hash: str) -> SatsdicePayoutState:
+    withdraw = await get_satsdice_withdraw_by_hash(unique_hash)
+    if not withdraw:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Withdraw does not exist."
+        )
+    return SatsdicePayoutState(
+        status=withdraw.payout_status,
+        value=withdraw.value,
+        attempts=withdraw.attempts,
+        error=withdraw.error,
+    )
+
+
 @satsdice_api_router.get(
     "/api/v1/withdraws/{the_hash}/{lnurl_id}",
     dependencies=[Depends(require_invoice_key)],
@@ -126,3 +591,20 @@ async def api_withdraw_hash_retrieve(
 ):
     hash_check = await get_withdraw_hash_checkw(the_hash, lnurl_id)
     return hash_check
+
+
+@satsdice_api_router.get(
+    "/api/v1/cache",
+    dependencies=[Depends(require_admin_key)],
+)
+async def api_cache_stats() -> dict[str, int]:
+    return satsdice_link_cache.stats()
+
+
+@satsdice_api_router.get(
+    "/api/v1/metrics",
+    dependencies=[Depends(require_admin_key)],
+    response_class=PlainTextResponse,
+)
+async def api_metrics() -> PlainTextResponse:
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
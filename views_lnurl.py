@@ -1,18 +1,14 @@
-import json
-import math
 from http import HTTPStatus
 
+from bolt11 import decode as bolt11_decode
 from fastapi import APIRouter, Query, Request
-from lnbits.core.services import (
-    create_invoice,
-    pay_invoice,
-)
+from fastapi.responses import Response
+from lnbits.core.services import create_invoice
 from lnurl import (
     CallbackUrl,
     LightningInvoice,
     LnurlErrorResponse,
     LnurlPayActionResponse,
-    LnurlPayMetadata,
     LnurlPayResponse,
     LnurlSuccessResponse,
     LnurlWithdrawResponse,
@@ -22,37 +18,50 @@ from lnurl import (
 )
 from pydantic import parse_obj_as
 
+from .counters import link_counters
 from .crud import (
+    claim_satsdice_withdraw,
     create_satsdice_payment,
     get_satsdice_pay,
     get_satsdice_withdraw_by_hash,
-    update_satsdice_withdraw,
 )
+from .exposure import house_exposure
+from .helpers import (
+    COMMENT_ALLOWED,
+    bet_invoice,
+    lnurlp_response,
+    not_modified,
+    payout_address,
+)
+from .metrics import MetricsRoute, metrics
 from .models import CreateSatsDicePayment
+from .payouts import payout_queue
+from .pool import invoice_pool
+from .ratelimit import admits_invoice
+from .services import withdraw_opened_after
 
-satsdice_lnurl_router = APIRouter()
+satsdice_lnurl_router = APIRouter(route_class=MetricsRoute)
 
 
 @satsdice_lnurl_router.get(
     "/api/v1/lnurlp/{link_id}",
     name="satsdice.lnurlp_response",
+    response_model=LnurlPayResponse | LnurlErrorResponse,
 )
 async def api_lnurlp_response(
     req: Request, link_id: str
-) -> LnurlPayResponse | LnurlErrorResponse:
+) -> Response | LnurlErrorResponse:
     link = await get_satsdice_pay(link_id)
     if not link:
         return LnurlErrorResponse(reason="LNURL-pay not found.")
+    link_counters.add(link.id, served_meta=1)
     callback_url = str(req.url_for("satsdice.api_lnurlp_callback", link_id=link.id))
-    _plain = [
-        "text/plain",
-        f"{link.title} (Chance: {link.chance}%, Multiplier: {link.multiplier})",
-    ]
-    return LnurlPayResponse(
-        callback=parse_obj_as(CallbackUrl, callback_url),
-        metadata=LnurlPayMetadata(json.dumps([_plain])),
-        minSendable=MilliSatoshi(math.ceil(link.min_bet * 1) * 1000),
-        maxSendable=MilliSatoshi(round(link.max_bet * 1) * 1000),
+    response = lnurlp_response(link, callback_url)
+    headers = {"ETag": response.etag, "Cache-Control": "no-cache"}
+    if not_modified(req.headers.get("if-none-match"), response.etag):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    return Response(
+        content=response.content, media_type="application/json", headers=headers
     )
 
 
@@ -61,14 +70,22 @@ async def api_lnurlp_response(
     name="satsdice.api_lnurlp_callback",
 )
 async def api_lnurlp_callback(
-    req: Request, link_id: str, amount: str = Query(None)
+    req: Request,
+    link_id: str,
+    amount: str = Query(None),
+    comment: str | None = Query(None),
+    payerdata: str | None = Query(None),
 ) -> LnurlErrorResponse | LnurlPayActionResponse:
     link = await get_satsdice_pay(link_id)
     if not link:
         return LnurlErrorResponse(reason="LNURL-pay not found.")
+    if comment and len(comment) > COMMENT_ALLOWED:
+        return LnurlErrorResponse(
+            reason=f"Comment is longer than {COMMENT_ALLOWED} characters."
+        )
 
-    min_bet = link.min_bet * 1000
-    max_bet = link.max_bet * 1000
+    min_bet = link.min_bet * link.rolls * 1000
+    max_bet = link.max_bet * link.rolls * 1000
 
     amount_received = int(amount or 0)
     if amount_received < min_bet:
@@ -79,37 +96,49 @@ async def api_lnurlp_callback(
         return LnurlErrorResponse(
             reason=f"Amount {amount_received} is greater than maximum {max_bet}."
         )
+    limited = link.rate_limit or link.client_rate_limit
+    if limited and not admits_invoice(link, req.client.host if req.client else ""):
+        return LnurlErrorResponse(reason="Too many bets, try again in a minute.")
 
-    _plain = [
-        "text/plain",
-        f"{link.title} (Chance: {link.chance}%, Multiplier: {link.multiplier})",
-    ]
-    _metadata = LnurlPayMetadata(json.dumps([_plain]))
-    payment = await create_invoice(
-        wallet_id=link.wallet,
-        amount=int(amount_received / 1000),
-        memo="Satsdice bet",
-        unhashed_description=_metadata.encode(),
-        extra={"tag": "satsdice", "link": link.id, "comment": "comment"},
-    )
+    payout = int(amount_received / 1000 * link.multiplier)
+    if not await house_exposure.admits(link.wallet, payout):
+        return LnurlErrorResponse(
+            reason="The house cannot cover this bet right now, try a smaller amount."
+        )
 
+    # a ready made invoice saves the player the round trip to the backend,
+    # but pooled invoices cannot commit to the payer data of LUD-18
+    invoice = None if payerdata else invoice_pool.take(link, amount_received)
+    if invoice:
+        payment_hash, bolt11 = invoice.payment_hash, invoice.bolt11
+    else:
+        with metrics.timer(
+            "satsdice_backend_wait_seconds", (("call", "create_invoice"),)
+        ):
+            payment = await create_invoice(
+                **bet_invoice(link, int(amount_received / 1000), payerdata)
+            )
+        payment_hash, bolt11 = payment.payment_hash, payment.bolt11
+
+    # the seed is only reserved when the bet settles, see resolve_satsdice_bet
     data = CreateSatsDicePayment(
         satsdice_pay=link.id,
         value=int(amount_received / 1000),
-        payment_hash=payment.payment_hash,
+        payment_hash=payment_hash,
+        payout_address=payout_address(comment, payerdata),
+        rolls=link.rolls,
     )
 
     await create_satsdice_payment(data)
+    link_counters.add(link.id, served_pr=1)
 
     url = str(
-        req.url_for(
-            "satsdice.displaywin", link_id=link.id, payment_hash=payment.payment_hash
-        )
+        req.url_for("satsdice.displaywin", link_id=link.id, payment_hash=payment_hash)
     )
     msg = parse_obj_as(Max144Str, "Check the attached link")
     success_action = UrlAction(url=parse_obj_as(CallbackUrl, url), description=msg)
     return LnurlPayActionResponse(
-        pr=parse_obj_as(LightningInvoice, payment.bolt11),
+        pr=parse_obj_as(LightningInvoice, bolt11),
         successAction=success_action,
         disposable=link.disposable,
     )
@@ -130,6 +159,9 @@ async def api_lnurlw_response(
     if link.used:
         return LnurlErrorResponse(reason="Withdraw already used.")
 
+    if link.open_time < withdraw_opened_after():
+        return LnurlErrorResponse(reason="Withdraw expired.")
+
     url = str(req.url_for("satsdice.api_lnurlw_callback", unique_hash=link.unique_hash))
     return LnurlWithdrawResponse(
         callback=parse_obj_as(CallbackUrl, url),
@@ -149,29 +181,29 @@ async def api_lnurlw_callback(
     unique_hash: str,
     pr: str = Query(None),
 ) -> LnurlErrorResponse | LnurlSuccessResponse:
-    link = await get_satsdice_withdraw_by_hash(unique_hash)
-    if not link:
-        return LnurlErrorResponse(reason="Withdraw not found.")
-    if link.used:
-        return LnurlErrorResponse(reason="Withdraw already used.")
-    paylink = await get_satsdice_pay(link.satsdice_pay)
-
-    if not paylink:
-        return LnurlErrorResponse(reason="No paylink found.")
-
-    link.used = True
-    await update_satsdice_withdraw(link)
-
     try:
-        await pay_invoice(
-            wallet_id=paylink.wallet,
-            payment_request=pr,
-            max_sat=link.value,
-        )
-    except Exception as exc:
-        # If the payment failed, we need to reset the withdraw to unused
-        link.used = False
-        await update_satsdice_withdraw(link)
-        return LnurlErrorResponse(reason=str(exc))
+        invoice = bolt11_decode(pr)
+    except Exception:
+        return LnurlErrorResponse(reason="Invalid payment request.")
+    if not invoice.amount_msat:
+        return LnurlErrorResponse(reason="Amountless invoices are not supported.")
+
+    opened_after = withdraw_opened_after()
+    claim = await claim_satsdice_withdraw(
+        unique_hash, pr, invoice.amount_msat, opened_after
+    )
+    if not claim:
+        link = await get_satsdice_withdraw_by_hash(unique_hash)
+        if not link:
+            return LnurlErrorResponse(reason="Withdraw not found.")
+        if link.used:
+            return LnurlErrorResponse(reason="Withdraw already used.")
+        if link.open_time < opened_after:
+            return LnurlErrorResponse(reason="Withdraw expired.")
+        if invoice.amount_msat > link.value * 1000:
+            return LnurlErrorResponse(reason="Invoice amount is too high.")
+        return LnurlErrorResponse(reason="No paylink found.")
 
+    # the winnings stay in the exposure until the queued payout is paid
+    payout_queue.notify()
     return LnurlSuccessResponse()